@@ -0,0 +1,135 @@
+""" Runs batches of external commands (GATK, modify_VJSD.py) concurrently. """
+import os
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Job:
+	""" A command to run as part of a batch.
+		Parameters
+		----------
+			name: string
+				Identifies the job in the results.
+			command: string
+				The shell command to run.
+			memory: float; default 0
+				The memory the job needs, in GB. For java commands this should match '-Xmx'.
+			output: any; default None
+				The value to report as the result of the job, usually the output filename.
+	"""
+	def __init__(self, name, command, memory = 0, output = None):
+		self.name = name
+		self.command = command
+		self.memory = memory
+		self.output = output
+
+	def __repr__(self):
+		return "Job({}, memory = {})".format(self.name, self.memory)
+
+
+class BatchRunner:
+	""" Runs jobs on a pool of threads, each waiting on a subprocess.
+		At most `cores` jobs run at once, and jobs are only started while the memory
+		reserved by the running jobs stays within `memory`.
+		Usage
+		-----
+			runner = BatchRunner(cores = 8, memory = 32)
+			results = runner([Job('patient1', command, memory = 4), ...])
+	"""
+	def __init__(self, cores = None, memory = None, retries = 1, log_folder = None):
+		"""
+			Parameters
+			----------
+				cores: int; default None
+					The maximum number of jobs to run at once. Defaults to the number of CPUs.
+				memory: float; default None
+					The total memory available to the jobs, in GB. If None, only `cores`
+					limits the number of jobs. A job that needs more than `memory` runs alone.
+				retries: int; default 1
+					The number of times to rerun a job that fails.
+				log_folder: string [PATH]; default None
+					If provided, the output of each job is also saved to
+					'{name}.stdout.txt' and '{name}.stderr.txt' in this folder.
+		"""
+		self.cores = cores or os.cpu_count() or 1
+		self.memory = memory
+		self.retries = retries
+		self.log_folder = log_folder
+		self._reserved = 0
+		self._memory_available = threading.Condition()
+
+	def __call__(self, jobs):
+		return self.run(jobs)
+
+	def run(self, jobs):
+		""" Runs every job and waits for them to finish.
+			Returns
+			-------
+				results: list<dict<>>
+					The result of each job, in the same order as `jobs`.
+					* 'name', 'command', 'output': From the job.
+					* 'status': bool
+						Whether the job finished with a return code of 0.
+					* 'returncode': int
+					* 'attempts': int
+					* 'wall time': float
+						The seconds taken by the last attempt.
+					* 'stdout', 'stderr': string
+						The output of the last attempt.
+		"""
+		if self.log_folder is not None:
+			os.makedirs(self.log_folder, exist_ok = True)
+		with ThreadPoolExecutor(max_workers = self.cores) as executor:
+			results = list(executor.map(self._runJob, jobs))
+		return results
+
+	def _reserve(self, memory):
+		if self.memory is None: return 0
+		# A job that doesn't fit within the budget waits until nothing else is running.
+		memory = min(memory, self.memory)
+		with self._memory_available:
+			while self._reserved + memory > self.memory:
+				self._memory_available.wait()
+			self._reserved += memory
+		return memory
+
+	def _release(self, memory):
+		if self.memory is None: return
+		with self._memory_available:
+			self._reserved -= memory
+			self._memory_available.notify_all()
+
+	def _runJob(self, job):
+		attempts = 0
+		while True:
+			attempts += 1
+			reserved = self._reserve(job.memory)
+			start = time.time()
+			try:
+				process = subprocess.run(job.command, shell = True, stdout = subprocess.PIPE,
+					stderr = subprocess.PIPE, universal_newlines = True)
+			finally:
+				self._release(reserved)
+			wall_time = time.time() - start
+			if process.returncode == 0 or attempts > self.retries:
+				break
+
+		if self.log_folder is not None:
+			for kind, text in [('stdout', process.stdout), ('stderr', process.stderr)]:
+				with open(os.path.join(self.log_folder, "{}.{}.txt".format(job.name, kind)), 'w') as log_file:
+					log_file.write(text)
+
+		result = {
+			'name': job.name,
+			'command': job.command,
+			'output': job.output,
+			'status': process.returncode == 0,
+			'returncode': process.returncode,
+			'attempts': attempts,
+			'wall time': wall_time,
+			'stdout': process.stdout,
+			'stderr': process.stderr
+		}
+		return result
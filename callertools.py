@@ -10,8 +10,12 @@ else:
 sys.path.append(GITHUB_FOLDER)
 
 import pytools.filetools as filetools
+import pytools.systemtools as systemtools
 import pytools.tabletools as tabletools
 import progressbar
+import vcf
+from varianttools import batchtools
+from varianttools.vcftools import combine, scanner, vaf, vcfio
 
 
 class CallerClassifier:
@@ -139,7 +143,12 @@ class GATKMergeSampleCallsets:
 		------------
 			GATK
 			Reference Genome
+			Neither is needed if 'native' is True, since the files are merged by
+			vcftools.combine instead of GATK CombineVariants.
 	"""
+	# The caller priority used by CombineVariants, ordered by VAF confidence.
+	priority_order = "mutect2,varscan,strelka,muse,somaticsniper"
+
 	def __init__(self, merge_options = None, **kwargs):
 		""" Parameters
 			----------
@@ -147,6 +156,10 @@ class GATKMergeSampleCallsets:
 				merge_options: the general options being used for the genomics pipeline.
 				output_folder:
 				variants:
+			Keyword Arguments
+			-----------------
+				* 'native': bool; default False
+					Merge callsets with vcftools.combine.combineVariants() instead of GATK.
 		"""
 		#log_message = "GATKMergeSampleCallsets(merge_options = {})".format(merge_options)
 		#print(log_message)
@@ -161,7 +174,9 @@ class GATKMergeSampleCallsets:
 			self.gatk_program = kwargs.get('GATK', kwargs.get('program'))
 			self.reference = kwargs.get('reference')
 
-		if self.gatk_program is None or self.reference is None:
+		self.native = kwargs.get('native', False)
+
+		if not self.native and (self.gatk_program is None or self.reference is None):
 			message = "Missing a dependancy: "
 			if self.gatk_program is None: message += ', GATK'
 			if self.reference is None: message += ', reference'
@@ -181,24 +196,32 @@ class GATKMergeSampleCallsets:
 		output_filename = self.gatkCombineVariants(callset, output_filename)
 		return output_filename
 			
-	def _modify_merged_vcf(self, filename):
+	def _modify_merged_vcf(self, filename, output_format = 'vcf', backend = 'pyvcf'):
 		""" Adds the VAF to the 'Info' field of the output file.
 			The new file will be saved to the same folder as the original.
 		:param filename: string
 			Path to the merged file.
+		:param output_format: {'vcf', 'vcf.gz'}
+			'vcf.gz' bgzips the output file and indexes it with tabix.
+		:param backend: {'pyvcf', 'raw'}
+			'raw' only rewrites the INFO column of each line and leaves the rest of
+			the line as it is. See vcftools.vaf.annotateVcf().
 		:return: string
 			path to the output file.
 		"""
 		output_folder = os.path.dirname(filename)
-		basename = os.path.splitext(os.path.basename(filename))[0]
-		basename = basename + ".modified.vcf"
+		basename = os.path.splitext(os.path.basename(vcfio.getOutputFilename(filename)))[0]
+		basename = vcfio.getOutputFilename(basename + ".modified.vcf", output_format)
 		output_file = os.path.join(output_folder, basename)
 
-		with open(filename, 'r') as vcf_file:
-			reader = vcf.Reader(vcf_file)
+		if backend == 'raw':
+			return vaf.annotateVcf(filename, output_file)
+
+		with vcfio.openVcf(filename, 'r') as vcf_file:
+			reader = vcf.Reader(vcf_file, compressed = False)
 			reader.infos['VAF'] = reader.formats['FREQ']._replace(type='Float')
 			
-			with open(output_file, 'w') as file2:
+			with vcfio.openVcf(output_file, 'w') as file2:
 				writer = vcf.Writer(file2, reader)
 				for record in reader:
 					VAF = self._getVAF(record)
@@ -258,17 +281,29 @@ class GATKMergeSampleCallsets:
 			VAF = sample_vaf
 		return VAF
 
-	def _modify_variants(self, vcfs):
+	def _modify_variants(self, vcfs, backend = 'pyvcf', output_format = 'vcf'):
 		""" Some caller outputs are inconsistent and need to be modified.
+			Parameters
+			----------
+				vcfs: dict<caller, path>
+				backend: {'pyvcf', 'raw'}; default 'pyvcf'
+					'raw' copies the records verbatim without parsing them with PyVCF.
+					See vcftools.copyVcf().
+				output_format: {'vcf', 'vcf.gz'}; default 'vcf'
+					'vcf.gz' bgzips the output files and indexes them with tabix.
 		"""
 		output_variants = dict()
 		for caller, vcf_filename in vcfs.items():
 			current_output_folder = os.path.dirname(vcf_filename)
-			basename = os.path.splitext(os.path.basename(vcf_filename))[0] + ".modified.vcf"
-			output_file = os.path.join(current_output_folder, basename)
+			basename = os.path.splitext(os.path.basename(vcfio.getOutputFilename(vcf_filename)))[0] + ".modified.vcf"
+			output_file = os.path.join(current_output_folder, vcfio.getOutputFilename(basename, output_format))
+
+			if backend == 'raw':
+				output_variants[caller] = scanner.copyRecords(vcf_filename, output_file, fix_dp4 = 'varscan' in caller)
+				continue
 
-			with open(vcf_filename, 'r') as vcf_file:
-				reader = vcf.Reader(vcf_file)
+			with vcfio.openVcf(vcf_filename, 'r') as vcf_file:
+				reader = vcf.Reader(vcf_file, compressed = False)
 				if 'varscan' in caller:
 					reader = self._modify_varscan_output(reader)
 				output_variants[caller] = self._copy_vcf(reader, output_file)
@@ -276,7 +311,7 @@ class GATKMergeSampleCallsets:
 		return output_variants
 	@staticmethod
 	def _copy_vcf(reader, output_file):
-		with open(output_file, 'w') as file1:
+		with vcfio.openVcf(output_file, 'w') as file1:
 			writer = vcf.Writer(file1, reader)
 			for record in reader:
 				filterOut = '/' in str(record.ALT[0]) or '/' in record.REF
@@ -322,23 +357,41 @@ class GATKMergeSampleCallsets:
 		}
 		return result
 
-	def gatkCombineVariants(self, variants, output_file):
+	def gatkCombineVariants(self, variants, output_file, native = None):
 		""" Uses GATK CombineVariants to merge the calls from each caller into a single file.
 			Parameters
 			----------
 				variants: dict<caller, path>
 					A dictionary linkng each caller to its harmonized output.
 					Format: {NormalID}_vs_{TumorID}.{CallerName}.{TAG}.harmonized.vcf
+				native: bool; default None
+					If True, the files are merged in-process by vcftools.combine, with the
+					same priority order. The files must be sorted. Defaults to the 'native'
+					option the merger was created with.
 			Returns
 			-------
 				Output_file: string
 					Format: {NormalID}_vs_{TumorID}.{CallerName}.{TAG}.merged.vcf
 		"""
 
-		order = "mutect2,varscan,strelka,muse,somaticsniper"  # ordered by VAF confidence
+		if native is None: native = self.native
+		if native:
+			return combine.combineVariants(variants, output_file, priority = self.priority_order.split(','))
+
+		command = self._getCombineVariantsCommand(variants, output_file)
+		systemtools.Terminal(command)
+		return output_file
+
+	def _getCombineVariantsCommand(self, variants, output_file, memory = None):
+		""" Builds the GATK CombineVariants command used by gatkCombineVariants().
+			Parameters
+			----------
+				memory: int; default None
+					If provided, the java heap is limited to this many GB with '-Xmx'.
+		"""
 		variant_command = ['--variant:{} "{}"'.format(k, v) for k, v in variants.items()]
 		variant_command = ' \\\n'.join(variant_command)
-		command = """java -jar "{gatk}" \
+		command = """java {java_options}-jar "{gatk}" \
 			-T CombineVariants \
 			-R "{reference}" \
 			{variants} \
@@ -346,34 +399,93 @@ class GATKMergeSampleCallsets:
 			-genotypeMergeOptions PRIORITIZE \
 			-priority {rod}"""
 		command = command.format(
+				java_options = _getJavaOptions(memory),
 				gatk =      self.gatk_program,
 				reference = self.reference,
 				variants =  variant_command,
-				rod =       order,
+				rod =       self.priority_order,
 				output =    output_file)
+		return command
 
+	def catVariants(self, left, right, native = None):
+		""" Combines the SNV and Indel files. Assumes both are saved in the same folder.
+			Parameters
+			----------
+				left, right: string [PATH]
+				native: bool; default None
+					If True, the sorted files are combined in-process by vcftools.combine.catVariants()
+					instead of GATK CatVariants. Bgzipped inputs produce a bgzipped, indexed output.
+					Defaults to the 'native' option the merger was created with.
+		"""
+		output_file = self._getCatVariantsFilename(left)
+
+		if native is None: native = self.native
+		if native:
+			if left.endswith('.gz'):
+				output_file = vcfio.getOutputFilename(output_file, 'vcf.gz')
+			return combine.catVariants([left, right], output_file)
+
+		command = self._getCatVariantsCommand(left, right, output_file)
 		systemtools.Terminal(command)
+
 		return output_file
 
-	def catVariants(self, left, right):
-		""" Combines the SNV and Indel files. Assumes both are saved in the same folder. """
-		l = os.path.splitext(os.path.splitext(left)[0])[0]
-		output_file = l + '.cat.vcf'
+	@staticmethod
+	def _getCatVariantsFilename(left):
+		l = os.path.splitext(os.path.splitext(vcfio.getOutputFilename(left))[0])[0]
+		return l + '.cat.vcf'
 
-		command = """java -cp {GATK} org.broadinstitute.gatk.tools.CatVariants \
+	def _getCatVariantsCommand(self, left, right, output_file, memory = None):
+		""" Builds the GATK CatVariants command used by catVariants(). """
+		command = """java {java_options}-cp {GATK} org.broadinstitute.gatk.tools.CatVariants \
 			-R {reference}\
 			-V {left} \
 			-V {right} \
 			-out {output}
 		""".format(
+			java_options = _getJavaOptions(memory),
 			GATK = self.gatk_program,
 			reference = self.reference,
 			left = left,
 			right = right,
 			output = output_file)
-		systemtools.Terminal(command)
+		return command
 
-		return output_file
+	def combineVariantsBatch(self, batch, runner = None, memory = None):
+		""" Runs GATK CombineVariants for many callsets at once.
+			Parameters
+			----------
+				batch: list<tuple<dict<caller, path>, string>>
+					The variants and output file of each merge, as passed to gatkCombineVariants().
+				runner: batchtools.BatchRunner; default None
+					Limits the number of concurrent jobs and their memory. Defaults to
+					one job per CPU.
+				memory: int; default None
+					The java heap of each job, in GB.
+			Returns
+			-------
+				results: list<dict<>>
+					The result of each job. See batchtools.BatchRunner.run().
+		"""
+		jobs = list()
+		for variants, output_file in batch:
+			command = self._getCombineVariantsCommand(variants, output_file, memory)
+			jobs.append(batchtools.Job(os.path.basename(output_file), command, memory or 0, output_file))
+		if runner is None: runner = batchtools.BatchRunner()
+		return runner.run(jobs)
+
+	def catVariantsBatch(self, pairs, runner = None, memory = None):
+		""" Runs GATK CatVariants for many (snp, indel) pairs at once. See combineVariantsBatch(). """
+		jobs = list()
+		for left, right in pairs:
+			output_file = self._getCatVariantsFilename(left)
+			command = self._getCatVariantsCommand(left, right, output_file, memory)
+			jobs.append(batchtools.Job(os.path.basename(output_file), command, memory or 0, output_file))
+		if runner is None: runner = batchtools.BatchRunner()
+		return runner.run(jobs)
+
+def _getJavaOptions(memory):
+	return "" if memory is None else "-Xmx{}g ".format(memory)
 
 def classify(folder):
 	""" Retrieves the callset for each caller """
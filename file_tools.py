@@ -3,6 +3,7 @@ import csv
 import vcf
 from pprint import pprint
 import configparser
+from varianttools.vcftools import combine, scanner, tabix, vcfio
 PIPELINE_DIRECTORY = "/home/upmc/Documents/Variant_Discovery_Pipeline"
 OPTIONS_FILENAME = os.path.join(PIPELINE_DIRECTORY, "0_config_files", "pipeline_project_options.txt")
 OPTIONS = configparser.ConfigParser()
@@ -28,16 +29,24 @@ def writeTSV(table, filename, fieldnames = None):
         writer.writeheader()
         writer.writerows(table)
 
-def compareCallers(left, right):
+def compareCallers(left, right, native = False):
     """ Uses GATK CombineVariants to merge and compare the output of two callers.
         Parameters
         ----------
             left: string
             right: string
+            native: bool; default False
+                If True, the files are merged in-process by vcftools.combine instead of GATK.
+                Both files must be sorted.
     """
+    output_file = "left-right-output.vcf"
+    if native:
+        # GATK names unnamed inputs 'variant', 'variant2', ...
+        variants = {'variant': left, 'variant2': right}
+        return combine.combineVariants(variants, output_file, priority = ['variant', 'variant2'], genotype_merge = 'UNIQUIFY')
+
     gatk_program = OPTIONS['Programs']['GATK']
     reference = OPTIONS['Reference Files']['reference genome']
-    output_file = "left-right-output.vcf"
 
     order = "left,right" #ordered by VAF confidence
 
@@ -56,11 +65,29 @@ def compareCallers(left, right):
             rod = order)
     os.system(uniqueify_command)
 
-def countVariants(filename):
-    """ Counts the number of variants detected per Chromosome."""
+def countVariants(filename, backend = 'raw', use_index = True):
+    """ Counts the number of variants detected per Chromosome.
+        Parameters
+        ----------
+            filename: string [PATH]
+            backend: {'raw', 'pyvcf'}; default 'raw'
+                'raw' reads the chromosome directly from each line, while 'pyvcf'
+                parses each record with PyVCF. Both return the same counts.
+            use_index: bool; default True
+                If the file is bgzipped and has an up-to-date tabix or CSI index,
+                the counts are read from the index instead of the file.
+    """
+    index_filename = tabix.findIndex(filename) if use_index else None
+    if index_filename is not None:
+        counts = tabix.readIndex(index_filename).getCounts()
+        if counts is not None:
+            return {chrom: count for chrom, count in counts.items() if count > 0}
+
+    if backend == 'raw':
+        return scanner.countRecords(filename)
     chromosomes = dict()
-    with open(filename, 'r') as file1:
-        reader = vcf.Reader(file1)
+    with vcfio.openVcf(filename, 'r') as file1:
+        reader = vcf.Reader(file1, compressed = False)
 
         for record in reader:
             if record.CHROM not in chromosomes:
@@ -1,6 +1,18 @@
+import argparse
 import csv
+import datetime
 import hashlib
+import io
 import os
+import queue
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from varianttools.vcftools import bgzf
 genome_folder = "/home/upmc/Documents/Variant_Discovery_Pipeline/"
 import sys
 sys.path.append(genome_folder)
@@ -27,11 +39,240 @@ def getAvailableFolders(computer_name = None):
 def getComputerName():
 	filename = "/home/upmc/Documents/computer_name.txt"
 	with open(filename, 'r') as file1:
-		computer_name = file1.read()
+		computer_name = file1.read().strip()
 
 	return computer_name
 
-def generateFileMd5(filename, blocksize=2**20):
+class ChecksumCache:
+	""" An on-disk store of file checksums, saved as an sqlite database.
+		Each checksum is recorded with the device, inode, size and modification
+		time of the file, so a cached value is only used while the file is unchanged.
+		Usage
+		-----
+			cache = ChecksumCache("full_manifest.WD.md5cache.sqlite")
+			md5sum = generateFileMd5(filename, cache = cache)
+	"""
+	def __init__(self, filename):
+		self.filename = filename
+		self._connection = None
+
+	def __getstate__(self):
+		# sqlite connections can't be shared between processes.
+		# Each worker opens its own connection to the same file.
+		return {'filename': self.filename, '_connection': None}
+
+	@property
+	def connection(self):
+		if self._connection is None:
+			self._connection = sqlite3.connect(self.filename, timeout = 60, isolation_level = None)
+			self._connection.execute("""CREATE TABLE IF NOT EXISTS checksums (
+				path TEXT NOT NULL,
+				algorithm TEXT NOT NULL,
+				device INTEGER NOT NULL,
+				inode INTEGER NOT NULL,
+				size INTEGER NOT NULL,
+				mtime_ns INTEGER NOT NULL,
+				digest TEXT NOT NULL,
+				checked REAL NOT NULL,
+				PRIMARY KEY (path, algorithm))""")
+		return self._connection
+
+	@staticmethod
+	def getFileKey(filename):
+		""" Returns the (device, inode, size, mtime_ns) tuple used to detect changes to a file. """
+		stat = os.stat(filename)
+		return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+	def get(self, filename, algorithm = 'md5', key = None):
+		""" Returns the cached checksum of a file, or None if the file is not
+			cached or has changed since it was cached.
+		"""
+		path = os.path.abspath(filename)
+		if key is None:
+			key = self.getFileKey(path)
+		row = self.connection.execute(
+			"SELECT device, inode, size, mtime_ns, digest FROM checksums WHERE path = ? AND algorithm = ?",
+			(path, algorithm)).fetchone()
+		if row is None:
+			return None
+		if tuple(row[:4]) != tuple(key):
+			self.connection.execute("DELETE FROM checksums WHERE path = ? AND algorithm = ?", (path, algorithm))
+			return None
+		return row[4]
+
+	def set(self, filename, digest, algorithm = 'md5', key = None):
+		""" Saves the checksum of a file.
+			Parameters
+			----------
+				key: tuple<int>; default None
+					The output of getFileKey() taken before the file was read. If None,
+					the file is stat'd again.
+		"""
+		path = os.path.abspath(filename)
+		if key is None:
+			key = self.getFileKey(path)
+		self.connection.execute(
+			"INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+			(path, algorithm) + tuple(key) + (digest, time.time()))
+
+	def compact(self, max_age = None):
+		""" Removes entries for files that were deleted or changed, and shrinks the database.
+			Parameters
+			----------
+				max_age: int; default None
+					If provided, entries that were not computed within this many days are also removed.
+			Returns
+			-------
+				removed: int
+					The number of entries removed.
+		"""
+		stale = list()
+		rows = self.connection.execute("SELECT path, algorithm, device, inode, size, mtime_ns, checked FROM checksums").fetchall()
+		oldest = None if max_age is None else time.time() - max_age * 86400
+		for path, algorithm, device, inode, size, mtime_ns, checked in rows:
+			try:
+				key = self.getFileKey(path)
+			except OSError:
+				key = None
+			if key != (device, inode, size, mtime_ns) or (oldest is not None and checked < oldest):
+				stale.append((path, algorithm))
+		self.connection.executemany("DELETE FROM checksums WHERE path = ? AND algorithm = ?", stale)
+		self.connection.execute("VACUUM")
+		return len(stale)
+
+	def close(self):
+		if self._connection is not None:
+			self._connection.close()
+			self._connection = None
+
+def getChecksumCacheFilename(manifest):
+	""" Returns the default location of the checksum cache for a manifest file. """
+	return os.path.splitext(manifest)[0] + ".md5cache.sqlite"
+
+class _ZlibChecksum:
+	""" Wraps zlib.crc32 and zlib.adler32 in the same interface as the hashlib objects. """
+	def __init__(self, name):
+		self.name = name
+		self._function = getattr(zlib, name)
+		self._value = self._function(b'')
+
+	def update(self, data):
+		self._value = self._function(data, self._value)
+
+	def hexdigest(self):
+		return "{0:08x}".format(self._value & 0xffffffff)
+
+def _newChecksum(algorithm):
+	if algorithm in ('crc32', 'adler32'):
+		return _ZlibChecksum(algorithm)
+	return hashlib.new(algorithm)
+
+def _iterFileBlocks(filename, blocksize, threaded = False, buffers = 3):
+	""" Reads a file into reusable preallocated buffers.
+		Parameters
+		----------
+			filename: string [PATH]
+			blocksize: int
+				The size of each buffer.
+			threaded: bool; default False
+				If 'True', the file is read by a background thread so the
+				next blocks are read while the current block is processed.
+			buffers: int; default 3
+				The number of buffers to cycle through when 'threaded' is set.
+		Yields
+		------
+			block: memoryview
+				A view of the next block of the file. The view is only valid
+				until the next block is requested.
+	"""
+	if not threaded:
+		buffer = bytearray(blocksize)
+		view = memoryview(buffer)
+		with open(filename, 'rb', buffering = 0) as f:
+			while True:
+				length = f.readinto(buffer)
+				if not length: break
+				yield view[:length]
+		return
+
+	free = queue.Queue()
+	filled = queue.Queue()
+	for _ in range(buffers):
+		free.put(bytearray(blocksize))
+	stop = threading.Event()
+
+	def reader():
+		try:
+			with open(filename, 'rb', buffering = 0) as f:
+				while not stop.is_set():
+					buffer = free.get()
+					if buffer is None: break
+					length = f.readinto(buffer)
+					filled.put((buffer, length))
+					if not length: break
+		except Exception as exception:
+			filled.put((exception, None))
+
+	thread = threading.Thread(target = reader, daemon = True)
+	thread.start()
+	try:
+		while True:
+			buffer, length = filled.get()
+			if isinstance(buffer, Exception):
+				raise buffer
+			if not length: break
+			yield memoryview(buffer)[:length]
+			free.put(buffer)
+	finally:
+		stop.set()
+		free.put(None)
+		thread.join()
+
+def generateFileDigests(filename, algorithms = ('md5',), blocksize = 2**20, cache = None, rehash = False, threaded = False):
+	""" Generates several checksums of a file while only reading it once.
+		Parameters
+		----------
+			filename: string [PATH]
+				Path to a file.
+			algorithms: list<string>; default ('md5',)
+				The checksums to generate. Any algorithm supported by hashlib
+				(ex. 'md5', 'sha256') as well as 'crc32' and 'adler32'.
+			blocksize: int
+				The size of the read buffer. Three buffers are used when 'threaded' is set.
+			cache: ChecksumCache; default None
+				If provided, cached checksums are used for unchanged files, and
+				generated checksums are saved to the cache.
+			rehash: bool; default False
+				If 'True', cached values are ignored and the file is read again.
+			threaded: bool; default False
+				If 'True', the file is read in a background thread while the
+				checksums are calculated.
+		Returns
+		-------
+			digests: dict<string, string>
+				The hex digest for each algorithm.
+	"""
+	digests = dict()
+	if cache is not None:
+		key = cache.getFileKey(filename)
+		if not rehash:
+			for algorithm in algorithms:
+				digest = cache.get(filename, algorithm, key = key)
+				if digest is not None:
+					digests[algorithm] = digest
+
+	checksums = {algorithm: _newChecksum(algorithm) for algorithm in algorithms if algorithm not in digests}
+	if checksums:
+		for block in _iterFileBlocks(filename, blocksize, threaded):
+			for checksum in checksums.values():
+				checksum.update(block)
+		for algorithm, checksum in checksums.items():
+			digests[algorithm] = checksum.hexdigest()
+			if cache is not None:
+				cache.set(filename, digests[algorithm], algorithm, key = key)
+	return digests
+
+def generateFileMd5(filename, blocksize=2**20, cache = None, rehash = False, threaded = False):
 	""" Generates the md5sum of a file.
 		Parameters
 		----------
@@ -39,20 +280,54 @@ def generateFileMd5(filename, blocksize=2**20):
 				Path to a file.
 			blocksize: int
 				The maximum amount of memory to use when generating the md5sum.
+			cache: ChecksumCache; default None
+				If provided, the md5sum is read from the cache when the file is
+				unchanged, and saved to the cache after it is generated.
+			rehash: bool; default False
+				If 'True', the cached value is ignored and the file is read again.
+			threaded: bool; default False
+				Passed to generateFileDigests().
 		Returns
 		-------
 			md5sum: string
 				The md5sum of the passed file.
 	"""
+	digests = generateFileDigests(filename, ['md5'], blocksize, cache = cache, rehash = rehash, threaded = threaded)
+	return digests['md5']
+
+def generateQuickFingerprint(filename, samples = 8, blocksize = 2**16):
+	""" Generates a fingerprint of a file from its size and a fixed set of sampled blocks.
+		The first block, the last block and `samples` evenly spaced blocks are hashed,
+		so truncated files and most corrupted files get a different fingerprint while
+		only a small fraction of the file is read.
+		Parameters
+		----------
+			filename: string [PATH]
+			samples: int; default 8
+				The number of interior blocks to sample.
+			blocksize: int; default 2**16
+				The size of each sampled block.
+		Returns
+		-------
+			fingerprint: string
+				Formatted as '{size}:{samples}:{blocksize}:{md5}'.
+	"""
+	size = os.path.getsize(filename)
 	m = hashlib.md5()
-	with open( filename , "rb" ) as f:
-		while True:
-			buf = f.read(blocksize)
-			if not buf: break
-			m.update( buf )
-	return m.hexdigest()
+	with open(filename, 'rb') as f:
+		if size <= (samples + 2) * blocksize:
+			offsets = [0]
+			blocksize = size
+		else:
+			last = size - blocksize
+			offsets = [0] + [last * i // (samples + 1) for i in range(1, samples + 1)] + [last]
+		for offset in offsets:
+			f.seek(offset)
+			m.update(f.read(blocksize))
+	return "{0}:{1}:{2}:{3}".format(size, samples, blocksize, m.hexdigest())
 
-def verifyFileStatus(filename, expected_md5sum = None):
+def verifyFileStatus(filename, expected_md5sum = None, cache = None, rehash = False, expected_size = None,
+		quick = False, expected_fingerprint = None):
 	""" Verifies a single file.
 		Parameters
 		----------
@@ -60,6 +335,18 @@ def verifyFileStatus(filename, expected_md5sum = None):
 				path to a file to test. The file may not exist.
 			expected_md5sum: string; default None
 				The expected md5sum to test against. If None, the md5sum will not be generated.
+			cache: ChecksumCache; default None
+				Passed to generateFileMd5().
+			rehash: bool; default False
+				Passed to generateFileMd5().
+			expected_size: int; default None
+				The expected size of the file, in bytes. Files with a different size
+				fail without generating the md5sum.
+			quick: bool; default False
+				If 'True', the quick fingerprint of the file is also generated.
+			expected_fingerprint: string; default None
+				The fingerprint of the file from a previous run, when that run confirmed
+				the md5sum. If the fingerprint is unchanged, the md5sum isn't generated again.
 		Returns
 		-------
 			response: dict<>
@@ -68,10 +355,31 @@ def verifyFileStatus(filename, expected_md5sum = None):
 				* 'file exists'
 				* 'file md5sum':
 				* 'expected md5sum'
+				* 'size status'
+				* 'fingerprint': Only if 'quick' is set.
+				* 'fingerprint status': Only if 'quick' is set. Whether the md5sum was
+					confirmed by an unchanged fingerprint.
 	"""
 	file_status = os.path.isfile(filename)
-	if file_status and expected_md5sum is not None:
-		file_md5sum = generateFileMd5(filename)
+	if file_status and expected_size is not None:
+		size_status = os.path.getsize(filename) == int(expected_size)
+	else:
+		size_status = None
+
+	if quick and file_status and size_status is not False:
+		fingerprint = generateQuickFingerprint(filename)
+	else:
+		fingerprint = None
+	fingerprint_status = fingerprint is not None and fingerprint == expected_fingerprint
+
+	if file_status and size_status is False:
+		md5sum_status = False if expected_md5sum is not None else None
+		status = False
+	elif fingerprint_status and expected_md5sum is not None:
+		md5sum_status = True
+		status = True
+	elif file_status and expected_md5sum is not None:
+		file_md5sum = generateFileMd5(filename, cache = cache, rehash = rehash)
 		md5sum_status = file_md5sum == expected_md5sum
 		status = file_status and md5sum_status
 	else: 
@@ -82,22 +390,352 @@ def verifyFileStatus(filename, expected_md5sum = None):
 		'filename': filename,
 		'status': status,
 		'file status': file_status,
-		'md5 status': md5sum_status
+		'md5 status': md5sum_status,
+		'size status': size_status
 	}
+	if quick:
+		response['fingerprint'] = fingerprint
+		response['fingerprint status'] = fingerprint_status
 	return response
 
+def _getManifestHeaders(row):
+	basic_headers = ["id", "filename", "md5", "size", "state"]
+	other_headers = sorted(set(row.keys()) - set(basic_headers))
+	return basic_headers + other_headers
+
 def writeManifestFile(rows, filename):
 	if len(rows) == 0: return None
-	basic_headers = ["id", "filename", "md5", "size", "state"]
-	other_headers = sorted(set(rows[0].keys()) - set(basic_headers))
-	headers = basic_headers + other_headers
+	headers = _getManifestHeaders(rows[0])
 
 	with open(filename, 'w', newline = "") as file2:
 		writer = csv.DictWriter(file2, delimiter = '\t', fieldnames = headers)
 		writer.writeheader()
 		writer.writerows(rows)
 
-def verifyFromManifest(input_manifest, output_manifest, check_integrity = True):
+FileLocation = namedtuple('FileLocation', ['path', 'size', 'mtime', 'device'])
+
+def buildLocationIndex(folders):
+	""" Indexes the files saved in each folder, using a single directory scan per folder.
+		Files are expected to be saved as {folder}/{id}/{filename}.
+		Parameters
+		----------
+			folders: list<string>
+				The folders to index, in order of preference.
+		Returns
+		-------
+			index: dict<tuple<string,string>, list<FileLocation>>
+				Maps (id, filename) to the (path, size, mtime, device) of each copy
+				of the file, in the same order as `folders`.
+	"""
+	index = dict()
+	for folder in folders:
+		try:
+			id_entries = list(os.scandir(folder))
+		except OSError:
+			continue
+		for id_entry in id_entries:
+			if not id_entry.is_dir(): continue
+			try:
+				file_entries = list(os.scandir(id_entry.path))
+			except OSError:
+				continue
+			for file_entry in file_entries:
+				if not file_entry.is_file(): continue
+				stat = file_entry.stat()
+				location = FileLocation(file_entry.path, stat.st_size, stat.st_mtime, stat.st_dev)
+				index.setdefault((id_entry.name, file_entry.name), list()).append(location)
+	return index
+
+def _getPreviousFingerprint(row, deep_interval, md5sum):
+	""" Returns the fingerprint saved by a previous quick verification, if the md5sum
+		was confirmed at that time against the same expected md5sum and a deep pass
+		isn't due yet.
+	"""
+	if row is None:
+		return None
+	if row.get('md5Status') != 'True' or not row.get('quickFingerprint') or not row.get('md5Date'):
+		return None
+	# A changed manifest md5sum has to be checked against the file again.
+	if row.get('md5') != md5sum:
+		return None
+	if deep_interval is not None:
+		md5_date = datetime.datetime.strptime(row['md5Date'], "%Y-%m-%d").date()
+		if (datetime.date.today() - md5_date).days >= deep_interval:
+			return None
+	return row['quickFingerprint']
+
+def _hasExpectedSize(location, expected_size):
+	""" Whether a copy of a file can be verified. The index already has the size, so copies
+		with the wrong size are rejected without reading them.
+	"""
+	return expected_size is None or location.size == int(expected_size)
+
+def _verifyRow(row, locations, check_integrity, previous_row = None, quick = False, deep_interval = None, **kwargs):
+	""" Verifies the file described by a single manifest row.
+		Parameters
+		----------
+			row: dict<>
+				A row from the input manifest.
+			locations: list<FileLocation>
+				The copies of the file found by buildLocationIndex(), in order of preference.
+			check_integrity: bool
+				Whether to compare the md5sum of the file against the manifest.
+			previous_row: dict<>; default None
+				The row for this file in the output of a previous quick verification.
+			quick: bool; default False
+				If 'True', the md5sum is only generated when the file's quick fingerprint
+				differs from the one saved in `previous_row`.
+			deep_interval: int; default None
+				Used with 'quick'. The md5sum is also generated if it was last confirmed
+				at least this many days ago.
+		Keyword Arguments
+		-----------------
+			Passed to verifyFileStatus().
+		Returns
+		-------
+			response, abs_filename: dict<>, string
+				The response from verifyFileStatus() and the location of the file.
+	"""
+	if check_integrity:
+		md5sum = row['md5']
+	else:
+		md5sum = None
+	expected_size = row.get('size') or None
+	quick = quick and check_integrity
+	if quick:
+		kwargs['quick'] = True
+		kwargs['expected_fingerprint'] = _getPreviousFingerprint(previous_row, deep_interval, md5sum)
+
+	response = {
+		'filename': "",
+		'status': False,
+		'file status': False,
+		'md5 status': None,
+		'size status': None
+	}
+	for location in locations:
+		if not _hasExpectedSize(location, expected_size):
+			response = {
+				'filename': location.path,
+				'status': False,
+				'file status': True,
+				'md5 status': False if md5sum is not None else None,
+				'size status': False
+			}
+			continue
+		response = verifyFileStatus(location.path, md5sum, expected_size = expected_size, **kwargs)
+		if response['status']:
+			abs_filename = location.path
+			break
+	else:
+		abs_filename = ""
+
+	if quick:
+		response.setdefault('fingerprint', None)
+		if response.get('fingerprint status'):
+			response['md5 date'] = previous_row['md5Date']
+		elif response['md5 status']:
+			response['md5 date'] = datetime.date.today().strftime("%Y-%m-%d")
+		else:
+			response['md5 date'] = ""
+	return response, abs_filename
+
+def _buildManifestLine(row, response, abs_filename, computer_name):
+	if not response['status']:
+		computer_name = ""
+	new_line = {
+		'id': row['id'],
+		'filename': row['filename'],
+		'md5': row['md5'],
+		'size': row['size'],
+		'state': row['state'],
+		'barcode': row.get('barcode'),
+		'category': row.get('category'),
+		'patient': row.get('patient'),
+		'tissueType': row.get('tissue type', row.get('tissueType')),
+		'status': response['status'],
+		'md5Status': response['md5 status'],
+		'fileStatus': response['file status'],
+		'fileLocation': abs_filename,
+		'computer': computer_name,
+		'verified': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+	}
+	if 'fingerprint' in response:
+		new_line['quickFingerprint'] = response['fingerprint']
+		new_line['md5Date'] = response['md5 date']
+	return new_line
+
+def _groupRowsByDevice(rows, indices, row_locations):
+	""" Groups the manifest rows by the device _verifyRow() will read their file from:
+		the first copy with the expected size. Rows without such a copy are grouped
+		under None, since no file is read for them.
+		Returns
+		-------
+			groups: dict<int, deque<int>>
+				The row indices read from each device.
+	"""
+	groups = dict()
+	for index in indices:
+		expected_size = rows[index].get('size') or None
+		devices = [location.device for location in row_locations[index] if _hasExpectedSize(location, expected_size)]
+		device = devices[0] if devices else None
+		groups.setdefault(device, deque()).append(index)
+	return groups
+
+def _verifyRowsSerial(rows, indices, row_locations, previous_rows, check_integrity, **kwargs):
+	""" Verifies the manifest rows one at a time.
+		Yields
+		------
+			index, result: int, tuple<dict, string>
+				The row index and the output of _verifyRow().
+	"""
+	for completed, index in enumerate(indices):
+		print("{0} of {1}: {2}".format(completed+1, len(indices), rows[index]['id']))
+		yield index, _verifyRow(rows[index], row_locations[index], check_integrity, previous_rows[index], **kwargs)
+
+def _verifyRowsParallel(rows, indices, row_locations, previous_rows, check_integrity, workers_per_device, **kwargs):
+	""" Verifies the manifest rows in a process pool, running at most
+		`workers_per_device` md5 jobs against each physical device at a time.
+		Yields
+		------
+			index, result: int, tuple<dict, string>
+				The row index and the output of _verifyRow(), in the order the rows finish.
+	"""
+	groups = _groupRowsByDevice(rows, indices, row_locations)
+	pending = dict()
+	with ProcessPoolExecutor(max_workers = max(1, len(groups) * workers_per_device)) as executor:
+		def submitNext(device):
+			device_rows = groups[device]
+			if device_rows:
+				index = device_rows.popleft()
+				future = executor.submit(_verifyRow, rows[index], row_locations[index], check_integrity,
+					previous_rows[index], **kwargs)
+				pending[future] = (device, index)
+
+		for device in groups:
+			for _ in range(workers_per_device):
+				submitNext(device)
+
+		completed = 0
+		while pending:
+			done, _ = wait(pending, return_when = FIRST_COMPLETED)
+			for future in done:
+				device, index = pending.pop(future)
+				completed += 1
+				print("{0} of {1}: {2}".format(completed, len(indices), rows[index]['id']))
+				yield index, future.result()
+				submitNext(device)
+
+class ManifestJournal:
+	""" Appends verified manifest rows to a journal file as they finish, so an
+		interrupted verification can be resumed.
+		The journal is written in the same format as writeManifestFile() and is
+		converted into the final manifest by finalize().
+	"""
+	def __init__(self, filename, flush_every = 10):
+		self.filename = filename
+		self.flush_every = flush_every
+		self.completed = set()
+		self.headers = None
+		self._file = None
+		self._writer = None
+		self._unflushed = 0
+		if os.path.exists(filename):
+			self._load()
+
+	@staticmethod
+	def _getKey(row):
+		return row['id'], row['filename']
+
+	def _load(self):
+		""" Reads the rows already saved to the journal and drops any partially-written line. """
+		with open(self.filename, 'rb') as journal_file:
+			contents = journal_file.read()
+		complete_length = contents.rfind(b'\n') + 1
+		if complete_length < len(contents):
+			with open(self.filename, 'r+b') as journal_file:
+				journal_file.truncate(complete_length)
+		lines = contents[:complete_length].decode().splitlines()
+		if not lines: return
+		reader = csv.DictReader(lines, delimiter = '\t')
+		self.headers = reader.fieldnames
+		for row in reader:
+			self.completed.add(self._getKey(row))
+
+	def __contains__(self, row):
+		return self._getKey(row) in self.completed
+
+	def write(self, line):
+		if self._writer is None:
+			if self.headers is None:
+				self.headers = _getManifestHeaders(line)
+				self._file = open(self.filename, 'w', newline = "")
+				self._writer = csv.DictWriter(self._file, delimiter = '\t', fieldnames = self.headers)
+				self._writer.writeheader()
+			else:
+				self._file = open(self.filename, 'a', newline = "")
+				self._writer = csv.DictWriter(self._file, delimiter = '\t', fieldnames = self.headers)
+		self._writer.writerow(line)
+		self.completed.add(self._getKey(line))
+		self._unflushed += 1
+		if self._unflushed >= self.flush_every:
+			self.flush()
+
+	def flush(self):
+		if self._file is not None:
+			self._file.flush()
+			os.fsync(self._file.fileno())
+		self._unflushed = 0
+
+	def close(self):
+		if self._file is not None:
+			self.flush()
+			self._file.close()
+			self._file = None
+			self._writer = None
+
+	def finalize(self, output_manifest, order, sort_by_barcode):
+		""" Writes the journal to the output manifest and deletes the journal.
+			Only the sort keys and line offsets are held in memory.
+			Parameters
+			----------
+				output_manifest: string [PATH]
+				order: dict<tuple<string,string>, int>
+					The position of each (id, filename) in the input manifest.
+				sort_by_barcode: bool
+					Whether to sort the rows by barcode. Rows with the same barcode
+					stay in manifest order.
+		"""
+		self.close()
+		if self.headers is None: return None
+		barcode_column = self.headers.index('barcode')
+		id_column = self.headers.index('id')
+		filename_column = self.headers.index('filename')
+		keys = list()
+		with open(self.filename, 'rb') as journal_file:
+			header = journal_file.readline()
+			offset = journal_file.tell()
+			for line in iter(journal_file.readline, b''):
+				fields = next(csv.reader([line.decode()], delimiter = '\t'))
+				position = order.get((fields[id_column], fields[filename_column]), len(order))
+				if sort_by_barcode:
+					key = (fields[barcode_column], position)
+				else:
+					key = (position,)
+				keys.append((key, offset, len(line)))
+				offset += len(line)
+			keys.sort()
+
+			with open(output_manifest, 'wb') as output_file:
+				output_file.write(header)
+				for _, offset, length in keys:
+					journal_file.seek(offset)
+					output_file.write(journal_file.read(length))
+		os.remove(self.filename)
+
+def verifyFromManifest(input_manifest, output_manifest, check_integrity = True, parallel = False, workers_per_device = 1,
+		cache = None, rehash = False, stream = False, flush_every = 10, quick = False, deep_interval = None,
+		previous_manifest = None, computer_name = None):
 	""" Verifies files listed in a amanifest file.
 		Parameters
 		----------
@@ -105,60 +743,502 @@ def verifyFromManifest(input_manifest, output_manifest, check_integrity = True):
 				The manifest file to read from.
 			output_manifest: string [PATH]
 				The manifest file to write the output to.
+			check_integrity: bool; default True
+				Whether to compare each file against the md5sum listed in the manifest.
+			parallel: bool; default False
+				If 'True', files are verified in a process pool with the rows grouped by
+				the device each file is stored on. The output manifest is identical to
+				the serial output.
+			workers_per_device: int; default 1
+				The number of files to verify concurrently on each device when 'parallel' is set.
+				Values above 1 are only useful for SSDs and network mounts.
+			cache: string [PATH], bool; default None
+				The checksum cache to use. If 'True', the cache is saved next to the output manifest.
+				If None, every file is read.
+			rehash: bool; default False
+				If 'True', cached md5sums are ignored and replaced.
+			stream: bool; default False
+				If 'True', each row is appended to '{output_manifest}.journal' as soon as it
+				is verified. If the journal already exists, the rows saved to it are skipped,
+				so an interrupted run can be resumed by calling this function again. The journal
+				is sorted into the output manifest once every row is verified.
+			flush_every: int; default 10
+				The number of rows to write to the journal between flushes to disk.
+			quick: bool; default False
+				If 'True', a quick fingerprint of each file is saved to the 'quickFingerprint'
+				column along with the date the md5sum was last confirmed ('md5Date'). When the
+				input manifest is the output of a previous quick run, the md5sum is only
+				generated for files whose fingerprint changed since the previous quick run.
+			deep_interval: int; default None
+				Used with 'quick'. The md5sum is always generated for files that were last
+				fully verified at least this many days ago. Use 0 for a full deep pass.
+			previous_manifest: string [PATH]; default None
+				Used with 'quick'. The output of the previous quick run. Defaults to
+				`output_manifest`, if it exists.
+			computer_name: string; default None
+				If provided, only the folders available on this computer are searched.
+				Used to verify one computer's share of a partitioned manifest
+				(see partitionManifest()).
 	"""
-	_current_computer = getComputerName()
+	if computer_name is None:
+		_current_computer = getComputerName()
+	else:
+		_current_computer = computer_name
 	with open(input_manifest, 'r') as inputmanifest:
 		rows = list(csv.DictReader(inputmanifest, delimiter = '\t'))
 
-	available_folders = getAvailableFolders()
-	lines = list()
+	if stream:
+		journal = ManifestJournal(output_manifest + '.journal', flush_every)
+		indices = [index for index, row in enumerate(rows) if row not in journal]
+		if len(indices) < len(rows):
+			print("Resuming: {0} of {1} rows are already verified.".format(len(rows) - len(indices), len(rows)))
+	else:
+		journal = None
+		indices = list(range(len(rows)))
 
-	for index, row in enumerate(rows):
-		print("{0} of {1}: {2}".format(index+1, len(rows), row['id']))
-		for folder in available_folders:
-			abs_filename = os.path.join(folder, row['id'], row['filename'])
-			if check_integrity:
-				md5sum = row['md5']
+	available_folders = getAvailableFolders(computer_name)
+	print("Indexing {0} folders...".format(len(available_folders)))
+	location_index = buildLocationIndex(available_folders)
+	row_locations = [location_index.get((row['id'], row['filename']), []) for row in rows]
+
+	if quick and previous_manifest is None and os.path.isfile(output_manifest):
+		previous_manifest = output_manifest
+	if quick and previous_manifest is not None:
+		with open(previous_manifest, 'r') as previousmanifest:
+			previous = {(row['id'], row['filename']): row for row in csv.DictReader(previousmanifest, delimiter = '\t')}
+		previous_rows = [previous.get((row['id'], row['filename'])) for row in rows]
+	else:
+		previous_rows = [None] * len(rows)
+
+	if cache is True:
+		cache = getChecksumCacheFilename(output_manifest)
+	if cache is not None:
+		cache = ChecksumCache(cache)
+
+	if parallel:
+		results = _verifyRowsParallel(rows, indices, row_locations, previous_rows, check_integrity, workers_per_device,
+			cache = cache, rehash = rehash, quick = quick, deep_interval = deep_interval)
+	else:
+		results = _verifyRowsSerial(rows, indices, row_locations, previous_rows, check_integrity,
+			cache = cache, rehash = rehash, quick = quick, deep_interval = deep_interval)
+
+	lines = list()
+	try:
+		for index, (response, abs_filename) in results:
+			new_line = _buildManifestLine(rows[index], response, abs_filename, _current_computer)
+			if journal is not None:
+				journal.write(new_line)
 			else:
-				md5sum = None
-			response = verifyFileStatus(abs_filename, md5sum)
-			if response['status']: break
-		else:
-			abs_filename = ""
+				lines.append((index, new_line))
+	finally:
+		if journal is not None:
+			journal.close()
+		if cache is not None:
+			cache.close()
 
-		if response['status']:
-			computer_name = _current_computer
+	sort_by_barcode = len(rows) > 0 and rows[0].get('barcode') is not None
+	if journal is not None:
+		order = {(row['id'], row['filename']): index for index, row in enumerate(rows)}
+		journal.finalize(output_manifest, order, sort_by_barcode)
+	else:
+		lines = [line for index, line in sorted(lines, key = lambda s: s[0])]
+		if sort_by_barcode:
+			lines = sorted(lines, key = lambda s: s['barcode'])
+
+		writeManifestFile(lines, output_manifest)
+
+def writeLocationFile(filename, computer_name = None):
+	""" Saves the files that are available on a computer, so the manifest can be
+		partitioned between computers with partitionManifest().
+		Parameters
+		----------
+			filename: string [PATH]
+				The file to save the locations to.
+			computer_name: string; default None
+				Defaults to the current computer.
+	"""
+	if computer_name is None:
+		computer_name = getComputerName()
+	location_index = buildLocationIndex(getAvailableFolders(computer_name))
+	rows = list()
+	for (file_id, file_name), locations in sorted(location_index.items()):
+		for location in locations:
+			rows.append({
+				'id': file_id,
+				'filename': file_name,
+				'path': location.path,
+				'size': location.size,
+				'computer': computer_name
+			})
+	with open(filename, 'w', newline = "") as file1:
+		writer = csv.DictWriter(file1, delimiter = '\t', fieldnames = ['id', 'filename', 'size', 'path', 'computer'])
+		writer.writeheader()
+		writer.writerows(rows)
+	return filename
+
+def partitionManifest(input_manifest, location_files, output_folder = None):
+	""" Splits a manifest between computers, so each computer only verifies the files
+		it can see and each file is only verified once.
+		Files available on several computers are assigned to whichever computer
+		has the fewest bytes assigned so far, so the computers finish at about the same time.
+		Parameters
+		----------
+			input_manifest: string [PATH]
+			location_files: list<string>
+				The output of writeLocationFile() for each computer.
+			output_folder: string [PATH]; default None
+				Defaults to the folder of the input manifest.
+		Returns
+		-------
+			partitions: dict<string, string>
+				The manifest for each computer, saved as '{basename}.share.{computer}.tsv'.
+				Files that are not available on any computer are saved under 'unassigned'.
+	"""
+	with open(input_manifest, 'r') as inputmanifest:
+		reader = csv.DictReader(inputmanifest, delimiter = '\t')
+		fieldnames = reader.fieldnames
+		rows = list(reader)
+
+	available = dict()
+	computers = list()
+	for location_file in location_files:
+		with open(location_file, 'r') as file1:
+			for location in csv.DictReader(file1, delimiter = '\t'):
+				if location['computer'] not in computers:
+					computers.append(location['computer'])
+				key = (location['id'], location['filename'])
+				available.setdefault(key, list()).append(location)
+
+	assigned_bytes = {computer: 0 for computer in computers}
+	shares = {computer: list() for computer in computers + ['unassigned']}
+	for row in rows:
+		locations = available.get((row['id'], row['filename']), [])
+		# Copies with the wrong size would fail anyway, so prefer computers with a complete copy.
+		complete = [i for i in locations if not row.get('size') or i['size'] == row['size']]
+		candidates = [i['computer'] for i in (complete or locations)]
+		if candidates:
+			computer = min(candidates, key = lambda s: (assigned_bytes[s], computers.index(s)))
+			assigned_bytes[computer] += int(row.get('size') or 0)
 		else:
-			computer_name = ""
-		new_line = {
-			'id': row['id'],
-			'filename': row['filename'],
-			'md5': row['md5'],
-			'size': row['size'],
-			'state': row['state'],
-			'barcode': row.get('barcode'),
-			'category': row.get('category'),
-			'patient': row.get('patient'),
-			'tissueType': row.get('tissue type'),
-			'status': response['status'],
-			'md5Status': response['md5 status'],
-			'fileStatus': response['file status'],
-			'fileLocation': abs_filename,
-			'computer': computer_name
-		}
-		lines.append(new_line)
-	if lines[0]['barcode'] is not None:
-		lines = sorted(lines, key = lambda s: s['barcode'])
+			computer = 'unassigned'
+		shares[computer].append(row)
 
+	if output_folder is None:
+		output_folder = os.path.dirname(os.path.abspath(input_manifest))
+	basename = os.path.splitext(os.path.basename(input_manifest))[0]
+	partitions = dict()
+	for computer, share in shares.items():
+		filename = os.path.join(output_folder, "{0}.share.{1}.tsv".format(basename, computer))
+		with open(filename, 'w', newline = "") as file1:
+			writer = csv.DictWriter(file1, delimiter = '\t', fieldnames = fieldnames)
+			writer.writeheader()
+			writer.writerows(share)
+		partitions[computer] = filename
+	return partitions
+
+def _getVerificationTime(row):
+	""" Returns when a manifest row was verified, as a sortable string. Manifests written
+		before the 'verified' column was added fall back to the md5 date, then to "".
+	"""
+	return row.get('verified') or row.get('md5Date') or ""
+
+def mergeManifests(manifests, output_manifest):
+	""" Combines the output of verifyFromManifest() from several computers into a single manifest.
+		When a file appears in more than one manifest, the most recently verified row in which
+		the file passed is used. If the file didn't pass anywhere, the most recently verified
+		row is used. Rows are ranked by their own 'verified' time rather than the time the
+		manifest was written, so copying or touching a manifest doesn't change the result.
+		Parameters
+		----------
+			manifests: list<string>
+				The output manifests to merge.
+			output_manifest: string [PATH]
+	"""
+	merged = dict()
+	order = list()
+	headers = set()
+	for manifest in manifests:
+		with open(manifest, 'r') as file1:
+			for row in csv.DictReader(file1, delimiter = '\t'):
+				headers.update(row.keys())
+				key = (row['id'], row['filename'])
+				rank = (row['status'] == 'True', _getVerificationTime(row))
+				if key not in merged:
+					order.append(key)
+				elif merged[key][0] >= rank:
+					continue
+				merged[key] = (rank, row)
+
+	lines = list()
+	for key in order:
+		row = merged[key][1]
+		lines.append({header: row.get(header, "") for header in headers})
+	if lines and any(line.get('barcode') for line in lines):
+		lines = sorted(lines, key = lambda s: s['barcode'])
 	writeManifestFile(lines, output_manifest)
+	return output_manifest
+
+class _BgzfStream:
+	""" Reads the decompressed contents of a BGZF file, one block at a time. """
+	def __init__(self, file1):
+		self.file = file1
+		self.buffer = b''
+		self.position = 0
+
+	def read(self, size):
+		while len(self.buffer) - self.position < size:
+			block = bgzf.readBlock(self.file)
+			if not block:
+				raise ValueError("Unexpected end of file")
+			self.buffer = self.buffer[self.position:] + bgzf.decompressBlock(block, check_crc = True)
+			self.position = 0
+		data = self.buffer[self.position:self.position + size]
+		self.position += size
+		return data
+
+	def unpack(self, fmt):
+		return struct.unpack(fmt, self.read(struct.calcsize(fmt)))
+
+def checkBgzfEof(filename):
+	""" Checks whether a BGZF file ends with the BGZF EOF marker. Truncated transfers won't. """
+	with open(filename, 'rb') as file1:
+		file1.seek(0, os.SEEK_END)
+		if file1.tell() < len(bgzf.BGZF_EOF):
+			return False
+		file1.seek(-len(bgzf.BGZF_EOF), os.SEEK_END)
+		return file1.read() == bgzf.BGZF_EOF
+
+def readBamHeader(filename):
+	""" Reads the header of a BAM file without reading the alignments.
+		Returns
+		-------
+			header: dict<>
+				* 'text': The SAM header text.
+				* 'references': list<tuple<string, int>>
+					The name and length of each reference sequence.
+	"""
+	with open(filename, 'rb') as file1:
+		stream = _BgzfStream(file1)
+		if stream.read(4) != b'BAM\x01':
+			raise ValueError("Missing the BAM magic string")
+		l_text = stream.unpack('<i')[0]
+		text = stream.read(l_text).rstrip(b'\x00').decode(errors = 'replace')
+		n_ref = stream.unpack('<i')[0]
+		references = list()
+		for _ in range(n_ref):
+			l_name = stream.unpack('<i')[0]
+			name = stream.read(l_name).rstrip(b'\x00').decode(errors = 'replace')
+			l_ref = stream.unpack('<i')[0]
+			references.append((name, l_ref))
+	header = {
+		'text': text,
+		'references': references
+	}
+	return header
+
+def _checkReferences(header):
+	""" Checks that the @SQ lines of the header text agree with the binary reference list. """
+	sequences = list()
+	for line in header['text'].splitlines():
+		if not line.startswith('@SQ'): continue
+		fields = dict(field.split(':', 1) for field in line.split('\t')[1:] if ':' in field)
+		sequences.append((fields.get('SN'), int(fields.get('LN', -1))))
+	return not sequences or sequences == header['references']
+
+def _parseBins(data, offset, n_ref, has_loffset):
+	""" Walks the per-reference binning index shared by the BAI and CSI formats.
+		Returns the offset of the end of the index.
+	"""
+	for _ in range(n_ref):
+		n_bin = struct.unpack_from('<i', data, offset)[0]
+		offset += 4
+		for _ in range(n_bin):
+			offset += 12 if has_loffset else 4
+			n_chunk = struct.unpack_from('<i', data, offset)[0]
+			offset += 4 + 16 * n_chunk
+		if not has_loffset:
+			n_intv = struct.unpack_from('<i', data, offset)[0]
+			offset += 4 + 8 * n_intv
+	return offset
+
+def readBamIndex(filename):
+	""" Parses a .bai or .csi index to confirm it is complete.
+		Returns
+		-------
+			n_ref: int
+				The number of reference sequences in the index.
+	"""
+	with open(filename, 'rb') as file1:
+		data = file1.read()
+	try:
+		if data[:4] == b'BAI\x01':
+			n_ref = struct.unpack_from('<i', data, 4)[0]
+			offset = _parseBins(data, 8, n_ref, False)
+		else:
+			# CSI indexes are BGZF-compressed.
+			compressed = io.BytesIO(data)
+			blocks = list()
+			while True:
+				block = bgzf.readBlock(compressed)
+				if not block: break
+				blocks.append(bgzf.decompressBlock(block, check_crc = True))
+			data = b''.join(blocks)
+			if data[:4] != b'CSI\x01':
+				raise ValueError("Unrecognized index format")
+			l_aux = struct.unpack_from('<i', data, 12)[0]
+			n_ref = struct.unpack_from('<i', data, 16 + l_aux)[0]
+			offset = _parseBins(data, 20 + l_aux, n_ref, True)
+	except struct.error:
+		raise ValueError("Truncated index")
+	# The index may end with the number of unplaced, unmapped reads.
+	if len(data) - offset not in (0, 8):
+		raise ValueError("Unexpected data at the end of the index")
+	return n_ref
+
+def findBamIndex(filename):
+	""" Returns the path to the index of a BAM file, or None if there is no index. """
+	basename = os.path.splitext(filename)[0]
+	for candidate in [filename + '.bai', basename + '.bai', filename + '.csi', basename + '.csi']:
+		if os.path.isfile(candidate):
+			return candidate
+
+def checkBamIntegrity(filename):
+	""" Runs a fast structural check of a BAM file and its index. Only the header
+		and the last 28 bytes of the BAM file are read.
+		Returns
+		-------
+			response: dict<>
+				* 'filename': string
+				* 'status': bool
+				* 'eof status': bool
+					Whether the file ends with the BGZF EOF marker.
+				* 'header status': bool
+					Whether the header could be read and its @SQ lines match the reference list.
+				* 'index': string
+					The path to the index, or "" if there is no index.
+				* 'index status': bool
+					Whether the index exists, is not older than the BAM file, and can be parsed.
+				* 'message': string
+					The reason the file failed, if any.
+	"""
+	messages = list()
+	try:
+		eof_status = checkBgzfEof(filename)
+		if not eof_status:
+			messages.append("missing the BGZF EOF marker")
+	except OSError as exception:
+		eof_status = False
+		messages.append("unreadable file: {0}".format(exception))
+
+	header = None
+	try:
+		header = readBamHeader(filename)
+		header_status = _checkReferences(header)
+		if not header_status:
+			messages.append("the @SQ lines don't match the reference list")
+	except OSError:
+		# Already reported by the EOF check.
+		header_status = False
+	except (ValueError, zlib.error, struct.error) as exception:
+		header_status = False
+		messages.append("invalid header: {0}".format(exception))
+
+	index_filename = findBamIndex(filename)
+	try:
+		if index_filename is None:
+			index_status = False
+			messages.append("missing index")
+		elif os.path.getmtime(index_filename) < os.path.getmtime(filename):
+			index_status = False
+			messages.append("the index is older than the BAM file")
+		else:
+			n_ref = readBamIndex(index_filename)
+			index_status = header is None or n_ref == len(header['references'])
+			if not index_status:
+				messages.append("the index doesn't match the reference list")
+	except OSError as exception:
+		index_status = False
+		messages.append("unreadable index: {0}".format(exception))
+	except (ValueError, zlib.error) as exception:
+		index_status = False
+		messages.append("invalid index: {0}".format(exception))
+
+	response = {
+		'filename': filename,
+		'status': eof_status and header_status and index_status,
+		'eof status': eof_status,
+		'header status': header_status,
+		'index': index_filename or "",
+		'index status': index_status,
+		'message': "; ".join(messages)
+	}
+	return response
 
 def verifyFileIntegrity(folder):
 	""" Verifies the status of all files within a folder, including the index.
+		This only checks the structure of each BAM file (see checkBamIntegrity()),
+		so it is a fast way to find truncated or incomplete files before running
+		a full md5 verification.
+		Parameters
+		----------
+			folder: string [PATH]
+				The folder to search. Subfolders are also searched.
+		Returns
+		-------
+			responses: list<dict>
+				The output of checkBamIntegrity() for each BAM file.
 	"""
-
-	pass
+	responses = list()
+	for path, folders, filenames in os.walk(folder):
+		for filename in sorted(filenames):
+			if not filename.endswith('.bam'): continue
+			responses.append(checkBamIntegrity(os.path.join(path, filename)))
+	return responses
 
 if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description = "Verifies the files listed in a manifest.")
+	parser.add_argument('--rehash', action = 'store_true', help = "Ignore the checksum cache and read every file.")
+	parser.add_argument('--no-cache', action = 'store_true', help = "Don't read or update the checksum cache.")
+	parser.add_argument('--compact-cache', action = 'store_true', help = "Remove stale entries from the checksum cache and exit.")
+	parser.add_argument('--max-age', type = int, default = None, help = "Used with --compact-cache. Also remove entries older than this many days.")
+	parser.add_argument('--parallel', action = 'store_true', help = "Verify files in a process pool, grouped by the device each file is stored on.")
+	parser.add_argument('--workers', type = int, default = 1, help = "Used with --parallel. The number of files to verify at once on each device.")
+	parser.add_argument('--stream', action = 'store_true', help = "Journal each row as it is verified and resume an interrupted run.")
+	parser.add_argument('--quick', action = 'store_true', help = "Skip the md5sum of files whose quick fingerprint is unchanged since the last run.")
+	parser.add_argument('--deep-interval', type = int, default = None, help = "Used with --quick. Re-check the md5sum of files last confirmed this many days ago.")
+	parser.add_argument('--triage', action = 'store_true', help = "Only check the structure of each BAM file and its index, then exit.")
+	parser.add_argument('--locations', action = 'store_true', help = "Save the files available on this computer to 'locations.{computer}.tsv' and exit.")
+	parser.add_argument('--partition', nargs = '+', metavar = 'LOCATIONS', help = "Split the manifest between the computers in these location files and exit.")
+	parser.add_argument('--share', action = 'store_true', help = "Only verify the share of the manifest assigned to this computer by --partition.")
+	parser.add_argument('--merge', nargs = '+', metavar = 'MANIFEST', help = "Merge the output manifests from each computer into 'full_manifest.merged.tsv' and exit.")
+	args = parser.parse_args()
+	if args.workers < 1:
+		parser.error("--workers must be at least 1.")
+
+	computer_name = getComputerName()
 	input_manifest = "full_manifest.tsv"
-	output_manifest = os.path.join(os.getcwd(), "full_manifest.{0}.tsv".format(getComputerName()))
-	verifyFromManifest(input_manifest, output_manifest, True)
+	output_manifest = os.path.join(os.getcwd(), "full_manifest.{0}.tsv".format(computer_name))
+	cache_filename = getChecksumCacheFilename(output_manifest)
+	if args.locations:
+		writeLocationFile("locations.{0}.tsv".format(computer_name), computer_name)
+	elif args.partition:
+		for computer, filename in sorted(partitionManifest(input_manifest, args.partition).items()):
+			print(computer, filename)
+	elif args.merge:
+		mergeManifests(args.merge, "full_manifest.merged.tsv")
+	elif args.triage:
+		for folder in getAvailableFolders():
+			for response in verifyFileIntegrity(folder):
+				if not response['status']:
+					print("{0}: {1}".format(response['filename'], response['message']))
+	elif args.compact_cache:
+		cache = ChecksumCache(cache_filename)
+		print("Removed {0} entries from {1}".format(cache.compact(args.max_age), cache_filename))
+		cache.close()
+	else:
+		if args.share:
+			input_manifest = "full_manifest.share.{0}.tsv".format(computer_name)
+		verifyFromManifest(input_manifest, output_manifest, True, parallel = args.parallel, workers_per_device = args.workers,
+			cache = None if args.no_cache else cache_filename, rehash = args.rehash, stream = args.stream,
+			quick = args.quick, deep_interval = args.deep_interval,
+			computer_name = computer_name if args.share else None)
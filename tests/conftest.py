@@ -0,0 +1,45 @@
+""" Makes the repository importable as 'varianttools' when it isn't installed under that name. """
+import importlib.util
+import os
+import sys
+
+import pytest
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+if importlib.util.find_spec('varianttools') is None:
+	spec = importlib.util.spec_from_file_location('varianttools', os.path.join(REPOSITORY, '__init__.py'),
+		submodule_search_locations = [REPOSITORY])
+	module = importlib.util.module_from_spec(spec)
+	sys.modules['varianttools'] = module
+	spec.loader.exec_module(module)
+
+def writeVcf(filename, records, contigs = (), samples = (), header = ()):
+	""" Writes a small vcf file.
+		Parameters
+		----------
+			records: list<string>
+				The tab-separated record lines, without the line terminator.
+			contigs: list<string>
+				Added as '##contig' lines.
+			samples: list<string>
+			header: list<string>
+				Other '##' lines.
+	"""
+	lines = ['##fileformat=VCFv4.1']
+	lines += list(header)
+	lines += ['##contig=<ID={}>'.format(contig) for contig in contigs]
+	columns = ['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO']
+	if samples:
+		columns += ['FORMAT'] + list(samples)
+	lines.append('\t'.join(columns))
+	lines += list(records)
+	with open(str(filename), 'w') as vcf_file:
+		vcf_file.write('\n'.join(lines) + '\n')
+	return str(filename)
+
+@pytest.fixture
+def write_vcf(tmp_path):
+	def write(name, records, **kwargs):
+		return writeVcf(tmp_path / name, records, **kwargs)
+	return write
@@ -0,0 +1,85 @@
+""" Checks that BgzfReader, which reads blocks ahead in other threads, returns the same data
+	as gzip, including reads, lines and seeks that cross block boundaries.
+"""
+import gzip
+import io
+import random
+
+import pytest
+
+pytest.importorskip('pytools.systemtools')
+from varianttools.vcftools import bgzf
+
+def _buildData():
+	generator = random.Random(17)
+	lines = list()
+	for number in range(6000):
+		# Some lines are longer than a block.
+		length = 70000 if number % 1000 == 500 else generator.randint(0, 300)
+		lines.append('{0}\t{1}\n'.format(number, 'ACGT' * (length // 4)).encode())
+	return b''.join(lines)
+
+DATA = _buildData()
+
+@pytest.fixture(scope = 'module', params = ['bgzfwriter', 'htslib'])
+def bgzf_file(request, tmp_path_factory):
+	folder = tmp_path_factory.mktemp(request.param)
+	filename = str(folder / 'data.txt.gz')
+	if request.param == 'bgzfwriter':
+		with bgzf.BgzfWriter(filename) as writer:
+			# Uneven writes, so data is split across blocks in different places.
+			for start in range(0, len(DATA), 40000):
+				writer.write(DATA[start:start + 40000])
+				if start % 120000 == 0:
+					writer.flush()
+	else:
+		pysam = pytest.importorskip('pysam')
+		with open(str(folder / 'data.txt'), 'wb') as output_file:
+			output_file.write(DATA)
+		pysam.tabix_compress(str(folder / 'data.txt'), filename)
+	with open(filename, 'rb') as input_file:
+		assert gzip.decompress(input_file.read()) == DATA
+	return filename
+
+THREADS = [0, 1, 4]
+
+@pytest.mark.parametrize('threads', THREADS)
+def test_read_matches_gzip(bgzf_file, threads):
+	with bgzf.BgzfReader(bgzf_file, threads = threads) as reader:
+		assert reader.read() == DATA
+
+@pytest.mark.parametrize('threads', THREADS)
+def test_sized_reads_match_gzip(bgzf_file, threads):
+	pieces = list()
+	with bgzf.BgzfReader(bgzf_file, threads = threads) as reader:
+		for size in [1, 7, 65279, 65280, 65281, 100000] * 200:
+			pieces.append(reader.read(size))
+		pieces.append(reader.read())
+		assert reader.read(10) == b''
+	assert b''.join(pieces) == DATA
+
+@pytest.mark.parametrize('threads', THREADS)
+def test_lines_match_gzip(bgzf_file, threads):
+	with bgzf.BgzfReader(bgzf_file, threads = threads) as reader:
+		assert list(reader) == DATA.splitlines(keepends = True)
+	with io.TextIOWrapper(io.BufferedReader(bgzf.BgzfRawReader(bgzf.BgzfReader(bgzf_file, threads = threads)))) as text_file:
+		assert text_file.read() == DATA.decode()
+
+@pytest.mark.parametrize('threads', THREADS)
+def test_seek_to_line_offsets(bgzf_file, threads):
+	offsets = list()
+	with bgzf.BgzfReader(bgzf_file, threads = threads) as reader:
+		while True:
+			offset = reader.tell()
+			line = reader.readline()
+			if not line: break
+			offsets.append((offset, line))
+
+		# Seeking discards the blocks read ahead, in either direction.
+		generator = random.Random(3)
+		for offset, line in generator.sample(offsets, 200) + [offsets[-1], offsets[0]]:
+			reader.seek(offset)
+			assert reader.readline() == line
+		start = sum(len(line) for _, line in offsets[:4000])
+		reader.seek(offsets[4000][0])
+		assert reader.read() == DATA[start:]
@@ -0,0 +1,146 @@
+""" The expected files were derived by hand from the GATK 3 CombineVariants merge rules for
+	`-genotypeMergeOptions PRIORITIZE|UNIQUIFY -priority mutect2,varscan,strelka`. They were
+	not written by GATK, so they guard against regressions rather than prove equivalence.
+	Only the '#CHROM' line and the records are compared.
+"""
+import os
+
+import pytest
+
+pytest.importorskip('pytools.systemtools')
+from varianttools.vcftools import bgzf, combine, scanner
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'combine')
+PRIORITY = ['mutect2', 'varscan', 'strelka']
+
+def _readBody(filename):
+	""" Returns the '#CHROM' line and the records of a vcf file. """
+	with open(filename) as vcf_file:
+		return [line for line in vcf_file if not line.startswith('##')]
+
+@pytest.fixture
+def variants():
+	return {caller: os.path.join(FIXTURES, caller + '.vcf') for caller in PRIORITY}
+
+@pytest.mark.parametrize('genotype_merge', ['PRIORITIZE', 'UNIQUIFY'])
+def test_combine_variants_matches_expected(tmp_path, variants, genotype_merge):
+	output_file = combine.combineVariants(variants, str(tmp_path / 'merged.vcf'), PRIORITY, genotype_merge)
+	expected = os.path.join(FIXTURES, 'expected_{}.vcf'.format(genotype_merge.lower()))
+	assert _readBody(output_file) == _readBody(expected)
+
+def test_combine_variants_keep_unconditional(tmp_path, variants):
+	output_file = combine.combineVariants(variants, str(tmp_path / 'merged.vcf'), PRIORITY,
+		filtered_records_merge = 'KEEP_UNCONDITIONAL')
+	records = {fields[1]: fields for fields in scanner.iterRecordFields(output_file)}
+	assert records[b'200'][scanner.FILTER] == b'QSS_ref'
+	assert records[b'100'][scanner.FILTER] == b'PASS'
+
+def test_combine_variants_header(tmp_path, variants):
+	output_file = combine.combineVariants(variants, str(tmp_path / 'merged.vcf'), PRIORITY)
+	header = scanner.readHeader(output_file)
+	assert header[0] == '##fileformat=VCFv4.1'
+	assert combine.SET_HEADER_LINE in header
+	for line in combine.CHROMOSOME_COUNT_HEADER_LINES.values():
+		assert line in header
+	assert len([line for line in header if line.startswith('##INFO=<ID=DP,')]) == 1
+
+def test_combine_variants_removes_partial_output(tmp_path, write_vcf):
+	records = ['chr1\t{}\t.\tA\tC\t.\tPASS\t.'.format(pos) for pos in (10, 20, 15)]
+	variants = {
+		'muse': write_vcf('muse.vcf', records),
+		'varscan': write_vcf('varscan.vcf', records[:1])
+	}
+	output_file = str(tmp_path / 'merged.vcf.gz')
+	with pytest.raises(ValueError):
+		combine.combineVariants(variants, output_file)
+	assert sorted(os.listdir(str(tmp_path))) == ['muse.vcf', 'varscan.vcf']
+
+@pytest.mark.parametrize('genotypes, alts, expected', [
+	([{'GT': '0/1'}, {'GT': '1|2'}], ['C', 'G'], {'AN': '4', 'AC': '2,1', 'AF': '0.500,0.250'}),
+	([{'GT': './.'}, {'AD': '3,4'}], ['C'], {'AN': '0', 'AC': '0', 'AF': '.'}),
+	([{'GT': '0/0'}, {'GT': '0'}], [], {'AN': '3'})
+])
+def test_chromosome_counts(genotypes, alts, expected):
+	info = {'AC': '5', 'AF': '1.00'}
+	combine._setChromosomeCounts(info, alts, genotypes)
+	assert info == expected
+
+def test_combined_vafs(tmp_path, write_vcf):
+	from varianttools.vcftools import vaf
+	header = ['##FORMAT=<ID=AF,Number=A,Type=Float,Description="Allele fraction">']
+	records = ['chr1\t{}\t.\tA\tC\t.\tPASS\tDP=20\tGT:AF\t0/0:0.01\t0/1:{}'.format(pos, af) for pos, af in ((10, 0.25), (20, 0.5))]
+	variants = {
+		'mutect2': write_vcf('mutect2.vcf', records, samples = ['NORMAL', 'TUMOR'], header = header),
+		'muse': write_vcf('muse.vcf', records[:1], samples = ['NORMAL', 'TUMOR'], header = header)
+	}
+	output_file = combine.combineVariants(variants, str(tmp_path / 'merged.vcf'), ['mutect2', 'muse'])
+	assert list(vaf.getVafs(output_file)['vafs']) == [0.25, 0.5]
+
+def _record(chrom, pos, info = '.'):
+	return '\t'.join([chrom, str(pos), '.', 'A', 'C', '.', 'PASS', info])
+
+def test_record_range_with_long_last_line(tmp_path, write_vcf):
+	from varianttools.vcftools import vcfio
+	# The last record spans more than two BGZF blocks.
+	long_info = 'NOTE=' + 'x' * (3 * bgzf.BGZF_BLOCK_SIZE)
+	source = write_vcf('long.vcf', [_record('chr1', 5), _record('chr1', 9), _record('chr2', 7, long_info)])
+	filename = vcfio.compressVcf(source)
+	rank = scanner.ContigOrder(filename)
+	assert combine._getRecordRange(filename, rank) == ((rank('chr1'), 5), (rank('chr2'), 7))
+
+def test_cat_variants_with_skipped_contig(tmp_path, write_vcf):
+	snp = write_vcf('snp.vcf', [_record('chr1', 10), _record('chr3', 5)])
+	indel = write_vcf('indel.vcf', [_record('chr1', 12), _record('chr2', 7), _record('chr3', 1)])
+	output_file = combine.catVariants([snp, indel], str(tmp_path / 'cat.vcf'))
+	positions = [tuple(fields[:2]) for fields in scanner.iterRecordFields(output_file, 2)]
+	assert positions == [(b'chr1', b'10'), (b'chr1', b'12'), (b'chr2', b'7'), (b'chr3', b'1'), (b'chr3', b'5')]
+
+def test_cat_variants_removes_partial_output(tmp_path, write_vcf):
+	snp = write_vcf('snp.vcf', [_record('chr1', 10), _record('chr1', 5)])
+	indel = write_vcf('indel.vcf', [_record('chr1', 12)])
+	with pytest.raises(ValueError):
+		combine.catVariants([snp, indel], str(tmp_path / 'cat.vcf.gz'))
+	assert sorted(os.listdir(str(tmp_path))) == ['indel.vcf', 'snp.vcf']
+
+def _writeLargeVcf(write_vcf, name, chromosomes, step, offset = 0):
+	filler = 'NOTE=' + 'x' * 200
+	records = list()
+	for chrom in chromosomes:
+		for pos in range(1 + offset, 400000, step):
+			info = filler if pos % 50 else 'SVTYPE=DEL;END={};{}'.format(pos + 60000, filler)
+			records.append(_record(chrom, pos, info))
+	return write_vcf(name, records, contigs = ['chr1', 'chr2', 'chr3'])
+
+def test_record_range_only_reads_the_ends(tmp_path, write_vcf, monkeypatch):
+	from varianttools.vcftools import vcfio
+	filename = vcfio.compressVcf(_writeLargeVcf(write_vcf, 'large.vcf', ['chr1', 'chr2'], 97))
+	# Reading the header reads blocks ahead in other threads, so it is done before counting.
+	rank = scanner.ContigOrder(filename)
+	decompressed = list()
+	original = bgzf.decompressBlock
+	monkeypatch.setattr(bgzf, 'decompressBlock', lambda block: decompressed.append(block) or original(block))
+	assert combine._getRecordRange(filename, rank) == ((rank('chr1'), 1), (rank('chr2'), list(range(1, 400000, 97))[-1]))
+	with open(filename, 'rb') as bgzf_file:
+		assert len(decompressed) < len(bgzf.findBlocks(bgzf_file, 0)) // 4
+
+@pytest.mark.parametrize('index', ['tbi', 'csi'])
+def test_cat_variants_combines_the_input_indexes(tmp_path, write_vcf, monkeypatch, index):
+	from varianttools.vcftools import vcfio
+	first = vcfio.compressVcf(_writeLargeVcf(write_vcf, 'first.vcf', ['chr1'], 89), index = index)
+	second = vcfio.compressVcf(_writeLargeVcf(write_vcf, 'second.vcf', ['chr2', 'chr3'], 113, 7), index = index)
+
+	def indexVcf(*args, **kwargs):
+		raise AssertionError("The output was indexed from scratch.")
+	monkeypatch.setattr(vcfio, 'indexVcf', indexVcf)
+	output_file = combine.catVariants([first, second], str(tmp_path / 'cat.vcf.gz'), index = index)
+	assert os.path.isfile(output_file + '.' + index)
+
+	lines = list(scanner.iterRecordLines(output_file))
+	assert lines == list(scanner.iterRecordLines(first)) + list(scanner.iterRecordLines(second))
+	for chrom, start, end in [('chr1', 1, 1), ('chr1', 30000, 30100), ('chr2', 1, 400000), ('chr2', 250000, 250010), ('chr3', 399000, 399500)]:
+		expected = list()
+		for line in lines:
+			line_chrom, begin, stop = vcfio.getRecordInterval(line)
+			if line_chrom == chrom and begin < end and stop > start - 1:
+				expected.append(line)
+		assert list(scanner.fetchRecordLines(output_file, chrom, start, end)) == expected
@@ -0,0 +1,70 @@
+import pytest
+
+pytest.importorskip('pytools.systemtools')
+from varianttools.vcftools import compare, scanner
+
+def _record(chrom, pos, filter_field = 'PASS'):
+	return '\t'.join([chrom, str(pos), '.', 'A', 'C', '.', filter_field, '.'])
+
+@pytest.fixture
+def skipped_contig(write_vcf):
+	# Neither file has '##contig' lines, and the left file has no records on chr2.
+	left = write_vcf('left.vcf', [_record('chr1', 10), _record('chr3', 5, 'LowQual')])
+	right = write_vcf('right.vcf', [_record('chr1', 10), _record('chr2', 7), _record('chr3', 5), _record('chr3', 9)])
+	return left, right
+
+def test_contig_order_merges_headerless_files(skipped_contig):
+	rank = scanner.ContigOrder(*skipped_contig)
+	assert rank('chr1') < rank('chr2') < rank('chr3')
+
+def test_contig_order_rejects_ungrouped_contigs(write_vcf):
+	filename = write_vcf('unsorted.vcf', [_record('chr1', 1), _record('chr2', 1), _record('chr1', 2)])
+	with pytest.raises(ValueError):
+		scanner.ContigOrder(filename)
+
+def test_contig_order_rejects_conflicting_files(write_vcf):
+	left = write_vcf('left.vcf', [_record('chr1', 1), _record('chr2', 1)])
+	right = write_vcf('right.vcf', [_record('chr2', 1), _record('chr1', 1)])
+	with pytest.raises(ValueError):
+		scanner.ContigOrder(left, right)
+
+def test_compare_positions_with_skipped_contig(skipped_contig):
+	left, right = skipped_contig
+	expected = compare._comparePositionSets(left, right)
+	result = compare.comparePositions(left, right)
+	assert result == expected
+	assert result['common'] == 2
+	assert result['rightUnique'] == 2
+	assert result['commonLeftFiltered'] == 1
+
+def test_concordance_with_skipped_contig(write_vcf):
+	callset = {
+		'muse': write_vcf('muse.vcf', [_record('chr1', 10), _record('chr3', 5)]),
+		'varscan': write_vcf('varscan.vcf', [_record('chr1', 10), _record('chr2', 7), _record('chr3', 5)]),
+		'strelka': write_vcf('strelka.vcf', [_record('chr2', 7), _record('chr2', 8)])
+	}
+	result = compare.concordance(callset)
+	assert result['callers'] == ['muse', 'strelka', 'varscan']
+	assert result['total'] == 4
+	assert result['matrix']['muse']['varscan'] == 2
+	assert result['matrix']['strelka']['varscan'] == 1
+	assert result['unique'] == {'muse': 0, 'strelka': 1, 'varscan': 0}
+	assert result['intersections'][0] == {'muse': True, 'strelka': False, 'varscan': True, 'count': 2}
+
+@pytest.mark.parametrize('positions', [
+	[('chr1', 10), ('chr1', 5), ('chr2', 7)],
+	[('chr1', 5), ('chr2', 7), ('chr1', 10)]
+])
+def test_compare_falls_back_for_unsorted_files(write_vcf, positions):
+	left = write_vcf('left.vcf', [_record(chrom, pos) for chrom, pos in positions])
+	right = write_vcf('right.vcf', [_record('chr1', 5), _record('chr2', 8)])
+	with pytest.raises(scanner.UnsortedVcfError):
+		compare.comparePositions(left, right)
+	assert compare.compare(left, right) == compare._comparePositionSets(left, right)
+
+def test_compare_raises_other_errors(skipped_contig, monkeypatch):
+	def comparePositions(*args):
+		raise ValueError("Not a sorting problem.")
+	monkeypatch.setattr(compare, 'comparePositions', comparePositions)
+	with pytest.raises(ValueError, match = "Not a sorting problem"):
+		compare.compare(*skipped_contig)
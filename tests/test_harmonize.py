@@ -0,0 +1,43 @@
+""" Checks that the harmonizers give the same output as SomaticSeq's vcf_modifier modules.
+	The expected files were written by SomaticSeq 3.12.0 (modify_VarScan2.convert() and
+	modify_SomaticSniper.convert()) from the input files in the same folder.
+"""
+import os
+
+import pytest
+
+pytest.importorskip('pytools.systemtools')
+from varianttools.vcftools import harmonize
+
+FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'harmonize')
+CALLERS = [('varscan', 'varscan.vcf'), ('somaticsniper', 'somaticsniper.vcf')]
+
+def _read(filename):
+	with open(filename) as vcf_file:
+		return vcf_file.read()
+
+@pytest.mark.parametrize('caller, basename', CALLERS)
+def test_harmonize_matches_somaticseq(tmp_path, caller, basename):
+	output_file = harmonize.harmonizeVcf(caller, os.path.join(FOLDER, basename), str(tmp_path / basename))
+	assert _read(output_file) == _read(os.path.join(FOLDER, 'expected_' + basename))
+
+@pytest.mark.parametrize('caller, basename', CALLERS)
+def test_harmonize_matches_installed_somaticseq(tmp_path, caller, basename):
+	pytest.importorskip('somaticseq.vcf_modifier')
+	from somaticseq.vcf_modifier import modify_SomaticSniper, modify_VarScan2
+	module = modify_VarScan2 if caller == 'varscan' else modify_SomaticSniper
+	source = os.path.join(FOLDER, basename)
+	expected_file = str(tmp_path / ('expected_' + basename))
+	module.convert(source, expected_file)
+	output_file = harmonize.harmonizeVcf(caller, source, str(tmp_path / basename))
+	assert _read(output_file) == _read(expected_file)
+
+def test_muse_is_copied(tmp_path):
+	assert harmonize.getHarmonizer('muse') is None
+	source = os.path.join(FOLDER, 'somaticsniper.vcf')
+	output_file = harmonize.harmonizeVcf('muse', source, str(tmp_path / 'muse.vcf'))
+	assert _read(output_file) == _read(source)
+
+def test_varscan_alleles_not_starting_with_the_reference():
+	# SomaticSeq raises an IndexError here after removing 'C'.
+	assert harmonize._fixVarscanAlleles(b'G', b'A/C/T') == (b'G', b'A,T')
@@ -0,0 +1,264 @@
+import csv
+import hashlib
+import os
+
+import pytest
+
+pytest.importorskip('pytools.systemtools')
+pytest.importorskip('progressbar')
+from varianttools import index_genome_files
+
+def _getLocations(filename):
+	stat = os.stat(filename)
+	return [index_genome_files.FileLocation(filename, stat.st_size, stat.st_mtime, stat.st_dev)]
+
+def _makeFile(tmp_path):
+	filename = str(tmp_path / 'sample.bam')
+	with open(filename, 'wb') as output:
+		output.write(b'ACGT' * 1000)
+	with open(filename, 'rb') as input_file:
+		md5sum = hashlib.md5(input_file.read()).hexdigest()
+	return filename, md5sum
+
+def test_quick_verification_rehashes_when_expected_md5_changes(tmp_path):
+	filename, md5sum = _makeFile(tmp_path)
+	locations = _getLocations(filename)
+	response, _ = index_genome_files._verifyRow({'md5': md5sum, 'size': ''}, locations, True, quick = True)
+	previous_row = {
+		'md5': md5sum,
+		'md5Status': str(response['md5 status']),
+		'quickFingerprint': response['fingerprint'],
+		'md5Date': response['md5 date']
+	}
+
+	response, _ = index_genome_files._verifyRow({'md5': md5sum, 'size': ''}, locations, True, previous_row, quick = True)
+	assert response['fingerprint status'] and response['md5 status']
+
+	response, _ = index_genome_files._verifyRow({'md5': '0' * 32, 'size': ''}, locations, True, previous_row, quick = True)
+	assert not response['fingerprint status']
+	assert response['md5 status'] is False
+
+def _writeManifest(filename, rows):
+	index_genome_files.writeManifestFile(rows, filename)
+	return filename
+
+def _readManifest(filename):
+	with open(filename) as manifest:
+		return list(csv.DictReader(manifest, delimiter = '\t'))
+
+def test_merge_manifests_uses_the_most_recently_verified_row(tmp_path):
+	base = {'id': 'P1', 'filename': 'sample.bam', 'md5': '0' * 32, 'size': '4000', 'state': '', 'status': 'True'}
+	newer = dict(base, fileLocation = '/new/sample.bam', verified = '2024-03-02 09:00:00')
+	older = dict(base, fileLocation = '/old/sample.bam', verified = '2024-03-01 17:30:00')
+	legacy = dict(base, fileLocation = '/legacy/sample.bam', md5Date = '2024-02-01')
+	manifests = [
+		_writeManifest(str(tmp_path / 'a.tsv'), [newer]),
+		_writeManifest(str(tmp_path / 'b.tsv'), [older]),
+		_writeManifest(str(tmp_path / 'c.tsv'), [legacy])
+	]
+	# The manifest with the oldest rows was written last.
+	os.utime(manifests[0], (1000, 1000))
+
+	output_manifest = index_genome_files.mergeManifests(manifests, str(tmp_path / 'merged.tsv'))
+	rows = _readManifest(output_manifest)
+	assert [row['fileLocation'] for row in rows] == ['/new/sample.bam']
+
+def test_merge_manifests_prefers_rows_that_passed(tmp_path):
+	base = {'id': 'P1', 'filename': 'sample.bam', 'md5': '0' * 32, 'size': '4000', 'state': ''}
+	passed = dict(base, status = 'True', fileLocation = '/old/sample.bam', verified = '2024-03-01 17:30:00')
+	failed = dict(base, status = 'False', fileLocation = '', verified = '2024-03-02 09:00:00')
+	manifests = [_writeManifest(str(tmp_path / 'a.tsv'), [passed]), _writeManifest(str(tmp_path / 'b.tsv'), [failed])]
+
+	output_manifest = index_genome_files.mergeManifests(manifests, str(tmp_path / 'merged.tsv'))
+	assert [row['fileLocation'] for row in _readManifest(output_manifest)] == ['/old/sample.bam']
+
+def test_parallel_verification_matches_serial(tmp_path):
+	rows = list()
+	row_locations = list()
+	for number in range(4):
+		folder = tmp_path / 'P{0}'.format(number)
+		folder.mkdir()
+		filename, md5sum = _makeFile(folder)
+		rows.append({'id': 'P{0}'.format(number), 'md5': md5sum if number != 2 else '0' * 32, 'size': ''})
+		row_locations.append(_getLocations(filename))
+	indices = list(range(len(rows)))
+	previous_rows = [None] * len(rows)
+
+	serial = dict(index_genome_files._verifyRowsSerial(rows, indices, row_locations, previous_rows, True))
+	parallel = dict(index_genome_files._verifyRowsParallel(rows, indices, row_locations, previous_rows, True, 2))
+	assert parallel == serial
+	assert [serial[index][0]['md5 status'] for index in indices] == [True, True, False, True]
+
+def test_rows_are_grouped_by_the_device_that_is_read():
+	def location(name, size, device):
+		return index_genome_files.FileLocation('/{0}/sample.bam'.format(name), size, 0, device)
+	rows = [{'size': '4000'}, {'size': '4000'}, {'size': ''}, {'size': '4000'}]
+	row_locations = [
+		# The first copy is skipped because of its size, so the second copy is read.
+		[location('a', 10, 1), location('b', 4000, 2)],
+		[location('a', 4000, 1), location('b', 4000, 2)],
+		[location('b', 10, 2), location('a', 4000, 1)],
+		[location('a', 10, 1)]
+	]
+	groups = index_genome_files._groupRowsByDevice(rows, range(len(rows)), row_locations)
+	assert {device: list(indices) for device, indices in groups.items()} == {1: [1], 2: [0, 2], None: [3]}
+
+def _writeBam(tmp_path, index = 'bai'):
+	pysam = pytest.importorskip('pysam')
+	filename = str(tmp_path / 'sample.bam')
+	header = {'HD': {'VN': '1.6', 'SO': 'coordinate'}, 'SQ': [{'SN': 'chr1', 'LN': 10000}, {'SN': 'chr2', 'LN': 5000}]}
+	with pysam.AlignmentFile(filename, 'wb', header = header) as bam_file:
+		for position in range(0, 9000, 50):
+			segment = pysam.AlignedSegment()
+			segment.query_name = 'read{0}'.format(position)
+			segment.query_sequence = 'ACGT' * 10
+			segment.reference_id = 0
+			segment.reference_start = position
+			segment.cigarstring = '40M'
+			segment.mapping_quality = 60
+			bam_file.write(segment)
+	pysam.index(filename, *(['-c'] if index == 'csi' else []))
+	return filename
+
+@pytest.mark.parametrize('index', ['bai', 'csi'])
+def test_check_bam_integrity(tmp_path, index):
+	filename = _writeBam(tmp_path, index)
+	response = index_genome_files.checkBamIntegrity(filename)
+	assert response['status'], response['message']
+	assert response['index'] == filename + '.' + index
+	assert index_genome_files.readBamHeader(filename)['references'] == [('chr1', 10000), ('chr2', 5000)]
+
+	# A truncated transfer.
+	with open(filename, 'rb') as bam_file:
+		data = bam_file.read()
+	with open(filename, 'wb') as bam_file:
+		bam_file.write(data[:-28])
+	os.utime(filename + '.' + index)
+	response = index_genome_files.checkBamIntegrity(filename)
+	assert not response['status'] and not response['eof status']
+	assert response['header status'] and response['index status']
+
+@pytest.mark.parametrize('kind', ['missing', 'folder'])
+def test_check_bam_integrity_reports_unreadable_files(tmp_path, kind):
+	filename = str(tmp_path / 'sample.bam')
+	if kind == 'folder':
+		os.mkdir(filename)
+	response = index_genome_files.checkBamIntegrity(filename)
+	assert not response['status'] and not response['eof status'] and not response['header status']
+	assert response['message'].startswith("unreadable file")
+
+def _countReads(monkeypatch):
+	reads = list()
+	original = index_genome_files._iterFileBlocks
+	def iterFileBlocks(filename, *args, **kwargs):
+		reads.append(filename)
+		return original(filename, *args, **kwargs)
+	monkeypatch.setattr(index_genome_files, '_iterFileBlocks', iterFileBlocks)
+	return reads
+
+def test_checksum_cache_hit(tmp_path, monkeypatch):
+	filename, md5sum = _makeFile(tmp_path)
+	cache_filename = str(tmp_path / 'manifest.md5cache.sqlite')
+	reads = _countReads(monkeypatch)
+	assert index_genome_files.generateFileMd5(filename, cache = index_genome_files.ChecksumCache(cache_filename)) == md5sum
+	assert len(reads) == 1
+
+	# The checksum is saved in the file, so a new cache (as in another process) uses it too.
+	cache = index_genome_files.ChecksumCache(cache_filename)
+	assert index_genome_files.generateFileMd5(filename, cache = cache) == md5sum
+	assert len(reads) == 1
+	assert index_genome_files.generateFileMd5(filename, cache = cache, rehash = True) == md5sum
+	assert len(reads) == 2
+
+@pytest.mark.parametrize('change', ['mtime', 'size'])
+def test_checksum_cache_miss_when_the_file_changes(tmp_path, monkeypatch, change):
+	filename, md5sum = _makeFile(tmp_path)
+	cache = index_genome_files.ChecksumCache(str(tmp_path / 'manifest.md5cache.sqlite'))
+	reads = _countReads(monkeypatch)
+	index_genome_files.generateFileMd5(filename, cache = cache)
+
+	stat = os.stat(filename)
+	if change == 'mtime':
+		# Same size and contents, only touched.
+		os.utime(filename, ns = (stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+	else:
+		with open(filename, 'ab') as output:
+			output.write(b'ACGT')
+	with open(filename, 'rb') as input_file:
+		expected = hashlib.md5(input_file.read()).hexdigest()
+	assert cache.get(filename) is None
+	assert index_genome_files.generateFileMd5(filename, cache = cache) == expected
+	assert len(reads) == 2
+	assert cache.get(filename) == expected
+
+def _journalLine(number):
+	return {'id': 'P{0}'.format(number), 'filename': 'sample.bam', 'md5': '0' * 32, 'size': '4000', 'state': '',
+		'barcode': 'B{0}'.format(number), 'status': True}
+
+def test_journal_resumes_after_a_truncated_last_line(tmp_path):
+	journal_filename = str(tmp_path / 'manifest.tsv.journal')
+	journal = index_genome_files.ManifestJournal(journal_filename)
+	for number in range(3):
+		journal.write(_journalLine(number))
+	journal.close()
+	# The process was killed while writing the fourth row.
+	with open(journal_filename, 'ab') as journal_file:
+		journal_file.write(b'P3\tsample.bam\t00000')
+
+	journal = index_genome_files.ManifestJournal(journal_filename)
+	assert journal.completed == {('P0', 'sample.bam'), ('P1', 'sample.bam'), ('P2', 'sample.bam')}
+	assert _journalLine(3) not in journal
+	for number in range(3, 5):
+		journal.write(_journalLine(number))
+	output_manifest = str(tmp_path / 'manifest.tsv')
+	journal.finalize(output_manifest, {('P{0}'.format(number), 'sample.bam'): number for number in range(5)}, False)
+
+	rows = _readManifest(output_manifest)
+	assert [row['id'] for row in rows] == ['P0', 'P1', 'P2', 'P3', 'P4']
+	assert all(row['md5'] == '0' * 32 and row['status'] == 'True' for row in rows)
+	assert not os.path.exists(journal_filename)
+
+def test_journal_resumes_after_a_truncated_header(tmp_path):
+	journal_filename = str(tmp_path / 'manifest.tsv.journal')
+	with open(journal_filename, 'wb') as journal_file:
+		journal_file.write(b'id\tfilena')
+
+	journal = index_genome_files.ManifestJournal(journal_filename)
+	assert not journal.completed
+	journal.write(_journalLine(0))
+	output_manifest = str(tmp_path / 'manifest.tsv')
+	journal.finalize(output_manifest, {('P0', 'sample.bam'): 0}, False)
+	assert [row['id'] for row in _readManifest(output_manifest)] == ['P0']
+
+@pytest.mark.parametrize('threaded', [False, True])
+def test_file_digests_match_hashlib(tmp_path, threaded):
+	import zlib
+	filename = str(tmp_path / 'sample.bam')
+	data = os.urandom(300000)
+	with open(filename, 'wb') as output:
+		output.write(data)
+	expected = {algorithm: hashlib.new(algorithm, data).hexdigest() for algorithm in ['md5', 'sha1', 'sha256', 'sha512']}
+	expected['crc32'] = '{0:08x}'.format(zlib.crc32(data) & 0xffffffff)
+	expected['adler32'] = '{0:08x}'.format(zlib.adler32(data) & 0xffffffff)
+
+	# The block size doesn't divide the file size, so the last block is partial.
+	digests = index_genome_files.generateFileDigests(filename, list(expected), blocksize = 65536, threaded = threaded)
+	assert digests == expected
+	assert index_genome_files.generateFileMd5(filename, blocksize = 65536, threaded = threaded) == expected['md5']
+
+def test_file_digests_of_an_empty_file(tmp_path):
+	filename = str(tmp_path / 'empty.bam')
+	open(filename, 'wb').close()
+	digests = index_genome_files.generateFileDigests(filename, ['md5', 'sha256', 'crc32', 'adler32'], threaded = True)
+	assert digests == {'md5': hashlib.md5().hexdigest(), 'sha256': hashlib.sha256().hexdigest(), 'crc32': '00000000', 'adler32': '00000001'}
+
+def test_file_digests_mix_cached_and_generated_values(tmp_path):
+	filename = str(tmp_path / 'sample.bam')
+	data = os.urandom(10000)
+	with open(filename, 'wb') as output:
+		output.write(data)
+	cache = index_genome_files.ChecksumCache(str(tmp_path / 'manifest.md5cache.sqlite'))
+	index_genome_files.generateFileDigests(filename, ['md5'], cache = cache)
+	digests = index_genome_files.generateFileDigests(filename, ['md5', 'sha256'], cache = cache)
+	assert digests == {'md5': hashlib.md5(data).hexdigest(), 'sha256': hashlib.sha256(data).hexdigest()}
+	assert cache.get(filename, 'sha256') == digests['sha256']
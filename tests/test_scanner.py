@@ -0,0 +1,53 @@
+""" Checks that the raw scanner reads records the same way as PyVCF. """
+import os
+
+import pytest
+import vcf
+
+pytest.importorskip('pytools.systemtools')
+from varianttools.vcftools import scanner, vcfio
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'scanner', 'mixed.vcf')
+
+def _getPyvcfClass(record):
+	if record.is_snp:
+		return 'snp'
+	if record.is_indel:
+		return 'indel'
+	return None
+
+@pytest.fixture(params = ['vcf', 'vcf.gz'])
+def filename(request, tmp_path):
+	if request.param == 'vcf':
+		return FIXTURE
+	return vcfio.compressVcf(FIXTURE, str(tmp_path / 'mixed.vcf.gz'))
+
+@pytest.fixture
+def records():
+	with open(FIXTURE) as vcf_file:
+		return list(vcf.Reader(vcf_file))
+
+def test_iter_positions(filename, records):
+	expected = [(record.CHROM, record.POS, bool(record.FILTER)) for record in records]
+	assert list(scanner.iterPositions(filename)) == expected
+
+def test_iter_positions_by_chromosome(filename, records):
+	expected = [(record.CHROM, record.POS, bool(record.FILTER)) for record in records if record.CHROM == 'chr2']
+	assert list(scanner.iterPositions(filename, 'chr2')) == expected
+
+def test_is_filtered(filename, records):
+	filters = [scanner.isFiltered(fields[scanner.FILTER]) for fields in scanner.iterRecordFields(filename)]
+	assert filters == [bool(record.FILTER) for record in records]
+
+def test_get_variant_class(filename, records):
+	classes = list()
+	for fields in scanner.iterRecordFields(filename):
+		ref, alt, info = [fields[column].decode() for column in (scanner.REF, scanner.ALT, scanner.INFO)]
+		classes.append(scanner.getVariantClass(ref, alt, info))
+	assert classes == [_getPyvcfClass(record) for record in records]
+
+def test_count_records(filename, records):
+	expected = dict()
+	for record in records:
+		expected[record.CHROM] = expected.get(record.CHROM, 0) + 1
+	assert scanner.countRecords(filename) == expected
@@ -0,0 +1,141 @@
+""" Checks chromosome and region fetches through tabix and CSI indexes against a scan of
+	every record, and against htslib through pysam. Indexes written by this package and
+	by htslib are both read.
+"""
+import pytest
+
+pytest.importorskip('pytools.systemtools')
+from varianttools.vcftools import scanner, tabix, vcfio
+
+FILLER = 'DB;' + 'X' * 150
+
+def _buildRecords():
+	records = list()
+	for step, position in enumerate(range(1, 3000000, 997)):
+		records.append(('chr1', position, 'A', '.'))
+		if step == 101:
+			# A deletion spanning several 16kbp windows.
+			records.append(('chr1', position, 'A' * 40000, '.'))
+		elif step == 201:
+			records.append(('chr1', position, 'N', 'SVTYPE=DEL;END=2500000'))
+		elif step == 1205:
+			records.append(('chr1', position, 'N', 'SVTYPE=DUP;END=1400000'))
+	for position in range(5000, 80000, 5000):
+		records.append(('chr2', position, 'C', 'SVTYPE=INV;END={}'.format(position + 30000) if position == 20000 else '.'))
+	records.append(('chr3', 1, 'G', '.'))
+	return records
+
+RECORDS = _buildRecords()
+REGIONS = [
+	('chr1', 1, 1),
+	('chr1', 150000, 150000),
+	('chr1', 2000000, 2000100),
+	('chr1', 2499990, 2500010),
+	('chr1', 1300000, 1300000),
+	('chr1', 1399000, 1405000),
+	('chr1', 2999000, 4000000),
+	('chr1', 3500000, 4000000),
+	('chr2', 45000, 46000),
+	('chr2', 1, 100000),
+	('chr3', 1, 10),
+	('chr4', 1, 10),
+	# Whole chromosomes, and regions open at one end.
+	('chr1', None, None),
+	('chr2', None, None),
+	('chr3', None, None),
+	('chr4', None, None),
+	('chr1', 2500000, None),
+	('chr1', None, 1000),
+	('chr2', None, 20000)
+]
+
+def _formatRecord(chrom, position, ref, info):
+	if info == '.':
+		info = FILLER
+	else:
+		info = info + ';' + FILLER
+	return '\t'.join([chrom, str(position), '.', ref, 'T', '.', 'PASS', info])
+
+def _overlaps(record, chrom, start, end):
+	record_chrom, position, ref, info = record
+	record_end = position - 1 + len(ref)
+	if 'END=' in info:
+		record_end = max(record_end, int(info.split('END=')[1]))
+	if start is not None and record_end <= start - 1:
+		return False
+	if end is not None and position - 1 >= end:
+		return False
+	return record_chrom == chrom
+
+@pytest.fixture(scope = 'module', params = [('tbi', 'vcfio'), ('csi', 'vcfio'), ('tbi', 'htslib'), ('csi', 'htslib')], ids = '-'.join)
+def indexed_vcf(request, tmp_path_factory):
+	kind, builder = request.param
+	folder = tmp_path_factory.mktemp(kind)
+	with open(str(folder / 'records.vcf'), 'w') as vcf_file:
+		vcf_file.write('##fileformat=VCFv4.1\n#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\n')
+		for record in RECORDS:
+			vcf_file.write(_formatRecord(*record) + '\n')
+	if builder == 'vcfio':
+		filename = vcfio.compressVcf(str(folder / 'records.vcf'), index = kind)
+	else:
+		pysam = pytest.importorskip('pysam')
+		filename = pysam.tabix_index(str(folder / 'records.vcf'), preset = 'vcf', csi = kind == 'csi')
+	return filename, filename + '.' + kind
+
+def _fetchPositions(filename, chrom, start, end):
+	return [(fields[0].decode(), int(fields[1])) for fields in (line.split(b'\t', 2) for line in scanner.fetchRecordLines(filename, chrom, start, end))]
+
+@pytest.mark.parametrize('chrom, start, end', REGIONS)
+def test_region_fetch_matches_scan(indexed_vcf, chrom, start, end):
+	filename, _ = indexed_vcf
+	expected = [(record[0], record[1]) for record in RECORDS if _overlaps(record, chrom, start, end)]
+	assert _fetchPositions(filename, chrom, start, end) == expected
+
+@pytest.mark.parametrize('chrom, start, end', REGIONS)
+def test_region_fetch_matches_pysam(indexed_vcf, chrom, start, end):
+	pysam = pytest.importorskip('pysam')
+	filename, index_filename = indexed_vcf
+	with pysam.TabixFile(filename, index = index_filename) as tabix_file:
+		if chrom not in tabix_file.contigs:
+			expected = list()
+		else:
+			begin = None if start is None else start - 1
+			expected = [(line.split('\t')[0], int(line.split('\t')[1])) for line in tabix_file.fetch(chrom, begin, end)]
+	assert _fetchPositions(filename, chrom, start, end) == expected
+
+def test_csi_bin_offsets_cover_spanning_records(indexed_vcf):
+	filename, index_filename = indexed_vcf
+	index = tabix.readIndex(index_filename)
+	if index.kind != 'csi':
+		pytest.skip("Only CSI indexes store an offset for each bin.")
+	# The leaf bin of 2,000,000 holds later SNVs, but the deletion ending at 2,500,000 overlaps it.
+	chunks = tabix.getRegionChunks(index, 'chr1', 2000000, 2000000)
+	lines = list(scanner._iterChunkLines(filename, chunks))
+	assert any(b'END=2500000' in line for line in lines)
+
+def _countRecords(records):
+	counts = dict()
+	for record in records:
+		counts[record[0]] = counts.get(record[0], 0) + 1
+	return counts
+
+def test_count_variants_from_index(indexed_vcf):
+	file_tools = pytest.importorskip('varianttools.file_tools')
+	filename, _ = indexed_vcf
+	assert file_tools.countVariants(filename, use_index = True) == _countRecords(RECORDS)
+	assert file_tools.countVariants(filename, use_index = False) == _countRecords(RECORDS)
+
+def test_count_variants_without_reference_names(indexed_vcf, tmp_path):
+	file_tools = pytest.importorskip('varianttools.file_tools')
+	filename, index_filename = indexed_vcf
+	index = tabix.readIndex(index_filename)
+	if index.kind != 'csi':
+		pytest.skip("Only CSI indexes can leave out the reference names.")
+	# Copy the file, so the index of the fixture is left as is.
+	copied = str(tmp_path / 'records.vcf.gz')
+	with open(filename, 'rb') as input_file, open(copied, 'wb') as output_file:
+		output_file.write(input_file.read())
+	index.names = list()
+	tabix.writeIndex(index, copied + '.csi')
+	assert tabix.readIndex(copied + '.csi').getCounts() is None
+	assert file_tools.countVariants(copied, use_index = True) == _countRecords(RECORDS)
@@ -0,0 +1,87 @@
+""" Checks that the VAFs calculated from raw lines match GATKMergeSampleCallsets._getVAF().
+	The fixture has a record shaped like the merged output of each caller, so every way
+	_getVAF() calculates the VAF is used: 'FREQ' (VarScan2), 'DP/AD' (MuSE), 'AF' (MuTect2),
+	'DP4' (SomaticSniper) and the tier counts (Strelka).
+	annotateVcf() is also checked against the PyVCF backend of _modify_merged_vcf().
+"""
+import os
+
+import pytest
+import vcf
+
+pytest.importorskip('pytools.systemtools')
+pytest.importorskip('progressbar')
+from varianttools import callertools
+from varianttools.vcftools import vaf
+
+FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'vaf', 'merged.vcf')
+
+@pytest.fixture(scope = 'module')
+def records():
+	with open(FIXTURE) as vcf_file:
+		return list(vcf.Reader(vcf_file))
+
+def test_fixture_uses_every_method():
+	with open(FIXTURE, 'rb') as vcf_file:
+		lines = [line for line in vcf_file if not line.startswith(b'#')]
+	methods = set(vaf._getMethod(line.split(b'\t')[vaf.INFO]) for line in lines)
+	assert methods == {vaf.FREQ, vaf.DEPTH, vaf.AF, vaf.DP4, vaf.TIERS}
+
+@pytest.mark.parametrize('chunk_size', [1, 2, 5, 10000])
+def test_get_vafs_matches_get_vaf(records, chunk_size):
+	expected = [callertools.GATKMergeSampleCallsets._getVAF(record) for record in records]
+	result = vaf.getVafs(FIXTURE, chunk_size = chunk_size)
+	assert list(result['chromosomes']) == [record.CHROM for record in records]
+	assert list(result['positions']) == [record.POS for record in records]
+	assert list(result['vafs']) == pytest.approx(expected)
+
+def _readLines(filename):
+	with open(filename, 'rb') as vcf_file:
+		return vcf_file.read().splitlines()
+
+def test_annotate_vcf_only_changes_info(tmp_path):
+	output_file = vaf.annotateVcf(FIXTURE, str(tmp_path / 'merged.modified.vcf'))
+	original = _readLines(FIXTURE)
+	annotated = _readLines(output_file)
+
+	header = [line for line in original if line.startswith(b'#')]
+	info_end = max(index for index, line in enumerate(header) if line.startswith(b'##INFO=')) + 1
+	header.insert(info_end, vaf.VAF_HEADER.encode())
+	assert annotated[:len(header)] == header
+
+	records = annotated[len(header):]
+	assert len(records) == len(original) - len(header) + 1
+	for line, annotated_line in zip(original[len(header) - 1:], records):
+		fields = line.split(b'\t')
+		annotated_fields = annotated_line.split(b'\t')
+		info = annotated_fields[vaf.INFO].split(b';')
+		assert info[:-1] == fields[vaf.INFO].split(b';')
+		assert info[-1].startswith(b'VAF=')
+		assert annotated_fields[:vaf.INFO] + annotated_fields[vaf.INFO + 1:] == fields[:vaf.INFO] + fields[vaf.INFO + 1:]
+
+def _readVafs(filename):
+	vafs = list()
+	for line in _readLines(filename):
+		if line.startswith(b'#'): continue
+		fields = line.split(b'\t')
+		info = dict(entry.split(b'=', 1) for entry in fields[vaf.INFO].split(b';') if b'=' in entry)
+		vafs.append((fields[0], int(fields[1]), float(info[b'VAF'])))
+	return vafs
+
+def test_annotate_vcf_matches_pyvcf_backend(tmp_path):
+	# The PyVCF writer reformats other fields and copies the FREQ header line for VAF,
+	# so only the positions and VAF values are compared.
+	merger = callertools.GATKMergeSampleCallsets(native = True)
+	outputs = dict()
+	for backend in ('pyvcf', 'raw'):
+		folder = tmp_path / backend
+		folder.mkdir()
+		filename = str(folder / 'merged.vcf')
+		with open(FIXTURE, 'rb') as input_file, open(filename, 'wb') as output_file:
+			output_file.write(input_file.read())
+		outputs[backend] = _readVafs(merger._modify_merged_vcf(filename, backend = backend))
+
+	assert len(outputs['raw']) == len(outputs['pyvcf']) == 12
+	for expected, result in zip(outputs['pyvcf'], outputs['raw']):
+		assert result[:2] == expected[:2]
+		assert result[2] == pytest.approx(expected[2])
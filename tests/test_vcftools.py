@@ -0,0 +1,172 @@
+import os
+
+import pytest
+
+pytest.importorskip('pytools.systemtools')
+pytest.importorskip('progressbar')
+from varianttools.vcftools import scanner, vcftools
+
+def _record(chrom, pos):
+	return '\t'.join([chrom, str(pos), '.', 'A', 'C', '.', 'PASS', '.'])
+
+def _readPositions(filename):
+	return [(fields[0].decode(), int(fields[1])) for fields in scanner.iterRecordFields(filename, 2)]
+
+def test_find_chromosome_ranges(write_vcf):
+	records = [_record('chr1', pos) for pos in range(1, 40)] + [_record('chr2', 5), _record('chr3', 2)]
+	filename = write_vcf('sorted.vcf', records)
+	ranges = vcftools.findChromosomeRanges(filename)
+	assert [chromosome for chromosome, _, _ in ranges] == ['chr1', 'chr2', 'chr3']
+
+def test_copy_chromosome_range_checks_every_line(tmp_path, write_vcf):
+	# The boundaries of the chr1 range are consistent, but chr2 is inside it.
+	records = [_record('chr1', 1), _record('chr2', 1), _record('chr1', 2), _record('chr3', 1)]
+	source = write_vcf('unsorted.vcf', records)
+	ranges = vcftools.findChromosomeRanges(source)
+	assert ranges[0][0] == 'chr1'
+	_, start, end = ranges[0]
+	with pytest.raises(ValueError):
+		vcftools._copyChromosomeRange(source, 'plain', 'chr1', start, end, b'', str(tmp_path / 'chr1.vcf'))
+
+@pytest.mark.parametrize('processes', [None, 2])
+def test_split_unsorted_vcf_by_chromosome(tmp_path, write_vcf, processes):
+	records = [_record('chr1', pos) for pos in range(1, 20)] + [_record('chr2', 5)] + [_record('chr1', pos) for pos in range(20, 40)]
+	source = write_vcf('unsorted.vcf', records, contigs = ['chr1', 'chr2'])
+	output_folder = str(tmp_path / 'split')
+	os.makedirs(output_folder)
+
+	output = vcftools.splitVcfByChromosome(source, output_folder, processes = processes)
+	assert sorted(output) == ['chr1', 'chr2']
+	assert _readPositions(output['chr1']) == [('chr1', pos) for pos in range(1, 40)]
+	assert _readPositions(output['chr2']) == [('chr2', 5)]
+
+def test_split_gzipped_vcf_in_parallel(tmp_path, write_vcf):
+	import gzip
+	source = write_vcf('sample.vcf', [_record('chr1', 1), _record('chr2', 1)], contigs = ['chr1', 'chr2'])
+	gzipped = source + '.gz'
+	with open(source, 'rb') as input_file, gzip.open(gzipped, 'wb') as output_file:
+		output_file.write(input_file.read())
+	output_folder = str(tmp_path / 'split')
+	os.makedirs(output_folder)
+
+	output = vcftools.splitVcfByChromosome(gzipped, output_folder, processes = 2)
+	assert _readPositions(output['chr1']) == [('chr1', 1)]
+	assert _readPositions(output['chr2']) == [('chr2', 1)]
+
+def test_fix_callset_outputs_rejects_patient_id(tmp_path):
+	with pytest.raises(ValueError):
+		vcftools.fixCallsetOutputs({'P1': {}}, str(tmp_path), patientId = 'P1', native = True)
+
+def test_fix_callset_outputs_names_native_files_by_patient(tmp_path):
+	source = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'harmonize', 'varscan.vcf')
+	result = vcftools.fixCallsetOutputs({'P1': {'varscan': source}}, str(tmp_path), native = True, output_folder = str(tmp_path))
+	assert result['callsets'] == {'P1': {'varscan': str(tmp_path / 'P1.varscan.corrected.vcf')}}
+
+def test_split_callset_with_an_unsorted_file(tmp_path, write_vcf):
+	sorted_records = [_record('chr1', pos) for pos in range(1, 30)] + [_record('chr2', 3)]
+	unsorted_records = [_record('chr1', pos) for pos in range(1, 20)] + [_record('chr2', 5)] + [_record('chr1', pos) for pos in range(20, 40)]
+	callset = {
+		'muse': write_vcf('muse.vcf', sorted_records, contigs = ['chr1', 'chr2']),
+		'varscan': write_vcf('varscan.vcf', unsorted_records, contigs = ['chr1', 'chr2'])
+	}
+	output_folder = str(tmp_path / 'split')
+	os.makedirs(output_folder)
+
+	vcftools.splitCallsetByChromosome(callset, output_folder, processes = 2)
+	assert _readPositions(os.path.join(output_folder, 'chr1', 'varscan.chr1.vcf')) == [('chr1', pos) for pos in range(1, 40)]
+	assert _readPositions(os.path.join(output_folder, 'chr2', 'varscan.chr2.vcf')) == [('chr2', 5)]
+	assert _readPositions(os.path.join(output_folder, 'chr1', 'muse.chr1.vcf')) == [('chr1', pos) for pos in range(1, 30)]
+	assert _readPositions(os.path.join(output_folder, 'chr2', 'muse.chr2.vcf')) == [('chr2', 3)]
+
+def _partitionRecords():
+	records = list()
+	for pos in range(1, 13):
+		chrom = ['chr1', 'chr2', 'chrUn_gl000220'][pos % 3]
+		ref, alt = [('A', 'C'), ('AT', 'A'), ('A', '<DEL>'), ('A', 'C/T')][pos % 4]
+		info = 'SVTYPE=DEL' if alt == '<DEL>' else '.'
+		records.append('\t'.join([chrom, str(pos), '.', ref, alt, '.', 'PASS' if pos % 5 else 'LowQual', info]))
+	return records
+
+def _readLines(filename):
+	return [line.decode().rstrip('\n') for line in scanner.iterRecordLines(filename)]
+
+def _expectedPartitions(records, remove_slash_alleles = True):
+	expected = dict()
+	for line in records:
+		fields = line.split('\t')
+		if remove_slash_alleles and '/' in fields[4]: continue
+		variant_class = 'snp' if len(fields[3]) == len(fields[4]) == 1 else 'indel' if fields[4] != '<DEL>' else None
+		if variant_class is None or fields[0] == 'chrUn_gl000220': continue
+		key = (variant_class, fields[0], 'PASS' if fields[6] == 'PASS' else 'filtered')
+		expected.setdefault(key, list()).append(line)
+	return expected
+
+@pytest.mark.parametrize('remove_slash_alleles', [True, False])
+def test_partition_vcf_by_routing_keys(tmp_path, write_vcf, remove_slash_alleles):
+	records = _partitionRecords()
+	source = write_vcf('sample.vcf', records)
+	output = vcftools.partitionVcf(source, str(tmp_path / 'partitions'), keys = ('type', 'chromosome', 'filter'),
+		remove_slash_alleles = remove_slash_alleles)
+
+	expected = _expectedPartitions(records, remove_slash_alleles)
+	assert sorted(output) == sorted(expected)
+	for key, filename in output.items():
+		assert os.path.basename(filename) == 'sample.{}.vcf'.format('.'.join(key))
+		assert _readLines(filename) == expected[key]
+		assert scanner.readHeader(filename) == scanner.readHeader(source)
+
+def test_partition_vcf_with_a_custom_key(tmp_path, write_vcf):
+	records = _partitionRecords()
+	source = write_vcf('sample.vcf', records)
+	output = vcftools.partitionVcf(source, str(tmp_path / 'partitions'), keys = (lambda fields: 'odd' if int(fields[1]) % 2 else None,),
+		remove_slash_alleles = False)
+	assert list(output) == [('odd',)]
+	assert _readLines(output[('odd',)]) == records[::2]
+
+@pytest.mark.parametrize('output_format', ['vcf', 'vcf.gz'])
+def test_partition_vcf_reopens_evicted_files(tmp_path, write_vcf, output_format):
+	# The chromosomes alternate, so each file is closed and reopened for every record.
+	records = [_record('chr{}'.format(pos % 3 + 1), pos) for pos in range(1, 40)]
+	source = write_vcf('sample.vcf', records, contigs = ['chr1', 'chr2', 'chr3'])
+	output = vcftools.partitionVcf(source, str(tmp_path / 'partitions'), keys = ('chromosome',), max_open_files = 1,
+		output_format = output_format)
+
+	assert sorted(output) == [('chr1',), ('chr2',), ('chr3',)]
+	for (chrom,), filename in output.items():
+		assert _readLines(filename) == [line for line in records if line.startswith(chrom + '\t')]
+		assert scanner.readHeader(filename) == scanner.readHeader(source)
+		if output_format == 'vcf.gz':
+			assert list(scanner.fetchRecordLines(filename, chrom, 10, 20)) == [line.encode() + b'\n' for line in records
+				if line.startswith(chrom + '\t') and 10 <= int(line.split('\t')[1]) <= 20]
+
+def test_partition_vcf_fixes_the_varscan_dp4_header(tmp_path, write_vcf):
+	dp4 = '##FORMAT=<ID=DP4,Number=1,Type=String,Description="Strand read counts">'
+	source = write_vcf('sample.Varscan.vcf', [_record('chr1', 1)], header = [dp4])
+	output = vcftools.partitionVcf(source, str(tmp_path / 'partitions'))
+	assert scanner.fixDp4Header(dp4) in scanner.readHeader(output[('snp',)])
+	assert dp4 not in scanner.readHeader(output[('snp',)])
+
+def _readPyvcf(filename):
+	import vcf
+	with open(filename) as vcf_file:
+		reader = vcf.Reader(vcf_file)
+		records = [(record.CHROM, record.POS, record.ID, record.REF, [str(alt) for alt in record.ALT], record.QUAL,
+			record.FILTER, record.INFO, record.FORMAT, [(sample.sample, sample.data) for sample in record.samples]) for record in reader]
+		return reader.infos, reader.formats, reader.filters, reader.samples, records
+
+@pytest.mark.parametrize('basename', ['sample.vcf', 'sample.Varscan.vcf'])
+def test_copy_records_matches_pyvcf_copy(tmp_path, basename):
+	source = str(tmp_path / basename)
+	fixture = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'harmonize', 'varscan.vcf')
+	with open(fixture) as input_file, open(source, 'w') as output_file:
+		output_file.write(input_file.read())
+	os.makedirs(str(tmp_path / 'pyvcf'))
+	os.makedirs(str(tmp_path / 'raw'))
+
+	expected = vcftools.copyVcf(source, str(tmp_path / 'pyvcf' / basename), backend = 'pyvcf')
+	result = vcftools.copyVcf(source, str(tmp_path / 'raw' / basename), backend = 'raw')
+	assert _readPyvcf(result) == _readPyvcf(expected)
+	# The records with a '/' in REF or the first ALT allele are removed.
+	assert _readPositions(result) == [('chr1', 1000), ('chr2', 500), ('chr2', 600), ('chr3', 950), ('chr3', 1000), ('chr3', 1100)]
+	if 'Varscan' in basename:
+		assert _readPyvcf(result)[1]['DP4'].num == 4
@@ -0,0 +1,363 @@
+""" Reads and writes BGZF files, the blocked gzip format used by bgzip, tabix and BAM files.
+	Positions in a BGZF file are virtual file offsets: the file offset of the
+	compressed block shifted left 16 bits, plus the offset within the
+	uncompressed block.
+"""
+import io
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# The empty block every BGZF file should end with.
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+# The largest amount of data stored in a block, as used by htslib.
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_MAX_BLOCK_SIZE = 0x10000
+
+def isBgzf(filename):
+	""" Checks whether a file starts with a BGZF block header. """
+	with open(filename, 'rb') as file1:
+		header = file1.read(18)
+	return len(header) == 18 and header[:4] == b'\x1f\x8b\x08\x04' and header[12:14] == b'BC'
+
+def readBlock(file1):
+	""" Reads the next compressed block of a BGZF file.
+		Returns
+		-------
+			block: bytes
+				The complete compressed block, or b'' at the end of the file.
+	"""
+	header = file1.read(18)
+	if not header:
+		return b''
+	if len(header) < 18 or header[:4] != b'\x1f\x8b\x08\x04':
+		raise ValueError("Invalid BGZF block header")
+	xlen = struct.unpack('<H', header[10:12])[0]
+	extra = header[12:] + file1.read(xlen - 6)
+	position = 0
+	block_size = None
+	while position + 4 <= len(extra):
+		subfield_length = struct.unpack('<H', extra[position+2:position+4])[0]
+		if extra[position:position+2] == b'BC':
+			block_size = struct.unpack('<H', extra[position+4:position+6])[0] + 1
+		position += 4 + subfield_length
+	if block_size is None:
+		raise ValueError("BGZF block is missing the BC field")
+	remainder = file1.read(block_size - 12 - xlen)
+	if len(remainder) < block_size - 12 - xlen:
+		raise ValueError("Truncated BGZF block")
+	return header[:12] + extra + remainder
+
+def _followBlocks(data, position):
+	""" Returns the offsets of the blocks starting at `position` if their sizes lead exactly
+		to the end of `data`, or None.
+	"""
+	offsets = list()
+	while position < len(data):
+		header = data[position:position + 18]
+		if len(header) < 18 or header[:4] != b'\x1f\x8b\x08\x04' or header[12:14] != b'BC':
+			return None
+		offsets.append(position)
+		position += struct.unpack('<H', header[16:18])[0] + 1
+	return offsets if position == len(data) else None
+
+def findBlocks(file1, start):
+	""" Finds the blocks of a BGZF file that start at or after the file offset `start`,
+		without reading the blocks before it. The first block header found after `start`
+		is only accepted if the block sizes lead exactly to the end of the file.
+		Returns
+		-------
+			offsets: list<int>
+				The file offset of each block, in file order.
+	"""
+	size = file1.seek(0, os.SEEK_END)
+	file1.seek(start)
+	data = file1.read(size - start)
+	candidate = data.find(b'\x1f\x8b\x08\x04')
+	while candidate != -1:
+		offsets = _followBlocks(data, candidate)
+		if offsets is not None:
+			return [start + offset for offset in offsets]
+		candidate = data.find(b'\x1f\x8b\x08\x04', candidate + 1)
+	return list()
+
+def decompressBlock(block, check_crc = False):
+	""" Decompresses a block from readBlock().
+		Parameters
+		----------
+			block: bytes
+			check_crc: bool; default False
+				Whether to also check the CRC32 of the data, as when checking a file's
+				integrity. Otherwise only the size is checked, as in htslib.
+	"""
+	xlen = struct.unpack('<H', block[10:12])[0]
+	data = zlib.decompress(block[12 + xlen:-8], -15)
+	crc, isize = struct.unpack('<II', block[-8:])
+	if len(data) != isize or (check_crc and zlib.crc32(data) & 0xffffffff != crc):
+		raise ValueError("Corrupt BGZF block")
+	return data
+
+class BgzfReader:
+	""" Reads the uncompressed contents of a BGZF file.
+		Blocks are independent, so the blocks after the current one are read ahead and
+		decompressed by a pool of threads (zlib releases the GIL) while the current
+		block is being used.
+		Usage
+		-----
+			reader = BgzfReader(filename)
+			reader.seek(virtual_offset)
+			for line in reader:
+				...
+	"""
+	def __init__(self, filename, threads = None):
+		"""
+			Parameters
+			----------
+				filename: string [PATH]
+				threads: int; default None
+					The number of decompression threads. Defaults to the number of CPUs,
+					up to 4. If 0, each block is decompressed when it is needed.
+		"""
+		if threads is None:
+			threads = min(4, os.cpu_count() or 1)
+		self.filename = filename
+		self.file = open(filename, 'rb')
+		self._executor = ThreadPoolExecutor(max_workers = threads) if threads > 0 else None
+		self._max_pending = 4 * threads
+		# The address, size and decompressed data (or future) of each block read ahead.
+		self._pending = deque()
+		self._file_address = 0
+		self._block_address = 0
+		self._next_address = 0
+		self._buffer = b''
+		self._within = 0
+
+	def _readAhead(self):
+		while len(self._pending) <= self._max_pending:
+			block = readBlock(self.file)
+			if not block: break
+			if self._executor is None:
+				data = decompressBlock(block)
+			else:
+				data = self._executor.submit(decompressBlock, block)
+			self._pending.append((self._file_address, len(block), data))
+			self._file_address += len(block)
+
+	def _loadBlock(self, address = None):
+		""" Loads the block at `address`, or the next block. Returns False at the end of the file. """
+		if address is not None:
+			for _, _, data in self._pending:
+				if self._executor is not None: data.cancel()
+			self._pending.clear()
+			self.file.seek(address)
+			self._file_address = address
+		while True:
+			self._readAhead()
+			self._within = 0
+			if not self._pending:
+				self._block_address = self._next_address = self._file_address
+				self._buffer = b''
+				return False
+			self._block_address, size, data = self._pending.popleft()
+			self._next_address = self._block_address + size
+			self._buffer = data if self._executor is None else data.result()
+			# Skip empty blocks, such as the EOF marker.
+			if self._buffer:
+				return True
+
+	def seek(self, virtual_offset):
+		self._loadBlock(virtual_offset >> 16)
+		self._within = virtual_offset & 0xffff
+
+	def tell(self):
+		""" Returns the virtual file offset of the next byte. At the end of a block,
+			this is the start of the next block.
+		"""
+		if self._within >= len(self._buffer):
+			return self._next_address << 16
+		return (self._block_address << 16) | self._within
+
+	def read(self, size = -1):
+		pieces = list()
+		while size != 0:
+			if self._within >= len(self._buffer) and not self._loadBlock():
+				break
+			end = len(self._buffer) if size < 0 else min(len(self._buffer), self._within + size)
+			pieces.append(self._buffer[self._within:end])
+			if size > 0: size -= end - self._within
+			self._within = end
+		return b''.join(pieces)
+
+	def readline(self):
+		pieces = list()
+		while True:
+			if self._within >= len(self._buffer) and not self._loadBlock():
+				break
+			end = self._buffer.find(b'\n', self._within)
+			if end < 0:
+				pieces.append(self._buffer[self._within:])
+				self._within = len(self._buffer)
+			else:
+				pieces.append(self._buffer[self._within:end + 1])
+				self._within = end + 1
+				break
+		return b''.join(pieces)
+
+	def readinto(self, buffer):
+		""" Reads up to len(buffer) bytes from the current block into `buffer`. """
+		if self._within >= len(self._buffer) and not self._loadBlock():
+			return 0
+		size = min(len(buffer), len(self._buffer) - self._within)
+		buffer[:size] = self._buffer[self._within:self._within + size]
+		self._within += size
+		return size
+
+	def __iter__(self):
+		return iter(self.readline, b'')
+
+	def close(self):
+		self.file.close()
+		if self._executor is not None:
+			self._executor.shutdown(wait = False)
+			self._pending.clear()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+class BgzfRawReader(io.RawIOBase):
+	""" Wraps a BgzfReader as a raw stream, so it can be buffered with io.BufferedReader
+		and decoded with io.TextIOWrapper like a regular file.
+	"""
+	def __init__(self, reader):
+		self.reader = reader
+
+	@property
+	def name(self):
+		return self.reader.filename
+
+	def readable(self):
+		return True
+
+	def readinto(self, buffer):
+		return self.reader.readinto(buffer)
+
+	def close(self):
+		if not self.closed:
+			self.reader.close()
+		super().close()
+
+def compressBlock(data, level = 6):
+	""" Compresses up to BGZF_BLOCK_SIZE bytes into a single BGZF block. """
+	compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+	compressed = compressor.compress(data) + compressor.flush()
+	if len(compressed) + 26 > BGZF_MAX_BLOCK_SIZE:
+		# Incompressible data. Store it without compression instead.
+		compressor = zlib.compressobj(0, zlib.DEFLATED, -15)
+		compressed = compressor.compress(data) + compressor.flush()
+	header = struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, ord('B'), ord('C'), 2, len(compressed) + 25)
+	footer = struct.pack('<2I', zlib.crc32(data) & 0xffffffff, len(data))
+	return header + compressed + footer
+
+class BgzfWriter:
+	""" Writes a BGZF file. Blocks are compressed by a pool of threads (zlib releases
+		the GIL) and written in order.
+		Since a block is only written once it has been compressed, positions are
+		returned by tell() as (block number, offset within the block). resolve() converts
+		them to virtual file offsets once the block has been written.
+		Usage
+		-----
+			with BgzfWriter(filename) as writer:
+				writer.write(data)
+	"""
+	def __init__(self, filename, mode = 'wb', threads = None, level = 6):
+		"""
+			Parameters
+			----------
+				filename: string [PATH]
+				mode: {'wb', 'ab'}; default 'wb'
+					In append mode, blocks are added after the existing blocks.
+				threads: int; default None
+					The number of compression threads. Defaults to the number of CPUs,
+					up to 4. If 0, blocks are compressed as they are written.
+				level: int; default 6
+					The zlib compression level.
+		"""
+		if threads is None:
+			threads = min(4, os.cpu_count() or 1)
+		self.filename = filename
+		self.level = level
+		self.file = open(filename, mode)
+		self.file.seek(0, os.SEEK_END)
+		self._executor = ThreadPoolExecutor(max_workers = threads) if threads > 0 else None
+		self._max_pending = 4 * max(threads, 1)
+		self._pending = deque()
+		self._buffer = bytearray()
+		# The file offset of each written block, followed by the offset of the next block.
+		self._addresses = [self.file.tell()]
+		self.closed = False
+
+	def write(self, data):
+		self._buffer += data
+		while len(self._buffer) >= BGZF_BLOCK_SIZE:
+			self._submit(bytes(self._buffer[:BGZF_BLOCK_SIZE]))
+			del self._buffer[:BGZF_BLOCK_SIZE]
+		return len(data)
+
+	def _submit(self, data):
+		if self._executor is None:
+			self._writeBlock(compressBlock(data, self.level))
+			return
+		self._pending.append(self._executor.submit(compressBlock, data, self.level))
+		while len(self._pending) > self._max_pending or (self._pending and self._pending[0].done()):
+			self._writeBlock(self._pending.popleft().result())
+
+	def _writeBlock(self, block):
+		self.file.write(block)
+		self._addresses.append(self._addresses[-1] + len(block))
+
+	def writeBlock(self, block):
+		""" Ends the current block and copies an already-compressed block to the file as is. """
+		self.flush()
+		self._writeBlock(block)
+
+	def tell(self):
+		""" Returns the position of the next byte as (block number, offset within the block). """
+		return len(self._addresses) - 1 + len(self._pending), len(self._buffer)
+
+	def resolve(self, position):
+		""" Converts a position from tell() to a virtual file offset, or returns None if
+			its block has not been written yet.
+		"""
+		block, within = position
+		if block >= len(self._addresses):
+			return None
+		return (self._addresses[block] << 16) | within
+
+	def flush(self):
+		""" Compresses and writes any buffered data. The current block is ended early. """
+		if self._buffer:
+			self._submit(bytes(self._buffer))
+			self._buffer = bytearray()
+		while self._pending:
+			self._writeBlock(self._pending.popleft().result())
+		self.file.flush()
+
+	def close(self):
+		if self.closed: return
+		self.flush()
+		self.file.write(BGZF_EOF)
+		self.file.close()
+		if self._executor is not None:
+			self._executor.shutdown()
+		self.closed = True
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
@@ -0,0 +1,543 @@
+""" Merges sorted vcf files without GATK.
+	combineVariants() follows the rules of GATK CombineVariants: records at the same
+	position and of the same type (snp, indel) are merged into a single record, genotypes
+	are taken from the highest-priority file (PRIORITIZE) or kept for every file (UNIQUIFY),
+	the files each record was found in are annotated in the 'set' INFO field, and AC, AF and
+	AN are recalculated from the merged genotypes.
+	catVariants() replaces GATK CatVariants, interleaving the records of several files.
+"""
+import heapq
+import os
+
+from . import bgzf, scanner, tabix, vcfio
+
+GENOTYPE_MERGE_OPTIONS = ('PRIORITIZE', 'UNIQUIFY')
+FILTERED_RECORDS_MERGE_OPTIONS = ('KEEP_IF_ANY_UNFILTERED', 'KEEP_UNCONDITIONAL')
+SET_HEADER_LINE = '##INFO=<ID=set,Number=1,Type=String,Description="Source VCF for the merged record in CombineVariants">'
+# The INFO lines GATK adds for the chromosome counts of each merged record.
+CHROMOSOME_COUNT_HEADER_LINES = {
+	'AC': '##INFO=<ID=AC,Number=A,Type=Integer,Description="Allele count in genotypes, for each ALT allele, in the same order as listed">',
+	'AF': '##INFO=<ID=AF,Number=A,Type=Float,Description="Allele Frequency, for each ALT allele, in the same order as listed">',
+	'AN': '##INFO=<ID=AN,Number=1,Type=Integer,Description="Total number of alleles in called genotypes">'
+}
+
+class _Record:
+	""" The columns of a record, with the INFO field and the genotypes split by key. """
+	def __init__(self, line, samples):
+		fields = line.decode().rstrip('\r\n').split('\t')
+		self.chrom = fields[scanner.CHROM]
+		self.pos = fields[scanner.POS]
+		self.id = fields[scanner.ID]
+		self.ref = fields[scanner.REF]
+		self.alts = [] if fields[scanner.ALT] == '.' else fields[scanner.ALT].split(',')
+		self.qual = fields[scanner.QUAL]
+		self.filter = fields[scanner.FILTER]
+		self.info = list()
+		if fields[scanner.INFO] != '.':
+			for item in fields[scanner.INFO].split(';'):
+				key, _, value = item.partition('=')
+				self.info.append((key, value if _ else True))
+		self.variant_class = scanner.getVariantClass(fields[scanner.REF], fields[scanner.ALT], fields[scanner.INFO])
+
+		self.genotypes = dict()
+		if len(fields) > scanner.FORMAT:
+			keys = fields[scanner.FORMAT].split(':')
+			for sample, column in zip(samples, fields[scanner.FORMAT + 1:]):
+				self.genotypes[sample] = dict(zip(keys, column.split(':')))
+
+	@property
+	def is_filtered(self):
+		return self.filter not in ('.', 'PASS', '')
+
+def _readSamples(header):
+	columns = header[-1].split('\t')
+	return columns[scanner.FORMAT + 1:]
+
+def _iterRecords(filename, index, rank):
+	""" Yields the sort key, input index and raw line of each record of a sorted vcf file. """
+	previous = None
+	for line in scanner.iterRecordLines(filename):
+		chrom, pos = line.split(b'\t', 2)[:2]
+		key = (rank(chrom.decode()), int(pos))
+		if previous is not None and key < previous:
+			message = "{} is not sorted at {}:{}".format(filename, chrom.decode(), int(pos))
+			raise ValueError(message)
+		previous = key
+		yield key, index, line
+
+def _getHeaderLineKey(line):
+	""" Identifies structured header lines by their type and ID, so that each is only kept once. """
+	if line.startswith('##') and '=<' in line and 'ID=' in line:
+		kind = line[2:line.index('=<')]
+		identifier = line[line.index('ID=') + 3:].split(',', 1)[0].rstrip('>')
+		return kind, identifier
+	return line
+
+def mergeHeaders(headers, samples, set_key = 'set'):
+	""" Combines the header lines of several vcf files. Lines with the same type and ID
+		are only kept from the first header that has them. The '##fileformat' line comes
+		first, followed by the other lines in sorted order, with '##contig' lines kept in
+		their original order. If there are samples, the AC, AF and AN INFO lines are added.
+		Parameters
+		----------
+			headers: list<list<string>>
+				The headers from scanner.readHeader(), in priority order.
+			samples: list<string>
+				The sample columns of the merged file.
+			set_key: string; default 'set'
+				If not None, the INFO line for the 'set' annotation is added.
+	"""
+	fileformat = None
+	lines = dict()
+	contigs = list()
+	for header in headers:
+		for line in header[:-1]:
+			if line.startswith('##fileformat='):
+				fileformat = fileformat or line
+				continue
+			key = _getHeaderLineKey(line)
+			if key in lines: continue
+			lines[key] = line
+			if line.startswith('##contig='):
+				contigs.append(line)
+	if set_key is not None:
+		lines.setdefault(('INFO', set_key), SET_HEADER_LINE.replace('ID=set', 'ID=' + set_key))
+	if samples:
+		for key, line in CHROMOSOME_COUNT_HEADER_LINES.items():
+			lines.setdefault(('INFO', key), line)
+
+	sorted_lines = sorted(line for line in lines.values() if not line.startswith('##contig='))
+	position = len([line for line in sorted_lines if line < '##contig='])
+	sorted_lines[position:position] = contigs
+
+	columns = ['#CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER', 'INFO']
+	if samples:
+		columns += ['FORMAT'] + samples
+	header = [fileformat or '##fileformat=VCFv4.2'] + sorted_lines + ['\t'.join(columns)]
+	return header
+
+def _remapAlleles(record, ref):
+	""" Extends the alleles of a record to match a longer REF allele, as GATK does when
+		records with different REF alleles are merged.
+	"""
+	if record.ref == ref:
+		return list(record.alts)
+	if not ref.startswith(record.ref):
+		message = "Can't merge the REF alleles {} and {} at {}:{}".format(record.ref, ref, record.chrom, record.pos)
+		raise ValueError(message)
+	suffix = ref[len(record.ref):]
+	return [alt if alt.startswith('<') or alt == '*' else alt + suffix for alt in record.alts]
+
+def _remapGenotype(genotype, allele_map):
+	""" Renumbers the alleles of a GT field. """
+	alleles = genotype.replace('|', '/').split('/')
+	separators = [character for character in genotype if character in '/|']
+	renumbered = [allele if allele == '.' else str(allele_map[int(allele)]) for allele in alleles]
+	pieces = [renumbered[0]]
+	for separator, allele in zip(separators, renumbered[1:]):
+		pieces += [separator, allele]
+	return ''.join(pieces)
+
+def _formatQual(qual):
+	""" Formats QUAL with two decimals, dropping '.00', as GATK does. """
+	if qual is None:
+		return '.'
+	qual = "{:.2f}".format(float(qual))
+	return qual[:-3] if qual.endswith('.00') else qual
+
+def _formatFrequency(frequency):
+	""" Formats a float INFO value the same way as htsjdk. """
+	if frequency >= 1:
+		return "{:.2f}".format(frequency)
+	if frequency >= 0.01:
+		return "{:.3f}".format(frequency)
+	if abs(frequency) >= 1e-20:
+		# Java writes the exponent with at least two digits, as Python does.
+		return "{:.3e}".format(frequency)
+	return "0.00"
+
+def _setChromosomeCounts(info, alts, genotypes):
+	""" Recalculates AC, AF and AN from the merged genotypes, as GATK's calculateChromosomeCounts()
+		does. Values of these fields in the input records are replaced.
+	"""
+	called = list()
+	for genotype in genotypes:
+		alleles = genotype.get('GT', '.').replace('|', '/').split('/')
+		called += [int(allele) for allele in alleles if allele != '.']
+	info['AN'] = str(len(called))
+	if alts:
+		counts = [called.count(number) for number in range(1, len(alts) + 1)]
+		info['AC'] = ','.join(str(count) for count in counts)
+		if called:
+			info['AF'] = ','.join(_formatFrequency(count / len(called)) for count in counts)
+		else:
+			info['AF'] = '.'
+	else:
+		info.pop('AC', None)
+		info.pop('AF', None)
+
+def _formatGenotype(genotype, keys):
+	if genotype is None:
+		genotype = {'GT': './.'} if 'GT' in keys else dict()
+	values = [genotype.get(key, '.') or '.' for key in keys]
+	# Trailing missing values are dropped, as GATK does.
+	while len(values) > 1 and values[-1] == '.':
+		values.pop()
+	return ':'.join(values)
+
+def _mergeRecords(records, names, samples, genotype_merge, filtered_records_merge, set_key, n_inputs):
+	""" Merges the records found at the same position. `records` is a list of (input index, record)
+		tuples in priority order.
+	"""
+	first = records[0][1]
+	ref = max((record.ref for _, record in records), key = len)
+
+	alts = list()
+	ids = list()
+	info = dict()
+	inconsistent = set()
+	depth = 0
+	genotypes = dict()
+	best_qual = None
+	n_filtered = 0
+	filters = list()
+	filters_applied = False
+	sources = list()
+
+	for index, record in records:
+		record_alts = _remapAlleles(record, ref)
+		allele_map = {0: 0}
+		for number, alt in enumerate(record_alts, 1):
+			if alt not in alts:
+				alts.append(alt)
+			allele_map[number] = alts.index(alt) + 1
+
+		if record.id != '.' and record.id not in ids:
+			ids.append(record.id)
+		if record.qual != '.' and (best_qual is None or float(record.qual) > float(best_qual)):
+			best_qual = record.qual
+
+		if record.filter != '.':
+			filters_applied = True
+		if record.is_filtered:
+			n_filtered += 1
+			for name in record.filter.split(';'):
+				if name not in filters: filters.append(name)
+		if record.alts:
+			source = names[index]
+			source = 'filterIn' + source if record.is_filtered else source
+			if source not in sources: sources.append(source)
+
+		for key, value in record.info:
+			if key == 'DP' and value is not True and value.isdigit():
+				depth += int(value)
+			if key in inconsistent: continue
+			if key in info and info[key] != value and info[key] != '.':
+				inconsistent.add(key)
+				del info[key]
+			elif key not in info or info[key] == '.':
+				info[key] = value
+
+		for sample, genotype in record.genotypes.items():
+			if genotype_merge == 'UNIQUIFY':
+				sample = "{}.{}".format(sample, names[index])
+			if sample in genotypes: continue
+			genotype = dict(genotype)
+			if 'GT' in genotype:
+				genotype['GT'] = _remapGenotype(genotype['GT'], allele_map)
+			genotypes[sample] = genotype
+
+	# The depths of the merged records are added together.
+	if depth > 0:
+		info['DP'] = str(depth)
+	if samples:
+		_setChromosomeCounts(info, alts, genotypes.values())
+
+	if filtered_records_merge == 'KEEP_IF_ANY_UNFILTERED' and n_filtered != len(records):
+		filters = list()
+	if filters:
+		filter_column = ';'.join(sorted(filters))
+	else:
+		filter_column = 'PASS' if filters_applied else '.'
+
+	if set_key is not None:
+		if n_filtered == 0 and len(records) == n_inputs:
+			info[set_key] = 'Intersection'
+		elif n_filtered == len(records):
+			info[set_key] = 'FilteredInAll'
+		elif not sources:
+			info[set_key] = 'ReferenceInAll'
+		else:
+			info[set_key] = '-'.join(sources)
+
+	info_column = ';'.join(key if value is True else "{}={}".format(key, value) for key, value in sorted(info.items()))
+	columns = [
+		first.chrom, first.pos, ','.join(ids) or '.', ref, ','.join(alts) or '.',
+		_formatQual(best_qual), filter_column, info_column or '.'
+	]
+	if samples:
+		keys = sorted(set(key for genotype in genotypes.values() for key in genotype))
+		if 'GT' in keys:
+			keys.remove('GT')
+			keys.insert(0, 'GT')
+		columns.append(':'.join(keys) or 'GT')
+		columns += [_formatGenotype(genotypes.get(sample), keys) for sample in samples]
+	return '\t'.join(columns) + '\n'
+
+def combineVariants(variants, output_file, priority = None, genotype_merge = 'PRIORITIZE',
+		filtered_records_merge = 'KEEP_IF_ANY_UNFILTERED', set_key = 'set'):
+	""" Merges sorted vcf files in a single pass with a k-way merge, replacing
+		`java -jar GenomeAnalysisTK.jar -T CombineVariants`.
+		Parameters
+		----------
+			variants: dict<string, string>
+				The vcf file of each input, by name (the GATK ROD name, usually the caller).
+			output_file: string [PATH]
+				The merged file. It is bgzipped and indexed if it ends in '.gz'.
+			priority: list<string>; default None
+				The input names in priority order, as with '-priority'. Names that are not
+				in `variants` are ignored. Defaults to sorted order.
+			genotype_merge: {'PRIORITIZE', 'UNIQUIFY'}; default 'PRIORITIZE'
+				'PRIORITIZE' takes the genotype of each sample from the highest-priority file
+				that has it. 'UNIQUIFY' keeps the genotypes from every file, renaming each
+				sample to '{sample}.{name}'.
+			filtered_records_merge: {'KEEP_IF_ANY_UNFILTERED', 'KEEP_UNCONDITIONAL'}
+				'KEEP_IF_ANY_UNFILTERED' marks a merged record as PASS if any of its
+				records passed. 'KEEP_UNCONDITIONAL' keeps the filters of every record.
+			set_key: string; default 'set'
+				The INFO field listing the inputs of each merged record. If None,
+				it is not added.
+		Returns
+		-------
+			output_file: string
+		Raises
+		------
+			ValueError: If an input is not sorted, or is missing from `priority`.
+	"""
+	if genotype_merge not in GENOTYPE_MERGE_OPTIONS:
+		message = "Unsupported genotype merge option: '{}'. Expected one of {}".format(genotype_merge, GENOTYPE_MERGE_OPTIONS)
+		raise ValueError(message)
+	if filtered_records_merge not in FILTERED_RECORDS_MERGE_OPTIONS:
+		message = "Unsupported filtered records merge option: '{}'. Expected one of {}".format(
+			filtered_records_merge, FILTERED_RECORDS_MERGE_OPTIONS)
+		raise ValueError(message)
+
+	if priority is None:
+		names = sorted(variants)
+	else:
+		missing = [name for name in variants if name not in priority]
+		if missing:
+			message = "The priority list is missing the inputs {}".format(', '.join(missing))
+			raise ValueError(message)
+		names = [name for name in priority if name in variants]
+	filenames = [variants[name] for name in names]
+
+	headers = [scanner.readHeader(filename) for filename in filenames]
+	input_samples = [_readSamples(header) for header in headers]
+	if genotype_merge == 'UNIQUIFY':
+		samples = sorted("{}.{}".format(sample, name) for name, samples in zip(names, input_samples) for sample in samples)
+	else:
+		samples = sorted(set(sample for samples in input_samples for sample in samples))
+	header = mergeHeaders(headers, samples, set_key)
+
+	rank = scanner.ContigOrder(*filenames)
+	streams = [_iterRecords(filename, index, rank) for index, filename in enumerate(filenames)]
+
+	def writeMerged(records):
+		# Records of different types at the same position are merged separately.
+		groups = list()
+		for index, record in sorted(records, key = lambda i: i[0]):
+			for group in groups:
+				if group[0][1].variant_class == record.variant_class:
+					group.append((index, record))
+					break
+			else:
+				groups.append([(index, record)])
+		for group in groups:
+			output.write(_mergeRecords(group, names, samples, genotype_merge, filtered_records_merge, set_key, len(names)))
+
+	with vcfio.atomicOutput(output_file) as temporary_file, vcfio.openVcf(temporary_file, 'w') as output:
+		output.write('\n'.join(header) + '\n')
+		current_key = None
+		records = list()
+		for key, index, line in heapq.merge(*streams):
+			if key != current_key and records:
+				writeMerged(records)
+				records = list()
+			current_key = key
+			records.append((index, _Record(line, input_samples[index])))
+		if records:
+			writeMerged(records)
+
+	return output_file
+
+def _getRecordRange(filename, rank):
+	""" Returns the sort keys of the first and last records of a bgzipped vcf file, or None if
+		it has no records. The first record is read from the start of the file, and the last
+		from the blocks at the end of the file, so the blocks in between are never read.
+	"""
+	first = None
+	with bgzf.BgzfReader(filename, threads = 0) as reader:
+		for line in reader:
+			if not line.startswith(b'#') and line.strip():
+				first = line
+				break
+	if first is None:
+		return None
+
+	last = None
+	with open(filename, 'rb') as bgzf_file:
+		size = bgzf_file.seek(0, os.SEEK_END)
+		# The last line may start any number of blocks before the end, so the search
+		# is widened until a complete line is found.
+		window = 4 * bgzf.BGZF_MAX_BLOCK_SIZE
+		while last is None:
+			window_start = max(0, size - window)
+			offsets = bgzf.findBlocks(bgzf_file, window_start)
+			data = b''
+			for offset in reversed(offsets):
+				bgzf_file.seek(offset)
+				data = bgzf.decompressBlock(bgzf.readBlock(bgzf_file)) + data
+				# Only the lines after the first line break are known to be complete.
+				complete = data if offset == 0 else data[data.find(b'\n') + 1:] if b'\n' in data else b''
+				lines = [line for line in complete.split(b'\n') if line.strip() and not line.startswith(b'#')]
+				if lines:
+					last = lines[-1]
+					break
+			if window_start == 0:
+				last = last or first
+			window *= 4
+
+	def getKey(line):
+		chrom, pos = line.split(b'\t', 2)[:2]
+		return rank(chrom.decode()), int(pos)
+	return getKey(first), getKey(last)
+
+def _areDisjoint(filenames, rank):
+	""" Checks whether the records of the files can be concatenated in order, without interleaving. """
+	ranges = [_getRecordRange(filename, rank) for filename in filenames]
+	ranges = [i for i in ranges if i is not None]
+	return all(left[1] < right[0] for left, right in zip(ranges, ranges[1:]))
+
+def _readInputIndexes(filenames, kind):
+	""" Returns the index of each file, or None if any file doesn't have an up-to-date index
+		of this kind with the same binning scheme as the others.
+	"""
+	indexes = list()
+	for filename in filenames:
+		index_filename = "{}.{}".format(filename, kind)
+		if not os.path.isfile(index_filename) or os.path.getmtime(index_filename) < os.path.getmtime(filename):
+			return None
+		index = tabix.readIndex(index_filename)
+		if not index.names:
+			return None
+		if indexes and (index.min_shift, index.depth) != (indexes[0].min_shift, indexes[0].depth):
+			return None
+		indexes.append(index)
+	return indexes
+
+def _concatenateBlocks(filenames, header, output_file, indexes = None):
+	""" Writes a new header followed by the records of each bgzipped file. Only the block
+		where each header ends is recompressed; the other blocks are copied as they are.
+		Parameters
+		----------
+			indexes: list<tabix.VcfIndex>; default None
+				The index of each file. If given, they are combined into the index of the
+				output file, with the offsets moved to where each block was copied.
+		Returns
+		-------
+			index: tabix.VcfIndex
+				The index of the output file, or None if `indexes` wasn't given.
+	"""
+	output_index = None
+	if indexes is not None:
+		output_index = tabix.VcfIndex(indexes[0].kind, indexes[0].min_shift, indexes[0].depth)
+		output_index.n_no_coor = 0
+	with bgzf.BgzfWriter(output_file) as writer:
+		writer.write(('\n'.join(header) + '\n').encode())
+		for number, filename in enumerate(filenames):
+			with bgzf.BgzfReader(filename, threads = 0) as reader:
+				while True:
+					data_start = reader.tell()
+					line = reader.readline()
+					if not line.startswith(b'#'): break
+			first_address, skipped = data_start >> 16, data_start & 0xffff
+			writer.flush()
+			first_block = writer.tell()[0]
+			# The output address of each input block copied as it is.
+			addresses = dict()
+			with open(filename, 'rb') as bgzf_file:
+				bgzf_file.seek(first_address)
+				block = bgzf.readBlock(bgzf_file)
+				if block:
+					writer.write(bgzf.decompressBlock(block)[skipped:])
+				writer.flush()
+				while True:
+					address = bgzf_file.tell()
+					# Empty blocks aren't copied, so their offsets move to the next block.
+					addresses[address] = writer.resolve(writer.tell()) >> 16
+					block = bgzf.readBlock(bgzf_file)
+					if not block: break
+					if len(block) > len(bgzf.BGZF_EOF):
+						writer.writeBlock(block)
+
+			def convert(offset):
+				address, within = offset >> 16, offset & 0xffff
+				if address > first_address:
+					return (addresses[address] << 16) | within
+				# The rest of the first block was written again, and may have been split.
+				within = max(within - skipped, 0) if address == first_address else 0
+				return writer.resolve((first_block + within // bgzf.BGZF_BLOCK_SIZE, within % bgzf.BGZF_BLOCK_SIZE))
+
+			if output_index is not None:
+				tabix.appendIndex(output_index, indexes[number], convert)
+	return output_index
+
+def catVariants(filenames, output_file, index = 'tbi'):
+	""" Combines sorted vcf files with the same samples, such as the snp and indel files
+		of a callset, into a single sorted file. Replaces GATK CatVariants.
+		Records are interleaved by (contig, POS) with a streaming merge, using the contig order
+		from scanner.ContigOrder. The header lines of all files are combined.
+		If the output and every input are bgzipped and the files don't overlap, the compressed
+		blocks are copied without recompressing them. The indexes of the inputs are then
+		combined into the index of the output, if each input has one of the same kind.
+		Parameters
+		----------
+			filenames: list<string>
+			output_file: string [PATH]
+				The output is bgzipped and indexed if it ends in '.gz'.
+			index: {'tbi', 'csi', None}; default 'tbi'
+				The index to write for bgzipped output.
+		Returns
+		-------
+			output_file: string
+		Raises
+		------
+			ValueError: If an input is not sorted or the inputs have different samples.
+	"""
+	headers = [scanner.readHeader(filename) for filename in filenames]
+	samples = _readSamples(headers[0])
+	for filename, header in zip(filenames, headers):
+		if _readSamples(header) != samples:
+			message = "{} has different samples than {}".format(filename, filenames[0])
+			raise ValueError(message)
+	header = mergeHeaders(headers, samples, set_key = None)
+	rank = scanner.ContigOrder(*filenames)
+
+	if output_file.endswith('.gz') and all(bgzf.isBgzf(filename) for filename in filenames) and _areDisjoint(filenames, rank):
+		indexes = None if index is None else _readInputIndexes(filenames, index)
+		with vcfio.atomicOutput(output_file) as temporary_file:
+			output_index = _concatenateBlocks(filenames, header, temporary_file, indexes)
+			if output_index is not None:
+				tabix.writeIndex(output_index, "{}.{}".format(temporary_file, index))
+			elif index is not None:
+				vcfio.indexVcf(temporary_file, index)
+		return output_file
+
+	streams = [_iterRecords(filename, index_number, rank) for index_number, filename in enumerate(filenames)]
+	with vcfio.atomicOutput(output_file) as temporary_file, vcfio.openVcf(temporary_file, 'wb', index = index) as output:
+		output.write(('\n'.join(header) + '\n').encode())
+		for _, _, line in heapq.merge(*streams):
+			if not line.endswith(b'\n'): line += b'\n'
+			output.write(line)
+	return output_file
@@ -1,20 +1,49 @@
 
+import heapq
 import vcf
+from collections import namedtuple
 from pprint import pprint
+from . import scanner, vcfio
 
-def getVcfPositions(filename, chromosome = None):
+def _iterPyvcfPositions(filename, chromosome = None, start = None, end = None):
+	with vcfio.openVcf(filename, 'r') as vcf_file:
+		reader = vcf.Reader(vcf_file, compressed = False)
+		for record in reader:
+			if chromosome is not None and record.CHROM != chromosome: continue
+			if start is not None and record.end < start: continue
+			if end is not None and record.start >= end: continue
+			yield record.CHROM, record.POS, bool(record.FILTER)
+
+def getVcfPositions(filename, chromosome = None, backend = 'raw', start = None, end = None):
+	"""
+		Parameters
+		----------
+			filename: string [PATH]
+			chromosome: str; default None
+				If provided, only positions on this chromosome are returned. With the
+				'raw' backend, bgzipped files with a tabix or CSI index only read
+				the blocks containing the chromosome.
+			backend: {'raw', 'pyvcf'}; default 'raw'
+				'raw' reads the needed columns directly from each line, while 'pyvcf'
+				parses each record with PyVCF. Both return the same positions.
+			start, end: int; default None
+				The 1-based, inclusive bounds of a region of `chromosome` to limit the
+				positions to. Records overlapping the region are included.
+	"""
 
 	all_positions = list()
 	filtered_positions = list()
 
-	with open(filename, 'r') as vcf_file:
-		reader = vcf.Reader(vcf_file)
-		for record in reader:
-			if chromosome is None or record.CHROM == chromosome:
-				position = (record.CHROM, record.POS)
-				all_positions.append(position)
-				if record.FILTER:
-					filtered_positions.append(position)
+	if backend == 'raw':
+		positions = scanner.iterPositions(filename, chromosome, start, end)
+	else:
+		positions = _iterPyvcfPositions(filename, chromosome, start, end)
+
+	for chrom, pos, filtered in positions:
+		position = (chrom, pos)
+		all_positions.append(position)
+		if filtered:
+			filtered_positions.append(position)
 
 	result = {
 		'allPositions': all_positions,
@@ -23,17 +52,110 @@ def getVcfPositions(filename, chromosome = None):
 
 	return result
 
-def compare(left_vcf, right_vcf, chromosome = None):
+JoinedPosition = namedtuple('JoinedPosition', ['chrom', 'pos', 'status', 'left_filtered', 'right_filtered'])
+
+def _iterUniquePositions(filename, rank, chromosome = None, start = None, end = None):
+	""" Yields the sort key, chromosome, position and filter status of each distinct position
+		in a sorted vcf file. A position is filtered if any of its records are filtered.
 	"""
+	previous = None
+	for chrom, pos, filtered in scanner.iterPositions(filename, chromosome, start, end):
+		key = (rank(chrom), pos)
+		if previous is not None:
+			if key == previous[0]:
+				previous[3] = previous[3] or filtered
+				continue
+			if key < previous[0]:
+				message = "{} is not sorted: {}:{} comes after {}:{}".format(filename, chrom, pos, previous[1], previous[2])
+				raise scanner.UnsortedVcfError(message)
+			yield tuple(previous)
+		previous = [key, chrom, pos, filtered]
+	if previous is not None:
+		yield tuple(previous)
+
+def iterJoinedPositions(left_vcf, right_vcf, chromosome = None, start = None, end = None):
+	""" Walks two sorted vcf files in lockstep and yields each distinct position found in either file.
+		Only one record of each file is held in memory at a time. Both files must be sorted
+		by position within each contig, with their contigs in a compatible order. Files may
+		skip contigs, and don't need '##contig' header lines. See scanner.ContigOrder.
 		Parameters
 		----------
-			left_vcf, right_vcf: string
-				Paths t othe vcf files to compare.
-			chromosome: str; default None
-				If provided, the comparison will only be done over this chromosome.
+			left_vcf, right_vcf: string [PATH]
+			chromosome, start, end
+				Limits the comparison to a chromosome or region. See getVcfPositions().
+		Yields
+		------
+			position: JoinedPosition
+				* 'status': {'common', 'left', 'right'}
+				* 'left_filtered', 'right_filtered': bool
+					Whether the position is filtered in each file. Always False for the
+					file the position is missing from.
+		Raises
+		------
+			scanner.UnsortedVcfError: If a file is not sorted.
+	"""
+	rank = scanner.ContigOrder(left_vcf, right_vcf)
+	left = _iterUniquePositions(left_vcf, rank, chromosome, start, end)
+	right = _iterUniquePositions(right_vcf, rank, chromosome, start, end)
+	left_position = next(left, None)
+	right_position = next(right, None)
+	while left_position is not None or right_position is not None:
+		if right_position is None or (left_position is not None and left_position[0] < right_position[0]):
+			_, chrom, pos, filtered = left_position
+			yield JoinedPosition(chrom, pos, 'left', filtered, False)
+			left_position = next(left, None)
+		elif left_position is None or right_position[0] < left_position[0]:
+			_, chrom, pos, filtered = right_position
+			yield JoinedPosition(chrom, pos, 'right', False, filtered)
+			right_position = next(right, None)
+		else:
+			_, chrom, pos, left_filtered = left_position
+			yield JoinedPosition(chrom, pos, 'common', left_filtered, right_position[3])
+			left_position = next(left, None)
+			right_position = next(right, None)
+
+def comparePositions(left_vcf, right_vcf, chromosome = None, start = None, end = None):
+	""" Counts the common and unique positions of two sorted vcf files in a single pass.
+		See iterJoinedPositions().
+		Returns
+		-------
+			result: dict<string, int>
+				* 'common': Positions in both files.
+				* 'leftUnique', 'rightUnique': Positions in only one file.
+				* 'leftUniqueFiltered', 'rightUniqueFiltered': Unique positions that are filtered.
+				* 'commonLeftFiltered', 'commonRightFiltered': Common positions that are
+					filtered in each file.
+				* 'total': Positions in either file.
+	"""
+	result = {
+		'common': 0,
+		'leftUnique': 0,
+		'rightUnique': 0,
+		'leftUniqueFiltered': 0,
+		'rightUniqueFiltered': 0,
+		'commonLeftFiltered': 0,
+		'commonRightFiltered': 0
+	}
+	for position in iterJoinedPositions(left_vcf, right_vcf, chromosome, start, end):
+		if position.status == 'common':
+			result['common'] += 1
+			result['commonLeftFiltered'] += position.left_filtered
+			result['commonRightFiltered'] += position.right_filtered
+		elif position.status == 'left':
+			result['leftUnique'] += 1
+			result['leftUniqueFiltered'] += position.left_filtered
+		else:
+			result['rightUnique'] += 1
+			result['rightUniqueFiltered'] += position.right_filtered
+	result['total'] = result['common'] + result['leftUnique'] + result['rightUnique']
+	return result
+
+def _comparePositionSets(left_vcf, right_vcf, chromosome = None, start = None, end = None):
+	""" Same as comparePositions(), but holds the positions in memory, so the files don't
+		need to be sorted.
 	"""
-	left_positions = getVcfPositions(left_vcf, chromosome)
-	right_positions= getVcfPositions(right_vcf, chromosome)
+	left_positions = getVcfPositions(left_vcf, chromosome, start = start, end = end)
+	right_positions= getVcfPositions(right_vcf, chromosome, start = start, end = end)
 
 	all_left_positions = set(left_positions['allPositions'])
 	all_right_positions= set(right_positions['allPositions'])
@@ -42,22 +164,54 @@ def compare(left_vcf, right_vcf, chromosome = None):
 	filtered_right_positions= set(right_positions['filteredPositions'])
 
 	common_positions= all_left_positions & all_right_positions
+	unique_positions_left = all_left_positions - common_positions
+	unique_positions_right= all_right_positions - common_positions
 
-	unique_positions_left = sorted(all_left_positions - common_positions)
-	unique_positions_right= sorted(all_right_positions - common_positions)
+	result = {
+		'common': len(common_positions),
+		'leftUnique': len(unique_positions_left),
+		'rightUnique': len(unique_positions_right),
+		'leftUniqueFiltered': len(filtered_left_positions & unique_positions_left),
+		'rightUniqueFiltered': len(filtered_right_positions & unique_positions_right),
+		'commonLeftFiltered': len(filtered_left_positions & common_positions),
+		'commonRightFiltered': len(filtered_right_positions & common_positions),
+		'total': len(all_left_positions | all_right_positions)
+	}
+	return result
+
+def compare(left_vcf, right_vcf, chromosome = None, start = None, end = None):
+	"""
+		Parameters
+		----------
+			left_vcf, right_vcf: string
+				Paths t othe vcf files to compare.
+			chromosome: str; default None
+				If provided, the comparison will only be done over this chromosome.
+			start, end: int; default None
+				Limits the comparison to a region of `chromosome`. See getVcfPositions().
+		Returns
+		-------
+			result: dict<string, int>
+				The counts from comparePositions(). Sorted files are compared in a single
+				streaming pass; unsorted files are compared in memory.
+	"""
+	try:
+		result = comparePositions(left_vcf, right_vcf, chromosome, start, end)
+	except scanner.UnsortedVcfError:
+		result = _comparePositionSets(left_vcf, right_vcf, chromosome, start, end)
 
 	print("Unique positions in the left file: ")
-	print(len(unique_positions_left))
-	print(len(filtered_left_positions & set(unique_positions_left)))
+	print(result['leftUnique'])
+	print(result['leftUniqueFiltered'])
 
 	print("Unique positions in the right file: ")
-	print(len(unique_positions_right))
-	print(len(filtered_right_positions & set(unique_positions_right)))
+	print(result['rightUnique'])
+	print(result['rightUniqueFiltered'])
 
-	total_common_positions = len(common_positions)
-	total_unique_positions = len(set(unique_positions_left + unique_positions_right))
+	total_common_positions = result['common']
+	total_unique_positions = result['leftUnique'] + result['rightUnique']
 
-	total_positions = len(all_left_positions | all_right_positions)
+	total_positions = result['total']
 	ratio = total_common_positions / total_positions
 
 	print("Total Common: ", total_common_positions)
@@ -65,6 +219,85 @@ def compare(left_vcf, right_vcf, chromosome = None):
 	print("Total All: ", total_positions)
 	print("Ratio: ", ratio)
 
+	return result
+
+
+def _iterCallerKeys(filename, index, rank, chromosome, start, end):
+	for key, _, _, _ in _iterUniquePositions(filename, rank, chromosome, start, end):
+		yield key, index
+
+def concordance(callset, chromosome = None, start = None, end = None):
+	""" Compares the positions called by every caller in a callset in a single pass, using a
+		k-way merge over the sorted vcf files instead of comparing each pair of files.
+		Parameters
+		----------
+			callset: dict<string, string>
+				The vcf file of each caller, as returned by callertools.CallerClassifier.
+				Every file must be sorted. See iterJoinedPositions().
+			chromosome, start, end
+				Limits the comparison to a chromosome or region. See getVcfPositions().
+		Returns
+		-------
+			result: dict<>
+				* 'callers': list<string>
+					The callers, in sorted order.
+				* 'matrix': dict<string, dict<string, int>>
+					The number of positions called by both callers of each pair. The
+					diagonal is the number of positions called by each caller.
+				* 'unique': dict<string, int>
+					The number of positions only called by each caller.
+				* 'intersections': list<dict<>>
+					An UpSet-style table with a row for each combination of callers that called
+					at least one position. Each row has a bool column for every caller and
+					'count', the number of positions called by exactly those callers.
+					Sorted by decreasing count.
+				* 'total': int
+					The number of distinct positions.
+		Raises
+		------
+			scanner.UnsortedVcfError: If a file is not sorted.
+	"""
+	callers = sorted(callset)
+	rank = scanner.ContigOrder(*[callset[caller] for caller in callers])
+	streams = [_iterCallerKeys(callset[caller], index, rank, chromosome, start, end) for index, caller in enumerate(callers)]
+
+	# The number of positions called by each combination of callers, as a bitmask.
+	combinations = dict()
+	current_key = None
+	members = 0
+	for key, index in heapq.merge(*streams):
+		if key != current_key:
+			if members:
+				combinations[members] = combinations.get(members, 0) + 1
+			current_key = key
+			members = 0
+		members |= 1 << index
+	if members:
+		combinations[members] = combinations.get(members, 0) + 1
+
+	matrix = {left: {right: 0 for right in callers} for left in callers}
+	unique = {caller: 0 for caller in callers}
+	intersections = list()
+	for members, count in combinations.items():
+		called = [caller for index, caller in enumerate(callers) if members & (1 << index)]
+		for left in called:
+			for right in called:
+				matrix[left][right] += count
+		if len(called) == 1:
+			unique[called[0]] += count
+		row = {caller: caller in called for caller in callers}
+		row['count'] = count
+		intersections.append(row)
+	intersections.sort(key = lambda row: (-row['count'], [not row[caller] for caller in callers]))
+
+	result = {
+		'callers': callers,
+		'matrix': matrix,
+		'unique': unique,
+		'intersections': intersections,
+		'total': sum(combinations.values())
+	}
+	return result
 
 if __name__ == "__main__":
 	left_vcf = "C:\\Users\\Deitrickc\\Downloads\\Downloads\\8a9e7682-0071-441d-8cc1-3bf4b27305e9\\8a9e7682-0071-441d-8cc1-3bf4b27305e9.vcf"
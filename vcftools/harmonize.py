@@ -0,0 +1,132 @@
+""" Fixes the quirks in the output of individual callers, in the same way as SomaticSeq's
+	modify_VJSD.py (the vcf_modifier.modify_VarScan2 and modify_SomaticSniper modules),
+	without starting a new process for each file. Each harmonizer takes an iterable of
+	raw lines (bytes, including the header) and yields the fixed lines, so they can be
+	chained with the other line-based tools in this package.
+
+	The records are written as SomaticSeq writes them, except that blank lines are skipped
+	instead of ending the file, the QUAL column is not reformatted, and a sample without
+	an RD or AD value gets '.' for it. MuSE output is not modified by SomaticSeq, so it has
+	no harmonizer.
+"""
+import re
+
+from . import vcfio
+from .scanner import REF, ALT, FORMAT
+
+VARSCAN_DP4_HEADER = b'##FORMAT=<ID=DP4,Number=4,Type=Integer,Description="# high-quality ref-forward bases, ref-reverse, alt-forward and alt-reverse bases">'
+VARSCAN_AD_HEADER = b'##FORMAT=<ID=AD,Number=.,Type=Integer,Description="Allelic depths for the ref and alt alleles in the order listed">'
+
+def _fixVarscanHeader(line):
+	if line.startswith(b'##FORMAT=<ID=DP4,'):
+		line = VARSCAN_DP4_HEADER
+	elif line.startswith(b'##FORMAT=<ID=AD,'):
+		line = VARSCAN_AD_HEADER
+	return line
+
+def _fixVarscanAlleles(ref, alt):
+	""" Returns the REF and ALT columns of a VarScan2 record in a form vcf-validator accepts. """
+	alt = alt.replace(b'/', b',')
+	# VarScan2 indels may have several sequences in the REF column.
+	ref = re.sub(rb'[^\w].*$', b'', ref)
+	alt = re.sub(rb'[^\w,.]', b'', alt)
+	# Removes duplicated alleles.
+	alt = re.sub(rb'(\w+),\1', rb'\1', alt)
+	if b',' in alt:
+		alleles = alt.split(b',')
+		if ref in alleles:
+			alleles.remove(ref)
+			alt = b','.join(alleles)
+		# Removes the alleles that don't start with the reference. Indexes into the
+		# shrinking list the same way SomaticSeq does, so the same alleles are removed.
+		for index, allele in enumerate(alleles[1:], 1):
+			if not allele.startswith(ref) and index < len(alleles):
+				alleles.pop(index)
+				alt = b','.join(alleles)
+	return ref, alt
+
+def _mergeVarscanDepths(fields):
+	""" Replaces AD with 'RD,AD' in the first two samples and removes RD from the FORMAT column. """
+	keys = fields[FORMAT].split(b':')
+	if b'AD' not in keys or b'RD' not in keys:
+		return
+	ad_index = keys.index(b'AD')
+	rd_index = keys.index(b'RD')
+	keys.pop(rd_index)
+	fields[FORMAT] = b':'.join(keys)
+	for column in range(FORMAT + 1, min(FORMAT + 3, len(fields))):
+		values = fields[column].split(b':')
+		depths = [values[index] if index < len(values) else b'.' for index in (rd_index, ad_index)]
+		values[ad_index] = b','.join(depths)
+		values.pop(rd_index)
+		fields[column] = b':'.join(values)
+
+def harmonizeVarscan(lines):
+	""" Fixes VarScan2 output.
+		* The DP4 and AD FORMAT lines are replaced, so DP4 is declared as four integers.
+		* '/' separating the alleles in the ALT column is replaced with ','. Extra sequences
+		  in the REF column, duplicated alleles, and alleles matching or not starting with
+		  the reference are removed.
+		* AD is set to 'RD,AD' in the first two samples, and RD is removed.
+		* Records with bases other than 'GCTAU' in the REF column (e.g. 'M') are dropped.
+	"""
+	for line in lines:
+		line = line.rstrip()
+		if line.startswith(b'#'):
+			yield _fixVarscanHeader(line) + b'\n'
+			continue
+		elif not line:
+			continue
+		fields = line.split(b'\t')
+		if len(fields) <= FORMAT + 1:
+			message = "{}:{} has no sample columns.".format(fields[0].decode(), fields[1].decode())
+			raise ValueError(message)
+		fields[REF], fields[ALT] = _fixVarscanAlleles(fields[REF], fields[ALT])
+		_mergeVarscanDepths(fields)
+		if not re.search(rb'[^GCTAU]', fields[REF], re.I):
+			yield b'\t'.join(fields) + b'\n'
+
+def harmonizeSomaticSniper(lines):
+	""" Fixes SomaticSniper output. Bases other than 'GCTA' in the REF column, such as the
+		IUPAC ambiguity codes that come from the reference, are replaced with 'N'.
+	"""
+	for line in lines:
+		line = line.rstrip()
+		if line.startswith(b'#'):
+			yield line + b'\n'
+			continue
+		elif not line:
+			continue
+		fields = line.split(b'\t', REF + 1)
+		fields[REF] = re.sub(rb'[^GCTA]', b'N', fields[REF], flags = re.I)
+		yield b'\t'.join(fields) + b'\n'
+
+def getHarmonizer(caller):
+	""" Returns the harmonizer for a caller, or None if the caller's output doesn't need to be fixed.
+		Matches callers by name in the same way as vcftools.fixCallerOutputs().
+	"""
+	if 'varscan' in caller:
+		return harmonizeVarscan
+	elif 'somaticsniper' in caller:
+		return harmonizeSomaticSniper
+	return None
+
+def harmonizeVcf(caller, source, destination):
+	""" Fixes the output of a caller and saves it to a new file. The output of callers
+		without a harmonizer is copied as it is.
+		Parameters
+		----------
+			caller: string
+			source, destination: string [PATH]
+				Either may be plain or bgzipped. The destination is bgzipped and
+				indexed if it ends in '.gz'.
+		Returns
+		-------
+			destination: string
+	"""
+	harmonizer = getHarmonizer(caller)
+	with vcfio.openVcf(source, 'rb') as input_file, vcfio.openVcf(destination, 'wb') as output_file:
+		lines = input_file if harmonizer is None else harmonizer(input_file)
+		for line in lines:
+			output_file.write(line)
+	return destination
@@ -0,0 +1,315 @@
+""" Reads the columns of VCF records directly from the raw lines, without
+	building a PyVCF record for each line. Fields are returned as bytes.
+	Files may be plain or bgzipped.
+"""
+import heapq
+import re
+
+from . import bgzf, tabix, vcfio
+
+CHROM, POS, ID, REF, ALT, QUAL, FILTER, INFO, FORMAT = range(9)
+
+class UnsortedVcfError(ValueError):
+	""" Raised when vcf files can't be walked in a single sorted pass. Callers can catch
+		it to fall back to reading the records in any order.
+	"""
+
+def readHeader(filename):
+	""" Returns the header lines of a vcf file, including the '#CHROM' line. """
+	header = list()
+	with vcfio.openVcf(filename, 'r') as vcf_file:
+		for line in vcf_file:
+			if not line.startswith('#'): break
+			header.append(line.rstrip('\r\n'))
+	return header
+
+def getContigs(header):
+	""" Returns the IDs of the '##contig' lines of a header from readHeader(), in order. """
+	contigs = list()
+	for line in header:
+		if line.startswith('##contig=<'):
+			fields = line[len('##contig=<'):].rstrip('>').split(',')
+			for field in fields:
+				if field.startswith('ID='):
+					contigs.append(field[3:])
+					break
+	return contigs
+
+class ContigOrder:
+	""" Ranks contigs in an order that every file is sorted by.
+		The order of each file's contigs is taken from its index if it has one, from its
+		'##contig' lines if it has any, or from the order of its records otherwise. The
+		orders are then merged, so files that skip a contig the other files have can
+		still be walked together. Ties are broken by the order of the '##contig' lines,
+		then by the order contigs are first seen. Contigs that aren't in any of these
+		are ranked after the others, in the order they are first seen.
+		Raises
+		------
+			UnsortedVcfError: If a file's records aren't grouped by contig, or the files
+				have their contigs in different orders.
+	"""
+	def __init__(self, *filenames):
+		header_ranks = dict()
+		sequences = list()
+		for filename in filenames:
+			contigs = getContigs(readHeader(filename))
+			for contig in contigs:
+				header_ranks.setdefault(contig, len(header_ranks))
+			sequences.append(_getContigSequence(filename, contigs))
+		self.ranks = _mergeContigSequences(sequences, header_ranks, filenames)
+
+	def __call__(self, contig):
+		return self.ranks.setdefault(contig, len(self.ranks))
+
+def _getContigSequence(filename, header_contigs):
+	index_filename = tabix.findIndex(filename)
+	if index_filename is not None and bgzf.isBgzf(filename):
+		names = tabix.readIndex(index_filename).names
+		if names: return names
+	if header_contigs:
+		return header_contigs
+	return readContigSequence(filename)
+
+def readContigSequence(filename):
+	""" Returns the contigs of a vcf file in the order of its records.
+		Raises
+		------
+			ValueError: If the records of a contig are split up by records of another contig.
+	"""
+	contigs = list()
+	seen = set()
+	for line in iterRecordLines(filename):
+		chrom = line[:line.find(b'\t')]
+		if contigs and chrom == contigs[-1]: continue
+		if chrom in seen:
+			message = "{} is not sorted: the records of {} are not together.".format(filename, chrom.decode())
+			raise UnsortedVcfError(message)
+		seen.add(chrom)
+		contigs.append(chrom)
+	return [contig.decode() for contig in contigs]
+
+def _mergeContigSequences(sequences, header_ranks, filenames):
+	""" Topologically sorts the contigs so that each sequence keeps its order. """
+	first_seen = dict()
+	successors = dict()
+	predecessors = dict()
+	for sequence in sequences:
+		for contig in sequence:
+			if contig not in first_seen:
+				first_seen[contig] = len(first_seen)
+				successors[contig] = set()
+				predecessors[contig] = 0
+		for left, right in zip(sequence, sequence[1:]):
+			if left != right and right not in successors[left]:
+				successors[left].add(right)
+				predecessors[right] += 1
+
+	def getPriority(contig):
+		return header_ranks.get(contig, len(header_ranks)), first_seen[contig]
+
+	ready = [(getPriority(contig), contig) for contig, count in predecessors.items() if count == 0]
+	heapq.heapify(ready)
+	ranks = dict()
+	while ready:
+		_, contig = heapq.heappop(ready)
+		ranks[contig] = len(ranks)
+		for successor in successors[contig]:
+			predecessors[successor] -= 1
+			if predecessors[successor] == 0:
+				heapq.heappush(ready, (getPriority(successor), successor))
+	if len(ranks) != len(first_seen):
+		message = "The contigs of {} are not in a consistent order.".format(', '.join(filenames))
+		raise UnsortedVcfError(message)
+	return ranks
+
+def iterRecordLines(filename):
+	""" Yields the raw lines of each record in a vcf file, skipping the header and any blank lines.
+		The line terminator is included.
+	"""
+	with vcfio.openVcf(filename, 'rb') as vcf_file:
+		for line in vcf_file:
+			if not line.startswith(b'#'):
+				if line.strip(): yield line
+				break
+		for line in vcf_file:
+			if line.strip(): yield line
+
+def fetchRecordLines(filename, chrom, start = None, end = None):
+	""" Yields the raw lines of the records overlapping a region, in file order.
+		Bgzipped files with an up-to-date tabix or CSI index only read the blocks
+		that contain the region. Other files are read in full.
+		Parameters
+		----------
+			filename: string [PATH]
+			chrom: string
+			start, end: int; default None
+				The 1-based, inclusive positions of the region. Records overlap the region
+				if the span of their REF allele (or INFO/END) does, as in tabix.
+				If not provided, the region extends to the start or end of the chromosome.
+	"""
+	begin = None if start is None else start - 1
+	prefix = chrom.encode() + b'\t'
+
+	index_filename = tabix.findIndex(filename)
+	if index_filename is not None and bgzf.isBgzf(filename):
+		index = tabix.readIndex(index_filename)
+		lines = _iterChunkLines(filename, tabix.getRegionChunks(index, chrom, start, end))
+	else:
+		lines = iterRecordLines(filename)
+
+	for line in lines:
+		if not line.startswith(prefix): continue
+		if begin is not None or end is not None:
+			_, record_begin, record_end = vcfio.getRecordInterval(line)
+			if end is not None and record_begin >= end: continue
+			if begin is not None and record_end <= begin: continue
+		yield line
+
+def _iterChunkLines(filename, chunks):
+	""" Yields the lines starting within each (begin, end) range of virtual file offsets. """
+	if not chunks: return
+	with bgzf.BgzfReader(filename) as reader:
+		for chunk_begin, chunk_end in chunks:
+			reader.seek(chunk_begin)
+			while reader.tell() < chunk_end:
+				line = reader.readline()
+				if not line: break
+				if line.strip(): yield line
+
+def iterRecordFields(filename, maxsplit = 8):
+	""" Yields the tab-separated fields of each record in a vcf file.
+		Parameters
+		----------
+			filename: string [PATH]
+			maxsplit: int; default 8
+				Only the first `maxsplit` columns are split. The rest of the
+				line is left in the last field. Use 2 to read only CHROM and POS.
+		Yields
+		------
+			fields: list<bytes>
+	"""
+	for line in iterRecordLines(filename):
+		yield line.rstrip(b'\r\n').split(b'\t', maxsplit)
+
+def isFiltered(filter_field):
+	""" Matches the behavior of PyVCF, where record.FILTER is None for '.' and empty for 'PASS'. """
+	return filter_field not in (b'.', b'PASS', b'')
+
+def countRecords(filename):
+	""" Counts the number of records for each chromosome.
+		Returns
+		-------
+			counts: dict<string, int>
+	"""
+	counts = dict()
+	for line in iterRecordLines(filename):
+		chrom = line[:line.find(b'\t')]
+		counts[chrom] = counts.get(chrom, 0) + 1
+	return {chrom.decode(): count for chrom, count in counts.items()}
+
+def iterPositions(filename, chromosome = None, start = None, end = None):
+	""" Yields the position of each record.
+		Parameters
+		----------
+			filename: string [PATH]
+			chromosome: string; default None
+				If provided, only records on this chromosome are returned. Indexed files
+				only read the part of the file containing the chromosome.
+			start, end: int; default None
+				Limits the records to a region of the chromosome. See fetchRecordLines().
+		Yields
+		------
+			chrom, pos, filtered: string, int, bool
+	"""
+	if chromosome is None:
+		lines = iterRecordLines(filename)
+	else:
+		lines = fetchRecordLines(filename, chromosome, start, end)
+	chrom_bytes = chrom = None
+	for line in lines:
+		fields = line.rstrip(b'\r\n').split(b'\t', FILTER + 1)
+		if fields[CHROM] != chrom_bytes:
+			chrom_bytes = fields[CHROM]
+			chrom = chrom_bytes.decode()
+		yield chrom, int(fields[POS]), isFiltered(fields[FILTER])
+
+_BREAKEND_REGEX = re.compile(r'[\[\]]')
+
+def _isSubstitution(alt):
+	""" Whether PyVCF would parse an ALT allele as a substitution (SNV or MNV)
+		rather than a structural variant or breakend.
+	"""
+	if _BREAKEND_REGEX.search(alt):
+		return False
+	if len(alt) > 1 and (alt[0] == '.' or alt[-1] == '.'):
+		return False
+	if alt[0] == '<' and alt[-1] == '>':
+		return False
+	return True
+
+def _hasSvtype(info):
+	return any(field.split('=', 1)[0] == 'SVTYPE' for field in info.split(';'))
+
+def getVariantClass(ref, alt, info):
+	""" Classifies a record the same way as PyVCF's record.is_snp and record.is_indel.
+		Parameters
+		----------
+			ref, alt, info: string
+				The REF, ALT and INFO columns of the record.
+		Returns
+		-------
+			variant_class: {'snp', 'indel', None}
+	"""
+	alts = [None if i == '.' else i for i in alt.split(',')]
+	if len(ref) <= 1 and all(i is not None and len(i) == 1 and _isSubstitution(i) and i in 'ACGTN*' for i in alts):
+		return 'snp'
+
+	is_sv = _hasSvtype(info)
+	if len(ref) > 1 and not is_sv:
+		return 'indel'
+	for i in alts:
+		if i is None or not _isSubstitution(i):
+			return None
+		if len(i) != len(ref):
+			return None if is_sv else 'indel'
+	return None
+
+def hasSlashAllele(ref, alt):
+	""" Whether the REF or first ALT allele contains a '/', as in some VarScan records.
+		These records are removed by copyVcf().
+	"""
+	return '/' in alt.split(',', 1)[0] or '/' in ref
+
+def fixDp4Header(line):
+	""" Declares the VarScan DP4 FORMAT field as four integers instead of a single string.
+		Other header lines are returned unchanged.
+	"""
+	if line.startswith('##FORMAT=<ID=DP4,'):
+		line = re.sub('Number=[^,>]*', 'Number=4', line, count = 1)
+		line = re.sub('Type=[^,>]*', 'Type=Integer', line, count = 1)
+	return line
+
+def copyRecords(source, destination, fix_dp4 = False):
+	""" Copies a vcf file without parsing the records, removing records with a '/' in the
+		REF or first ALT allele. The remaining lines are copied verbatim.
+		Parameters
+		----------
+			source, destination: string [PATH]
+				The destination is bgzipped and indexed if it ends in '.gz'.
+			fix_dp4: bool; default False
+				Whether to rewrite the '##FORMAT=<ID=DP4' header line with fixDp4Header().
+		Returns
+		-------
+			destination: string
+	"""
+	with vcfio.openVcf(source, 'rb') as input_file, vcfio.openVcf(destination, 'wb') as output_file:
+		for line in input_file:
+			if line.startswith(b'#'):
+				if fix_dp4:
+					line = fixDp4Header(line.decode()).encode()
+				output_file.write(line)
+				continue
+			fields = line.split(b'\t', ALT + 2)
+			if len(fields) > ALT and not hasSlashAllele(fields[REF].decode(), fields[ALT].decode()):
+				output_file.write(line)
+	return destination
@@ -0,0 +1,435 @@
+""" Reads and writes the tabix (.tbi) and CSI (.csi) indexes of bgzipped VCF files. """
+import gzip
+import os
+import struct
+
+from . import bgzf
+
+# The bin tabix uses to store the file offsets and record counts of each reference.
+TABIX_PSEUDO_BIN = 37450
+
+class ReferenceIndex:
+	""" The index of a single reference sequence.
+		Attributes
+		----------
+			bins: dict<int, list<tuple<int,int>>>
+				The chunks of virtual file offsets stored in each bin.
+			loffsets: dict<int, int>
+				CSI only. The smallest virtual file offset of the records overlapping each bin.
+			linear: list<int>
+				The smallest virtual file offset of the records overlapping each
+				16kbp window. CSI indexes only have it while they are being built.
+			begin, end: int
+				The virtual file offsets of the first and last records of the reference.
+				None if the index does not include the pseudo-bin.
+			n_mapped, n_unmapped: int
+				The number of records on the reference.
+				None if the index does not include the pseudo-bin.
+	"""
+	def __init__(self):
+		self.bins = dict()
+		self.loffsets = dict()
+		self.linear = list()
+		self.begin = self.end = None
+		self.n_mapped = self.n_unmapped = None
+
+class VcfIndex:
+	""" The contents of a tabix or CSI index.
+		Attributes
+		----------
+			names: list<string>
+				The name of each reference sequence, in index order.
+			references: list<ReferenceIndex>
+			min_shift, depth: int
+				The parameters of the binning scheme.
+			n_no_coor: int
+				The number of records without coordinates, if recorded.
+	"""
+	def __init__(self, kind, min_shift = 14, depth = 5):
+		self.kind = kind
+		self.min_shift = min_shift
+		self.depth = depth
+		self.names = list()
+		self.references = list()
+		self.n_no_coor = None
+		self.format = 2
+		self.col_seq, self.col_beg, self.col_end = 1, 2, 0
+		self.meta = '#'
+		self.skip = 0
+
+	@property
+	def pseudo_bin(self):
+		if self.kind == 'tbi':
+			return TABIX_PSEUDO_BIN
+		return ((1 << ((self.depth + 1) * 3)) - 1) // 7 + 1
+
+	def getCounts(self):
+		""" Returns the number of records on each reference, or None if the index
+			does not record the counts or the names of the references, as in CSI
+			indexes without tabix metadata.
+		"""
+		if self.references and len(self.names) != len(self.references):
+			return None
+		counts = dict()
+		for name, reference in zip(self.names, self.references):
+			if reference.n_mapped is None:
+				if reference.bins: return None
+				continue
+			counts[name] = reference.n_mapped + reference.n_unmapped
+		return counts
+
+class _Buffer:
+	def __init__(self, data):
+		self.data = data
+		self.offset = 0
+
+	def unpack(self, fmt):
+		values = struct.unpack_from(fmt, self.data, self.offset)
+		self.offset += struct.calcsize(fmt)
+		return values
+
+	def read(self, size):
+		data = self.data[self.offset:self.offset + size]
+		self.offset += size
+		return data
+
+	@property
+	def remaining(self):
+		return len(self.data) - self.offset
+
+def _readTabixHeader(buffer, index):
+	index.format, index.col_seq, index.col_beg, index.col_end, meta, index.skip, l_nm = buffer.unpack('<7i')
+	index.meta = chr(meta)
+	index.names = [name.decode() for name in buffer.read(l_nm).split(b'\x00')[:-1]]
+
+def _readReference(buffer, index):
+	reference = ReferenceIndex()
+	n_bin = buffer.unpack('<i')[0]
+	for _ in range(n_bin):
+		if index.kind == 'csi':
+			bin_number, loffset, n_chunk = buffer.unpack('<IQi')
+		else:
+			bin_number, n_chunk = buffer.unpack('<Ii')
+			loffset = None
+		chunks = [buffer.unpack('<QQ') for _ in range(n_chunk)]
+		if bin_number == index.pseudo_bin:
+			(reference.begin, reference.end), (reference.n_mapped, reference.n_unmapped) = chunks
+		else:
+			reference.bins[bin_number] = chunks
+			if loffset is not None:
+				reference.loffsets[bin_number] = loffset
+	if index.kind == 'tbi':
+		n_intv = buffer.unpack('<i')[0]
+		reference.linear = list(buffer.unpack('<{0}Q'.format(n_intv)))
+	return reference
+
+def readIndex(filename):
+	""" Reads a .tbi or .csi index.
+		Returns
+		-------
+			index: VcfIndex
+	"""
+	with gzip.open(filename, 'rb') as index_file:
+		buffer = _Buffer(index_file.read())
+
+	magic = buffer.read(4)
+	if magic == b'TBI\x01':
+		index = VcfIndex('tbi')
+		n_ref = buffer.unpack('<i')[0]
+		_readTabixHeader(buffer, index)
+	elif magic == b'CSI\x01':
+		min_shift, depth, l_aux = buffer.unpack('<3i')
+		index = VcfIndex('csi', min_shift, depth)
+		aux = _Buffer(buffer.read(l_aux))
+		if l_aux >= 28:
+			_readTabixHeader(aux, index)
+		n_ref = buffer.unpack('<i')[0]
+	else:
+		message = "Not a tabix or CSI index: {}".format(filename)
+		raise ValueError(message)
+
+	index.references = [_readReference(buffer, index) for _ in range(n_ref)]
+	if buffer.remaining >= 8:
+		index.n_no_coor = buffer.unpack('<Q')[0]
+	return index
+
+def getReferenceRange(reference):
+	""" Returns the virtual file offsets of the first record and the end of the last
+		record of a reference, using the pseudo-bin if it is available.
+	"""
+	if reference.begin is not None:
+		return reference.begin, reference.end
+	chunks = [chunk for chunks in reference.bins.values() for chunk in chunks]
+	return min(i[0] for i in chunks), max(i[1] for i in chunks)
+
+def bin2interval(bin_number, min_shift = 14, depth = 5):
+	""" Returns the 0-based, half-open interval [begin, end) covered by a bin. """
+	level = 0
+	while bin_number >= ((1 << ((level + 1) * 3)) - 1) // 7:
+		level += 1
+	shift = min_shift + (depth - level) * 3
+	begin = (bin_number - ((1 << (level * 3)) - 1) // 7) << shift
+	return begin, begin + (1 << shift)
+
+def _getMinimumOffset(reference, index, begin):
+	""" The smallest virtual file offset of the records that could overlap `begin`. """
+	if index.kind == 'tbi':
+		if not reference.linear:
+			return 0
+		return reference.linear[min(begin >> index.min_shift, len(reference.linear) - 1)]
+	# CSI indexes store the offset per bin instead. Use the smallest bin containing `begin`.
+	bin_number = ((1 << (index.depth * 3)) - 1) // 7 + (begin >> index.min_shift)
+	while bin_number > 0 and bin_number not in reference.loffsets:
+		bin_number = (bin_number - 1) >> 3
+	return reference.loffsets.get(bin_number, 0)
+
+def getRegionChunks(index, chrom, start = None, end = None):
+	""" Returns the ranges of virtual file offsets that contain the records overlapping a region.
+		The ranges may also contain records outside of the region, which the caller has to skip.
+		Parameters
+		----------
+			index: VcfIndex
+			chrom: string
+			start, end: int; default None
+				The 1-based, inclusive positions of the region. If both are None,
+				the whole chromosome is returned.
+		Returns
+		-------
+			chunks: list<tuple<int, int>>
+				Sorted, non-overlapping (begin, end) virtual file offsets.
+	"""
+	if chrom not in index.names:
+		return list()
+	reference = index.references[index.names.index(chrom)]
+	if not reference.bins:
+		return list()
+	if start is None and end is None:
+		return [getReferenceRange(reference)]
+
+	begin = 0 if start is None else max(start - 1, 0)
+	stop = 1 << (index.min_shift + index.depth * 3) if end is None else end
+	if begin >= stop:
+		return list()
+	minimum_offset = _getMinimumOffset(reference, index, begin)
+	chunks = list()
+	# Only check the bins in the index. Listing every bin of a large region would take
+	# millions of steps for deep CSI indexes.
+	for bin_number, bin_chunks in reference.bins.items():
+		bin_begin, bin_end = bin2interval(bin_number, index.min_shift, index.depth)
+		if bin_begin < stop and bin_end > begin:
+			chunks += [chunk for chunk in bin_chunks if chunk[1] > minimum_offset]
+
+	merged = list()
+	for chunk_begin, chunk_end in sorted(chunks):
+		chunk_begin = max(chunk_begin, minimum_offset)
+		if merged and chunk_begin <= merged[-1][1]:
+			merged[-1] = (merged[-1][0], max(merged[-1][1], chunk_end))
+		else:
+			merged.append((chunk_begin, chunk_end))
+	return merged
+
+def findIndex(filename):
+	""" Returns the path to the index of a bgzipped vcf file, or None if there
+		is no index or the index is older than the file.
+	"""
+	for index_filename in [filename + '.tbi', filename + '.csi']:
+		if os.path.isfile(index_filename) and os.path.getmtime(index_filename) >= os.path.getmtime(filename):
+			return index_filename
+
+def appendIndex(target, index, convert):
+	""" Adds the records of an index to `target`, for a file whose records were copied to the
+		end of the file `target` indexes. Used to index concatenated files without reading them.
+		Parameters
+		----------
+			target, index: VcfIndex
+				Both must use the same kind of index and binning scheme.
+			convert: function
+				Converts a virtual file offset of the copied file into the new file.
+	"""
+	if not target.names:
+		target.format, target.col_seq, target.col_beg, target.col_end = index.format, index.col_seq, index.col_beg, index.col_end
+		target.meta, target.skip = index.meta, index.skip
+	for name, reference in zip(index.names, index.references):
+		if not reference.bins: continue
+		if name in target.names:
+			combined = target.references[target.names.index(name)]
+		else:
+			target.names.append(name)
+			combined = ReferenceIndex()
+			combined.begin = convert(reference.begin) if reference.begin is not None else None
+			combined.n_mapped = combined.n_unmapped = 0
+			target.references.append(combined)
+		for bin_number, chunks in reference.bins.items():
+			combined.bins.setdefault(bin_number, list()).extend((convert(begin), convert(end)) for begin, end in chunks)
+		# The records copied earlier come first, so their offsets are smaller.
+		for bin_number, loffset in reference.loffsets.items():
+			combined.loffsets.setdefault(bin_number, convert(loffset))
+		combined.linear += [convert(offset) for offset in reference.linear[len(combined.linear):]]
+		if reference.begin is None or combined.n_mapped is None:
+			combined.begin = combined.end = combined.n_mapped = combined.n_unmapped = None
+		else:
+			combined.end = convert(reference.end)
+			combined.n_mapped += reference.n_mapped
+			combined.n_unmapped += reference.n_unmapped
+	if target.n_no_coor is not None and index.n_no_coor is not None:
+		target.n_no_coor += index.n_no_coor
+	else:
+		target.n_no_coor = None
+
+def reg2bin(begin, end, min_shift = 14, depth = 5):
+	""" Returns the smallest bin containing the 0-based, half-open interval [begin, end). """
+	end -= 1
+	level = depth
+	shift = min_shift
+	offset = ((1 << (depth * 3)) - 1) // 7
+	while level > 0:
+		if begin >> shift == end >> shift:
+			return offset + (begin >> shift)
+		level -= 1
+		shift += 3
+		offset -= 1 << (level * 3)
+	return 0
+
+class IndexBuilder:
+	""" Builds a tabix or CSI index from the records of a bgzipped vcf file, in file order.
+		If the records are not sorted, `sorted` is set to False and build() raises a ValueError.
+		Usage
+		-----
+			builder = IndexBuilder('tbi')
+			for each record:
+				builder.add(chrom, begin, end, start_offset, end_offset)
+			writeIndex(builder.build(), filename + '.tbi')
+	"""
+	def __init__(self, kind = 'tbi', min_shift = 14, depth = 5):
+		self.index = VcfIndex(kind, min_shift, depth)
+		self.index.n_no_coor = 0
+		self.sorted = True
+		self._reference = None
+		self._last_begin = -1
+		self._last_bin = None
+
+	def add(self, chrom, begin, end, start_offset, end_offset):
+		""" Adds a record.
+			Parameters
+			----------
+				chrom: string
+				begin, end: int
+					The 0-based, half-open interval covered by the record.
+				start_offset, end_offset: int
+					The virtual file offsets of the start and end of the record.
+		"""
+		if not self.sorted: return
+		index = self.index
+		if self._reference is None or chrom != index.names[-1]:
+			if chrom in index.names:
+				self.sorted = False
+				return
+			index.names.append(chrom)
+			self._reference = ReferenceIndex()
+			self._reference.begin = start_offset
+			self._reference.n_mapped = self._reference.n_unmapped = 0
+			index.references.append(self._reference)
+			self._last_begin = -1
+			self._last_bin = None
+		elif begin < self._last_begin:
+			self.sorted = False
+			return
+		if end > 1 << (index.min_shift + index.depth * 3):
+			message = "Position {}:{} is too large for this index. Use a CSI index with a larger depth.".format(chrom, end)
+			raise ValueError(message)
+		self._last_begin = begin
+
+		reference = self._reference
+		bin_number = reg2bin(begin, max(end, begin + 1), index.min_shift, index.depth)
+		if bin_number == self._last_bin:
+			reference.bins[bin_number][-1][1] = end_offset
+		else:
+			reference.bins.setdefault(bin_number, list()).append([start_offset, end_offset])
+			self._last_bin = bin_number
+
+		# CSI indexes don't store the linear index, but their bin offsets are taken from it.
+		first_window = begin >> index.min_shift
+		last_window = (max(end, begin + 1) - 1) >> index.min_shift
+		if len(reference.linear) <= last_window:
+			reference.linear += [None] * (last_window + 1 - len(reference.linear))
+		for window in range(first_window, last_window + 1):
+			if reference.linear[window] is None:
+				reference.linear[window] = start_offset
+
+		reference.end = end_offset
+		reference.n_mapped += 1
+
+	def build(self):
+		""" Returns the finished VcfIndex. """
+		if not self.sorted:
+			raise ValueError("The records are not sorted, so the file cannot be indexed.")
+		for reference in self.index.references:
+			for bin_number, chunks in reference.bins.items():
+				# Merge chunks that end and start in the same compressed block.
+				merged = [chunks[0]]
+				for chunk in chunks[1:]:
+					if chunk[0] >> 16 <= merged[-1][1] >> 16:
+						merged[-1][1] = max(merged[-1][1], chunk[1])
+					else:
+						merged.append(chunk)
+				reference.bins[bin_number] = [tuple(chunk) for chunk in merged]
+			# Windows without records point to the previous record.
+			previous = reference.begin
+			for window, offset in enumerate(reference.linear):
+				if offset is None:
+					reference.linear[window] = previous
+				else:
+					previous = offset
+			if self.index.kind == 'csi':
+				reference.loffsets = {bin_number: self._getBinOffset(reference, bin_number) for bin_number in reference.bins}
+		return self.index
+
+	def _getBinOffset(self, reference, bin_number):
+		""" Returns the loffset of a CSI bin, the same way as htslib: the linear index of the
+			first window the bin covers. This is the smallest offset of every record overlapping
+			the bin, including long records stored in its parent bins. Bins past the last window
+			get 0, so no chunks are skipped.
+		"""
+		first_window = bin2interval(bin_number, self.index.min_shift, self.index.depth)[0] >> self.index.min_shift
+		if first_window < len(reference.linear):
+			return reference.linear[first_window]
+		return 0
+
+def _packTabixHeader(index):
+	names = b''.join(name.encode() + b'\x00' for name in index.names)
+	header = struct.pack('<7i', index.format, index.col_seq, index.col_beg, index.col_end, ord(index.meta), index.skip, len(names))
+	return header + names
+
+def _packReference(reference, index):
+	bins = sorted(reference.bins.items())
+	pieces = [struct.pack('<i', len(bins) + (reference.begin is not None))]
+	for bin_number, chunks in bins:
+		if index.kind == 'csi':
+			pieces.append(struct.pack('<IQi', bin_number, reference.loffsets[bin_number], len(chunks)))
+		else:
+			pieces.append(struct.pack('<Ii', bin_number, len(chunks)))
+		pieces += [struct.pack('<QQ', *chunk) for chunk in chunks]
+	if reference.begin is not None:
+		if index.kind == 'csi':
+			pieces.append(struct.pack('<IQi', index.pseudo_bin, 0, 2))
+		else:
+			pieces.append(struct.pack('<Ii', index.pseudo_bin, 2))
+		pieces.append(struct.pack('<4Q', reference.begin, reference.end, reference.n_mapped, reference.n_unmapped))
+	if index.kind == 'tbi':
+		pieces.append(struct.pack('<i{0}Q'.format(len(reference.linear)), len(reference.linear), *reference.linear))
+	return b''.join(pieces)
+
+def writeIndex(index, filename):
+	""" Writes a VcfIndex as a .tbi or .csi file, depending on `index.kind`. """
+	if index.kind == 'tbi':
+		pieces = [b'TBI\x01', struct.pack('<i', len(index.names)), _packTabixHeader(index)]
+	else:
+		aux = _packTabixHeader(index)
+		pieces = [b'CSI\x01', struct.pack('<3i', index.min_shift, index.depth, len(aux)), aux, struct.pack('<i', len(index.references))]
+	pieces += [_packReference(reference, index) for reference in index.references]
+	if index.n_no_coor is not None:
+		pieces.append(struct.pack('<Q', index.n_no_coor))
+
+	with bgzf.BgzfWriter(filename, threads = 0) as index_file:
+		index_file.write(b''.join(pieces))
+	return filename
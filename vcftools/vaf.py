@@ -0,0 +1,236 @@
+""" Calculates the variant allele frequency of the TUMOR sample for chunks of raw vcf
+	records at once, with the same results as callertools.GATKMergeSampleCallsets._getVAF().
+	The TUMOR column is found once from the header. Records are then grouped by the
+	field the VAF is calculated from, and each group is converted with NumPy.
+"""
+import itertools
+import numpy
+
+from . import scanner, vcfio
+from .scanner import REF, INFO, FORMAT
+
+# The fields used by _getVAF(), in the order they are checked for in the INFO column.
+FREQ, DEPTH, AF, DP4, TIERS = 'FREQ', 'DP/AD', 'AF', 'DP4', 'tiers'
+_BASES = (b'A', b'C', b'G', b'T')
+VAF_HEADER = '##INFO=<ID=VAF,Number=1,Type=Float,Description="Variant allele frequency of the TUMOR sample">'
+
+def _getMethod(info):
+	""" Returns the field _getVAF() would use for a record, based on the keys of its INFO column. """
+	keys = set(item.partition(b'=')[0] for item in info.split(b';'))
+	if b'FREQ' in keys:
+		return FREQ
+	elif b'DP' in keys and b'AD' in keys:
+		return DEPTH
+	elif b'AF' in keys:
+		return AF
+	elif b'DP4' in keys:
+		return DP4
+	return TIERS
+
+class VafEngine:
+	""" Calculates the VAF of the TUMOR sample of raw record lines.
+		Usage
+		-----
+			engine = VafEngine.fromFile(filename)
+			for lines, vafs in engine.iterChunks(scanner.iterRecordLines(filename)):
+				...
+	"""
+	def __init__(self, header, sample = 'TUMOR'):
+		"""
+			Parameters
+			----------
+				header: list<string>
+					The header lines, as returned by scanner.readHeader().
+				sample: string; default 'TUMOR'
+			Raises
+			------
+				ValueError: If the header doesn't have a column for the sample.
+		"""
+		columns = header[-1].split('\t')
+		if not columns[0].startswith('#CHROM') or sample not in columns[FORMAT + 1:]:
+			message = "The header does not have a '{}' sample column.".format(sample)
+			raise ValueError(message)
+		self.sample_column = columns.index(sample, FORMAT + 1)
+		# The position of each key in a FORMAT column, for each FORMAT column seen so far.
+		self._formats = dict()
+
+	@classmethod
+	def fromFile(cls, filename, sample = 'TUMOR'):
+		return cls(scanner.readHeader(filename), sample)
+
+	def _getSampleValues(self, fields):
+		keys = self._formats.get(fields[FORMAT])
+		if keys is None:
+			keys = {key: index for index, key in enumerate(fields[FORMAT].split(b':'))}
+			self._formats[fields[FORMAT]] = keys
+		values = fields[self.sample_column].split(b':')
+		return keys, values
+
+	def _getValue(self, fields, key):
+		keys, values = self._getSampleValues(fields)
+		index = keys.get(key)
+		if index is None or index >= len(values) or values[index] in (b'', b'.'):
+			message = "{}:{} has no {} value for the TUMOR sample.".format(fields[0].decode(), fields[1].decode(), key.decode())
+			raise ValueError(message)
+		return values[index]
+
+	def compute(self, lines):
+		""" Calculates the VAF of a chunk of raw record lines.
+			Parameters
+			----------
+				lines: list<bytes>
+			Returns
+			-------
+				vafs: numpy.ndarray<float>
+					The VAF of each record. Like _getVAF(), 'FREQ', 'DP/AD' and the
+					tier counts give a percentage, while 'AF' and 'DP4' give a fraction.
+			Raises
+			------
+				ZeroDivisionError: If a record has no reads, for the methods where _getVAF() would raise.
+		"""
+		groups = {FREQ: [], DEPTH: [], AF: [], DP4: [], TIERS: []}
+		records = list()
+		for index, line in enumerate(lines):
+			fields = line.rstrip(b'\r\n').split(b'\t')
+			records.append(fields)
+			groups[_getMethod(fields[INFO])].append(index)
+
+		vafs = numpy.zeros(len(records))
+		if groups[FREQ]:
+			vafs[groups[FREQ]] = [float(self._getValue(records[i], b'FREQ')[:-1]) for i in groups[FREQ]]
+		if groups[DEPTH]:
+			reads = numpy.array([int(self._getValue(records[i], b'DP')) for i in groups[DEPTH]])
+			alleles = numpy.array([int(self._getValue(records[i], b'AD').split(b',')[1]) for i in groups[DEPTH]])
+			vafs[groups[DEPTH]] = _divide(alleles, reads) * 100
+		if groups[AF]:
+			vafs[groups[AF]] = [float(self._getValue(records[i], b'AF').split(b',')[0]) for i in groups[AF]]
+		if groups[DP4]:
+			counts = numpy.array([self._getValue(records[i], b'DP4').split(b',') for i in groups[DP4]], dtype = int)
+			vafs[groups[DP4]] = _divide(counts[:, 2:].sum(axis = 1), counts.sum(axis = 1))
+		if groups[TIERS]:
+			vafs[groups[TIERS]] = self._computeTiers([records[i] for i in groups[TIERS]])
+		return vafs
+
+	def _computeTiers(self, records):
+		# The second tier of the AU, CU, GU and TU counts.
+		counts = numpy.zeros((len(records), len(_BASES)), dtype = int)
+		reference = numpy.zeros(len(records), dtype = int)
+		for row, fields in enumerate(records):
+			if fields[REF] not in _BASES:
+				message = "{}:{} has no tier counts for the reference allele '{}'.".format(fields[0].decode(), fields[1].decode(), fields[REF].decode())
+				raise ValueError(message)
+			reference[row] = _BASES.index(fields[REF])
+			for column, base in enumerate(_BASES):
+				counts[row, column] = int(self._getValue(fields, base + b'U').split(b',')[1])
+		reads = counts.sum(axis = 1)
+		alleles = reads - counts[numpy.arange(len(records)), reference]
+		vafs = numpy.zeros(len(records))
+		covered = reads != 0
+		vafs[covered] = alleles[covered] / reads[covered]
+		return vafs
+
+	def iterChunks(self, lines, chunk_size = 10000):
+		""" Splits raw record lines into chunks and yields each chunk with its VAFs.
+			Yields
+			------
+				chunk: list<bytes>
+				vafs: numpy.ndarray<float>
+		"""
+		chunk = list()
+		for line in lines:
+			chunk.append(line)
+			if len(chunk) == chunk_size:
+				yield chunk, self.compute(chunk)
+				chunk = list()
+		if chunk:
+			yield chunk, self.compute(chunk)
+
+def _divide(alleles, reads):
+	if not reads.all():
+		raise ZeroDivisionError("A record has no reads.")
+	return alleles / reads
+
+def getVafs(filename, sample = 'TUMOR', chunk_size = 10000):
+	""" Calculates the VAF of every record in a vcf file, for cohort reports.
+		Parameters
+		----------
+			filename: string [PATH]
+			sample: string; default 'TUMOR'
+			chunk_size: int; default 10000
+				The number of records converted at once.
+		Returns
+		-------
+			result: dict<string, numpy.ndarray>
+				* 'chromosomes': The chromosome of each record.
+				* 'positions': The position of each record.
+				* 'vafs': The VAF of each record. See VafEngine.compute().
+	"""
+	engine = VafEngine.fromFile(filename, sample)
+	chromosomes = list()
+	positions = list()
+	vafs = list()
+	for chunk, chunk_vafs in engine.iterChunks(scanner.iterRecordLines(filename), chunk_size):
+		for line in chunk:
+			chrom, pos, _ = line.split(b'\t', 2)
+			chromosomes.append(chrom.decode())
+			positions.append(int(pos))
+		vafs.append(chunk_vafs)
+
+	result = {
+		'chromosomes': numpy.array(chromosomes, dtype = object),
+		'positions': numpy.array(positions, dtype = int),
+		'vafs': numpy.concatenate(vafs) if vafs else numpy.zeros(0)
+	}
+	return result
+
+def _addVafHeader(header):
+	""" Adds the VAF '##INFO' line after the other '##INFO' lines, replacing any existing VAF line. """
+	header = [line for line in header if not line.startswith('##INFO=<ID=VAF,')]
+	info_lines = [index for index, line in enumerate(header) if line.startswith('##INFO=')]
+	position = info_lines[-1] + 1 if info_lines else len(header) - 1
+	header.insert(position, VAF_HEADER)
+	return header
+
+def _addVafField(line, vaf):
+	""" Appends 'VAF=' to the INFO column of a raw record line. The other columns are not changed. """
+	fields = line.split(b'\t', INFO + 1)
+	info = fields[INFO].rstrip(b'\r\n')
+	# Keeps the line terminator when INFO is the last column.
+	terminator = fields[INFO][len(info):]
+	items = [item for item in info.split(b';') if item != b'.' and not item.startswith(b'VAF=')]
+	items.append('VAF={}'.format(float(vaf)).encode())
+	fields[INFO] = b';'.join(items) + terminator
+	return b'\t'.join(fields)
+
+def annotateVcf(source, destination, sample = 'TUMOR', chunk_size = 10000):
+	""" Adds the VAF of the TUMOR sample to the INFO column of each record, without parsing
+		the rest of the record. Used by GATKMergeSampleCallsets._modify_merged_vcf().
+		Parameters
+		----------
+			source, destination: string [PATH]
+				Either may be plain or bgzipped. The destination is bgzipped and
+				indexed if it ends in '.gz'.
+			sample: string; default 'TUMOR'
+			chunk_size: int; default 10000
+				The number of records converted at once.
+		Returns
+		-------
+			destination: string
+	"""
+	with vcfio.openVcf(source, 'rb') as input_file, vcfio.openVcf(destination, 'wb') as output_file:
+		header = list()
+		lines = iter(input_file)
+		for line in lines:
+			if not line.startswith(b'#'):
+				lines = itertools.chain([line], lines)
+				break
+			header.append(line.decode().rstrip('\r\n'))
+
+		engine = VafEngine(header, sample)
+		for line in _addVafHeader(header):
+			output_file.write((line + '\n').encode())
+		records = (line for line in lines if line.strip())
+		for chunk, vafs in engine.iterChunks(records, chunk_size):
+			for line, vaf in zip(chunk, vafs):
+				output_file.write(_addVafField(line, vaf))
+	return destination
@@ -0,0 +1,227 @@
+""" Opens plain and bgzipped vcf files.
+	Files read with openVcf() may be plain text, gzipped or bgzipped. Bgzipped files
+	are decompressed by a pool of threads. Files written
+	with openVcf() are bgzipped if their name ends in '.gz', and are indexed with
+	tabix as they are written.
+"""
+import contextlib
+import gzip
+import io
+import os
+import re
+import tempfile
+
+from . import bgzf, tabix
+
+OUTPUT_FORMATS = ('vcf', 'vcf.gz')
+_END_REGEX = re.compile(rb'(?:^|;)END=([0-9]+)')
+
+def isGzipped(filename):
+	with open(filename, 'rb') as file1:
+		return file1.read(2) == b'\x1f\x8b'
+
+def getOutputFilename(filename, output_format = 'vcf'):
+	""" Adds or removes the '.gz' extension of a filename to match `output_format`.
+		Parameters
+		----------
+			filename: string [PATH]
+			output_format: {'vcf', 'vcf.gz'}; default 'vcf'
+	"""
+	if output_format not in OUTPUT_FORMATS:
+		message = "Unsupported output format: '{}'. Expected one of {}".format(output_format, OUTPUT_FORMATS)
+		raise ValueError(message)
+	if filename.endswith('.gz'):
+		filename = filename[:-3]
+	if output_format == 'vcf.gz':
+		filename += '.gz'
+	return filename
+
+def getRecordInterval(line):
+	""" Returns the chromosome and the 0-based, half-open interval covered by a raw record line,
+		the same way as tabix: the REF allele, or up to INFO/END if it is provided.
+	"""
+	fields = line.split(b'\t', 8)
+	begin = int(fields[1]) - 1
+	end = begin + len(fields[3])
+	if len(fields) > 7:
+		match = _END_REGEX.search(fields[7])
+		if match:
+			end = max(end, int(match.group(1)))
+	return fields[0].decode(), begin, end
+
+class IndexedBgzfWriter:
+	""" Writes a bgzipped vcf file and indexes the records as they are written.
+		Accepts both text and bytes, so it can be passed to vcf.Writer().
+	"""
+	def __init__(self, filename, mode = 'wb', index = 'tbi', threads = None):
+		"""
+			Parameters
+			----------
+				filename: string [PATH]
+				mode: {'wb', 'ab'}; default 'wb'
+				index: {'tbi', 'csi', None}, tabix.IndexBuilder; default 'tbi'
+					The kind of index to write to '{filename}.{index}' when the file is closed.
+					If an IndexBuilder is given, records are added to it, but the caller is
+					responsible for writing the index. This allows a file to be reopened in
+					append mode.
+				threads: int; default None
+					The number of compression threads. See bgzf.BgzfWriter.
+		"""
+		self.filename = filename
+		self.writer = bgzf.BgzfWriter(filename, mode, threads)
+		self.write_index = isinstance(index, str)
+		self.index = tabix.IndexBuilder(index) if self.write_index else index
+		self._partial = b''
+		# Records whose blocks haven't been written yet.
+		self._unresolved = list()
+
+	def write(self, data):
+		if isinstance(data, str):
+			data = data.encode()
+		if self.index is not None:
+			lines = (self._partial + data).split(b'\n')
+			self._partial = lines.pop()
+			for line in lines:
+				start = self.writer.tell()
+				self.writer.write(line + b'\n')
+				if line and not line.startswith(b'#'):
+					self._unresolved.append((line, start, self.writer.tell()))
+			self._resolve()
+		else:
+			self.writer.write(data)
+		return len(data)
+
+	def _resolve(self):
+		resolved = 0
+		for line, start, end in self._unresolved:
+			end_offset = self.writer.resolve(end)
+			if end_offset is None: break
+			chrom, begin, stop = getRecordInterval(line)
+			self.index.add(chrom, begin, stop, self.writer.resolve(start), end_offset)
+			resolved += 1
+		del self._unresolved[:resolved]
+
+	def close(self):
+		if self.writer.closed: return
+		if self._partial:
+			self.write(b'\n')
+		self.writer.close()
+		if self.index is not None:
+			self._resolve()
+			if self.write_index:
+				saveIndex(self.index, self.filename)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+def saveIndex(builder, filename):
+	""" Writes the index of a bgzipped vcf file from a tabix.IndexBuilder to '{filename}.tbi' or
+		'{filename}.csi'. Unsorted files are not indexed.
+	"""
+	if not builder.sorted:
+		print("{} is not sorted and was not indexed.".format(filename))
+		return None
+	index = builder.build()
+	return tabix.writeIndex(index, "{}.{}".format(filename, index.kind))
+
+def indexVcf(filename, index = 'tbi'):
+	""" Indexes an existing bgzipped vcf file, like `tabix -p vcf`.
+		Parameters
+		----------
+			filename: string [PATH]
+			index: {'tbi', 'csi'}; default 'tbi'
+		Returns
+		-------
+			index_filename: string
+				None if the file is not sorted.
+	"""
+	builder = tabix.IndexBuilder(index)
+	with bgzf.BgzfReader(filename) as reader:
+		while True:
+			start = reader.tell()
+			line = reader.readline()
+			if not line: break
+			if line.startswith(b'#') or not line.strip(): continue
+			chrom, begin, end = getRecordInterval(line)
+			builder.add(chrom, begin, end, start, reader.tell())
+	return saveIndex(builder, filename)
+
+def openVcf(filename, mode = 'r', index = 'tbi', threads = None):
+	""" Opens a vcf file for reading or writing.
+		Parameters
+		----------
+			filename: string [PATH]
+			mode: {'r', 'rb', 'w', 'wb', 'a', 'ab'}; default 'r'
+				Gzipped and bgzipped files are decompressed when read, so pass
+				`compressed = False` to vcf.Reader(). Files written to a filename
+				ending in '.gz' are bgzipped.
+			index: {'tbi', 'csi', None}, tabix.IndexBuilder; default 'tbi'
+				Passed to IndexedBgzfWriter when writing a bgzipped file.
+			threads: int; default None
+				The number of threads used to compress or decompress a bgzipped file.
+	"""
+	if mode.startswith('r'):
+		if not isGzipped(filename):
+			return open(filename, mode)
+		if bgzf.isBgzf(filename):
+			vcf_file = io.BufferedReader(bgzf.BgzfRawReader(bgzf.BgzfReader(filename, threads)))
+		else:
+			vcf_file = gzip.open(filename, 'rb')
+		return vcf_file if mode.endswith('b') else io.TextIOWrapper(vcf_file)
+	if filename.endswith('.gz'):
+		# The writer accepts both text and bytes.
+		return IndexedBgzfWriter(filename, mode[0] + 'b', index, threads)
+	return open(filename, mode)
+
+@contextlib.contextmanager
+def atomicOutput(filename):
+	""" Yields a temporary filename to write `filename` to. The file, and its index if one was
+		written, are moved to `filename` if the block finishes, and deleted if it raises. This
+		keeps a partial file from being left behind when a merge fails part way.
+		Usage
+		-----
+			with atomicOutput(output_file) as temporary_file:
+				with openVcf(temporary_file, 'w') as output:
+					...
+	"""
+	folder, basename = os.path.split(filename)
+	# The temporary file keeps the extension, so it is compressed the same way.
+	handle, temporary_file = tempfile.mkstemp(prefix = '.', suffix = '.' + basename, dir = folder or '.')
+	os.close(handle)
+	indexes = [(temporary_file + extension, filename + extension) for extension in ('.tbi', '.csi')]
+	try:
+		yield temporary_file
+	except BaseException:
+		for path in [temporary_file] + [index for index, _ in indexes]:
+			if os.path.exists(path): os.remove(path)
+		raise
+	os.replace(temporary_file, filename)
+	for index, destination in indexes:
+		if os.path.exists(index):
+			os.replace(index, destination)
+
+def compressVcf(source, destination = None, index = 'tbi', remove_source = False):
+	""" Bgzips and indexes a plain vcf file.
+		Parameters
+		----------
+			source: string [PATH]
+			destination: string [PATH]; default None
+				Defaults to '{source}.gz'.
+			index: {'tbi', 'csi', None}; default 'tbi'
+			remove_source: bool; default False
+				Whether to delete the plain file afterwards.
+		Returns
+		-------
+			destination: string
+	"""
+	if destination is None:
+		destination = getOutputFilename(source, 'vcf.gz')
+	with open(source, 'rb') as input_file, openVcf(destination, 'wb', index) as output_file:
+		for line in input_file:
+			output_file.write(line)
+	if remove_source:
+		os.remove(source)
+	return destination
@@ -3,6 +3,10 @@ import vcf
 import shutil
 import sys
 import re
+from collections import OrderedDict
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from itertools import takewhile
 
 if os.name == 'nt':
 	GITHUB_FOLDER = os.path.join(os.getenv('USERPROFILE'), 'Documents', 'Github')
@@ -12,17 +16,40 @@ sys.path.append(GITHUB_FOLDER)
 
 import pytools.systemtools as systemtools
 import pytools.filetools as filetools
-import varianttools.callertools as callertools
+from varianttools import batchtools, callertools
 from pprint import pprint
+from . import bgzf, harmonize, scanner, tabix, vcfio
 
+# Only these chromosomes are saved when splitting a file by chromosome.
+_CHROMOSOME_REGEX = re.compile("chr[0-9MT]{1,3}$")
 
-def copyVcf(source, destination):
-	with open(source, 'r') as input_file:
-		reader = vcf.Reader(input_file)
+
+def copyVcf(source, destination, backend = 'pyvcf', output_format = 'vcf'):
+	""" Copies a vcf file, removing records with a '/' in the REF or first ALT allele.
+		Parameters
+		----------
+			source, destination: string [PATH]
+			backend: {'pyvcf', 'raw'}; default 'pyvcf'
+				'pyvcf' re-writes each record with PyVCF. 'raw' copies the remaining lines
+				verbatim without parsing them, which is much faster but keeps the original
+				header order and number formatting (PyVCF writes '1' as '1.0', for example).
+			output_format: {'vcf', 'vcf.gz'}; default 'vcf'
+				'vcf.gz' bgzips the output and indexes it with tabix. The extension
+				of the destination is changed to match.
+		Returns
+		-------
+			destination: string
+	"""
+	destination = vcfio.getOutputFilename(destination, output_format)
+	if backend == 'raw':
+		return scanner.copyRecords(source, destination, fix_dp4 = 'Varscan' in source)
+
+	with vcfio.openVcf(source, 'r') as input_file:
+		reader = vcf.Reader(input_file, compressed = False)
 		if 'Varscan' in source:
 			reader.formats['DP4'] = reader.formats['DP4']._replace(num=4)
 			reader.formats['DP4'] = reader.formats['DP4']._replace(type='Integer')
-		with open(destination, 'w') as output_file:
+		with vcfio.openVcf(destination, 'w') as output_file:
 			writer = vcf.Writer(output_file, reader)
 			for record in reader:
 				filterOut = '/' in str(record.ALT[0]) or '/' in record.REF
@@ -34,9 +61,265 @@ def copyVcf(source, destination):
 	return destination
 
 
-def splitVcfByChromosome(source, output_folder, create_subfolders = False):
+class _OutputFiles:
+	""" The output files of a function that routes records to several files.
+		At most `max_open_files` files are kept open. Each file is created with the
+		header the first time it is used, and is reopened in append mode if it
+		was closed to make room for another file.
+		Files with names ending in '.gz' are bgzipped, and are indexed when all
+		files are closed.
+	"""
+	def __init__(self, header, max_open_files):
+		self.header_text = "\n".join(header).encode() + b"\n"
+		self.max_open_files = max_open_files
+		self.filenames = dict()
+		# The index of each bgzipped file, kept while the file is reopened.
+		self._indexes = dict()
+		# The open files, with the most recently used last.
+		self._open_files = OrderedDict()
+
+	def get(self, key, getFilename):
+		""" Returns the open file for `key`. `getFilename` is called to name the file
+			the first time the key is used.
+		"""
+		if key in self._open_files:
+			self._open_files.move_to_end(key)
+			return self._open_files[key]
+		if len(self._open_files) >= self.max_open_files:
+			_, oldest_file = self._open_files.popitem(last = False)
+			oldest_file.close()
+
+		if key in self.filenames:
+			output_file = self._open(key, 'ab')
+		else:
+			self.filenames[key] = getFilename()
+			if self.filenames[key].endswith('.gz'):
+				self._indexes[key] = tabix.IndexBuilder()
+			output_file = self._open(key, 'wb')
+			output_file.write(self.header_text)
+		self._open_files[key] = output_file
+		return output_file
+
+	def _open(self, key, mode):
+		return vcfio.openVcf(self.filenames[key], mode, index = self._indexes.get(key))
+
+	def close(self):
+		for output_file in self._open_files.values():
+			output_file.close()
+		self._open_files.clear()
+		for key, index in self._indexes.items():
+			vcfio.saveIndex(index, self.filenames[key])
+		self._indexes.clear()
+
+def _getSourceBasename(source):
+	basename, ext = os.path.splitext(os.path.basename(source))
+	if ext == '.gz':
+		basename = os.path.splitext(basename)[0]
+	return basename
+
+def _getChromosomeFilename(basename, chromosome, output_folder, create_subfolders, output_format = 'vcf'):
+	output_basename = vcfio.getOutputFilename("{}.{}.vcf".format(basename, chromosome), output_format)
+	print(output_basename)
+	if create_subfolders:
+		chromosome_folder = os.path.join(output_folder, chromosome)
+	else: 
+		chromosome_folder = output_folder
+	filetools.checkDir(chromosome_folder, True)
+	return os.path.join(chromosome_folder, output_basename)
+
+def findChromosomeRanges(filename):
+	""" Finds the byte range of each chromosome in a sorted, uncompressed vcf file.
+		Each boundary is found with a binary search over the line starts, so only
+		a few lines are read per chromosome. The search can't see records of another
+		chromosome in the middle of a range, so _copyChromosomeRange() checks every
+		line it copies.
+		Returns
+		-------
+			ranges: list<tuple<string, int, int>>
+				The chromosome, start and end of each range. None if the file is not
+				sorted: a chromosome appears in more than one range, or the first or
+				last line of a range is on another chromosome.
+	"""
+	size = os.path.getsize(filename)
+	with open(filename, 'rb') as vcf_file:
+		while True:
+			start = vcf_file.tell()
+			line = vcf_file.readline()
+			if not line.startswith(b'#'): break
+
+		def getLineStart(offset):
+			""" Returns the start of the first line at or after `offset`. """
+			vcf_file.seek(offset - 1)
+			if vcf_file.read(1) != b'\n':
+				vcf_file.readline()
+			return vcf_file.tell()
+
+		def getChromosome(offset):
+			vcf_file.seek(offset)
+			return vcf_file.readline().split(b'\t', 1)[0].strip()
+
+		def getLastLineStart(start, end):
+			""" Returns the start of the last line in [start, end). """
+			position = end - 1
+			while position > start:
+				block_start = max(start, position - 2**16)
+				vcf_file.seek(block_start)
+				line_break = vcf_file.read(position - block_start).rfind(b'\n')
+				if line_break != -1:
+					return block_start + line_break + 1
+				position = block_start
+			return start
+
+		ranges = list()
+		while start < size:
+			chromosome = getChromosome(start)
+			low, high = start + 1, size
+			while low < high:
+				middle = (low + high) // 2
+				line_start = getLineStart(middle)
+				if line_start < size and getChromosome(line_start) == chromosome:
+					low = middle + 1
+				else:
+					high = middle
+			end = getLineStart(low)
+			if chromosome:
+				if getChromosome(getLastLineStart(start, end)) != chromosome:
+					return None
+				if end < size and getChromosome(end) == chromosome:
+					return None
+				ranges.append((chromosome.decode(), start, end))
+			start = end
+
+	chromosomes = [i[0] for i in ranges]
+	if len(set(chromosomes)) != len(chromosomes):
+		return None
+	return ranges
+
+def _copyChromosomeRange(source, kind, chromosome, start, end, header_text, output_filename):
+	""" Copies the records of one chromosome to a new file with the header attached.
+		Parameters
+		----------
+			kind: {'plain', 'bgzf'}
+				'plain' ranges are byte offsets in an uncompressed file. 'bgzf'
+				files are indexed, and the chromosome is fetched with
+				scanner.fetchRecordLines().
+			start, end: int
+				The range to copy. If None, only the header is written.
+		Raises
+		------
+			ValueError: If a 'plain' range has a line that isn't a record of `chromosome`.
+	"""
+	with vcfio.openVcf(output_filename, 'wb') as output_file:
+		output_file.write(header_text)
+		if start is None:
+			pass
+		elif kind == 'plain':
+			last = b'\n'
+			line_start = b'\n' + chromosome.encode() + b'\t'
+			with open(source, 'rb') as input_file:
+				input_file.seek(start)
+				remaining = end - start
+				while remaining > 0:
+					data = input_file.read(min(remaining, 2**20))
+					if not data: break
+					# Reads up to the end of the line, so each chunk only has whole lines.
+					if not data.endswith(b'\n') and len(data) < remaining:
+						data += input_file.readline(remaining - len(data))
+					lines = data.count(b'\n') + (not data.endswith(b'\n'))
+					if (b'\n' + data).count(line_start) != lines:
+						message = "{} is not sorted: {} has records of other chromosomes.".format(source, chromosome)
+						raise ValueError(message)
+					output_file.write(data)
+					remaining -= len(data)
+					last = data[-1:]
+			if last != b'\n':
+				output_file.write(b'\n')
+		else:
+			for line in scanner.fetchRecordLines(source, chromosome):
+				if not line.endswith(b'\n'): line += b'\n'
+				output_file.write(line)
+	return {chromosome: output_filename}
+
+def _planChromosomeSplit(source, output_folder, create_subfolders, output_format = 'vcf'):
+	""" Lists the jobs needed to split a sorted vcf file by chromosome in parallel.
+		Uncompressed files are split using findChromosomeRanges(). Bgzipped files are
+		split using their tabix or CSI index. Files that can't be split into ranges
+		(unsorted, unindexed or plain gzipped files) are split by a single
+		splitVcfByChromosome() job.
+		Returns
+		-------
+			jobs: list<tuple<function, tuple>>
+				Each function and its arguments. Every job returns a dict mapping each
+				chromosome to its output file.
+	"""
+	basename = _getSourceBasename(source)
+	ranges = None
+	if bgzf.isBgzf(source):
+		kind = 'bgzf'
+		index_filename = tabix.findIndex(source)
+		if index_filename is not None:
+			index = tabix.readIndex(index_filename)
+			ranges = [(name,) + tabix.getReferenceRange(reference)
+				for name, reference in zip(index.names, index.references)]
+			with bgzf.BgzfReader(source) as reader:
+				header = [line.decode().rstrip('\r\n') for line in takewhile(lambda s: s.startswith(b'#'), reader)]
+	elif vcfio.isGzipped(source):
+		# Plain gzip can't be read from an offset, so the file is split as a single stream.
+		pass
+	else:
+		kind = 'plain'
+		ranges = findChromosomeRanges(source)
+		header = scanner.readHeader(source)
+
+	if ranges is None:
+		return [(partial(splitVcfByChromosome, output_format = output_format), (source, output_folder, create_subfolders))]
+
+	header_text = "\n".join(header).encode() + b"\n"
+	jobs = list()
+	for chromosome, start, end in ranges:
+		if not _CHROMOSOME_REGEX.search(chromosome): continue
+		output_filename = _getChromosomeFilename(basename, chromosome, output_folder, create_subfolders, output_format)
+		jobs.append((_copyChromosomeRange, (source, kind, chromosome, start, end, header_text, output_filename)))
+
+	# Chromosomes without any records still get a file with the header.
+	found = set(i[0] for i in ranges)
+	for chromosome in scanner.getContigs(header):
+		if chromosome in found or not _CHROMOSOME_REGEX.search(chromosome): continue
+		output_filename = _getChromosomeFilename(basename, chromosome, output_folder, create_subfolders, output_format)
+		jobs.append((_copyChromosomeRange, (source, kind, chromosome, None, None, header_text, output_filename)))
+	return jobs
+
+def _runSplitJobs(jobs, processes):
+	""" Runs the jobs from _planChromosomeSplit() in a process pool.
+		Returns
+		-------
+			output_filenames: dict<string, string>
+				The file each chromosome was saved to.
+			errors: dict<string, ValueError>
+				The first error raised by the jobs of each source file, such as a range of
+				an unsorted file having records of another chromosome. The outputs of
+				these files are incomplete, and the files have to be split again.
+	"""
+	output_filenames = dict()
+	errors = dict()
+	with ProcessPoolExecutor(max_workers = processes) as executor:
+		futures = [(arguments[0], executor.submit(function, *arguments)) for function, arguments in jobs]
+		for source, future in futures:
+			try:
+				output_filenames.update(future.result())
+			except ValueError as exception:
+				errors.setdefault(source, exception)
+	return output_filenames, errors
+
+def _reportSerialSplit(source, exception):
+	print(exception)
+	print("Splitting {} in a single process instead.".format(source))
+
+def splitVcfByChromosome(source, output_folder, create_subfolders = False, max_open_files = 8, processes = None, output_format = 'vcf'):
 	""" Separates a vcf file into separate files for each chromosome.
-		Assumes the file is sorted.
+		Records are copied to the output files as they are read, so memory use does not
+		depend on the size of the file. Sorted files only need one open output file at a
+		time; unsorted files are also supported, but output files may need to be reopened.
 		
 		Parameters
 		----------
@@ -44,45 +327,61 @@ def splitVcfByChromosome(source, output_folder, create_subfolders = False):
 			output_folder: string [PATH]
 			create_subfolders: bool; default False
 				If 'True', each chromosome will be saved to a separate folder.
+			max_open_files: int; default 8
+				The maximum number of output files to keep open at once.
+			processes: int; default None
+				If provided, sorted files are split in parallel by this many processes,
+				with each process copying the byte range of one chromosome.
+			output_format: {'vcf', 'vcf.gz'}; default 'vcf'
+				'vcf.gz' bgzips each output file and indexes it with tabix.
+		Returns
+		-------
+			output: dict<string, string>
+				The file each chromosome was saved to.
 	"""
-	basename = os.path.basename(source)
-	basename, ext = os.path.splitext(basename)
-	_match_chroms = "chr[0-9MT]{1,3}$"
-	_match_chroms = re.compile(_match_chroms)
-
-	with open(source, 'r') as input_vcf_file:
-		reader = vcf.Reader(input_vcf_file)
-		#pprint(reader.contigs)
-		chromosomes = {i:list() for i in reader.contigs}
-		# Sort the records by chromosome
-		for record in reader:
-			chrom = record.CHROM
-			if chrom not in chromosomes: 
-				chromosomes[chrom] = list() 
-			chromosomes[chrom].append(record)
-
-		for chromosome, record_list in chromosomes.items():
-			match = _match_chroms.search(chromosome)
-			if not match: continue
-			print(chromosome, match)
-			output_basename = "{}.{}.vcf".format(basename, chromosome)
-			print(output_basename)
-			if create_subfolders:
-				chromosome_folder = os.path.join(output_folder, chromosome)
-			else: 
-				chromosome_folder = output_folder
-
-			output_filename       = os.path.join(chromosome_folder, output_basename)
-
-			filetools.checkDir(chromosome_folder, True)
-			with open(output_filename, 'w') as output_vcf:
-				writer = vcf.Writer(output_vcf, reader)
-				if len(record_list) > 0:
-					for record in record_list:
-						writer.write_record(record)
-
-
-def splitCallsetByChromosome(callset, output_folder):
+	if processes is not None:
+		jobs = _planChromosomeSplit(source, output_folder, create_subfolders, output_format)
+		if len(jobs) > 1:
+			output_filenames, errors = _runSplitJobs(jobs, processes)
+			if not errors:
+				return output_filenames
+			# The ranges of unsorted files can look consistent at their boundaries.
+			_reportSerialSplit(source, errors[source])
+
+	basename = _getSourceBasename(source)
+
+	header = scanner.readHeader(source)
+	outputs = _OutputFiles(header, max_open_files)
+
+	current_chromosome = None
+	output_file = None
+	try:
+		for line in scanner.iterRecordLines(source):
+			chromosome = line[:line.find(b'\t')]
+			if chromosome != current_chromosome:
+				current_chromosome = chromosome
+				chromosome = chromosome.decode()
+				if _CHROMOSOME_REGEX.search(chromosome):
+					output_file = outputs.get(chromosome,
+						lambda: _getChromosomeFilename(basename, chromosome, output_folder, create_subfolders, output_format))
+				else:
+					output_file = None
+			if output_file is not None:
+				if not line.endswith(b'\n'): line += b'\n'
+				output_file.write(line)
+
+		# Chromosomes without any records still get a file with the header.
+		for chromosome in scanner.getContigs(header):
+			if chromosome not in outputs.filenames and _CHROMOSOME_REGEX.search(chromosome):
+				outputs.get(chromosome, lambda: _getChromosomeFilename(basename, chromosome, output_folder, create_subfolders, output_format))
+	finally:
+		outputs.close()
+
+	output_filenames = outputs.filenames
+	return output_filenames
+
+
+def splitCallsetByChromosome(callset, output_folder, processes = None, output_format = 'vcf'):
 	""" Splits the files in a patients callset.
 
 		Parameters
@@ -93,6 +392,11 @@ def splitCallsetByChromosome(callset, output_folder):
 			output_folder: string
 				The folder to save the split files to.
 				Each chromosome will be saved to a separate sub-folder.
+			processes: int; default None
+				If provided, every chromosome of every caller is split concurrently
+				using at most this many processes in total. Files that turn out to be
+				unsorted are split again afterwards, one at a time.
+			output_format: {'vcf', 'vcf.gz'}; default 'vcf'
 	"""
 	filetools.checkDir(output_folder)
 
@@ -100,11 +404,25 @@ def splitCallsetByChromosome(callset, output_folder):
 		classifier = callertools.CallerClassifier()
 		callset = classifier(callset, key = 'original')
 
+	if processes is not None:
+		jobs = list()
+		errors = dict()
+		for caller, filename in callset.items():
+			try:
+				jobs += _planChromosomeSplit(filename, output_folder, True, output_format)
+			except ValueError as exception:
+				errors[filename] = exception
+		errors.update(_runSplitJobs(jobs, processes)[1])
+		for filename, exception in errors.items():
+			_reportSerialSplit(filename, exception)
+			splitVcfByChromosome(filename, output_folder, create_subfolders = True, output_format = output_format)
+		return
+
 	for caller, filename in callset.items():
-		splitVcfByChromosome(filename, output_folder, create_subfolders = True)
+		splitVcfByChromosome(filename, output_folder, create_subfolders = True, output_format = output_format)
 
 
-def splitVcf(filename, output_folder = None):
+def splitVcf(filename, output_folder = None, output_format = 'vcf'):
 	""" Separates a vcf file into indel and snp sections.
 		Parameters
 		----------
@@ -114,6 +432,8 @@ def splitVcf(filename, output_folder = None):
 				The folder to save the output files to. If None,
 				the files will be saved to the folder the original file
 				resides.
+			output_format: {'vcf', 'vcf.gz'}; default 'vcf'
+				'vcf.gz' bgzips the output files and indexes them with tabix.
 
 		Returns
 		-------
@@ -124,18 +444,20 @@ def splitVcf(filename, output_folder = None):
 					The snp file
 	"""
 
-	path, basename = os.path.split(filename)
+	path = os.path.dirname(filename)
 	if output_folder is None: output_folder = path
-	basename, ext = os.path.splitext(basename)
-	snp_filename = os.path.join(output_folder, basename + ".snp.vcf")
-	indel_filename=os.path.join(output_folder, basename + ".indel.vcf")
+	basename = _getSourceBasename(filename)
+	snp_filename = os.path.join(output_folder, vcfio.getOutputFilename(basename + ".snp.vcf", output_format))
+	indel_filename=os.path.join(output_folder, vcfio.getOutputFilename(basename + ".indel.vcf", output_format))
 	
-	with open(filename, 'r') as vcf_file:
+	with vcfio.openVcf(filename, 'r') as vcf_file, \
+		vcfio.openVcf(snp_filename, 'w') as snp_file, \
+		vcfio.openVcf(indel_filename, 'w') as indel_file:
 		
-		reader          = vcf.Reader(vcf_file)
+		reader          = vcf.Reader(vcf_file, compressed = False)
 
-		snp_writer      = vcf.Writer(open(snp_filename,   'w'), reader)
-		indel_writer    = vcf.Writer(open(indel_filename, 'w'), reader)
+		snp_writer      = vcf.Writer(snp_file,   reader)
+		indel_writer    = vcf.Writer(indel_file, reader)
 		for record in reader:
 			if record.is_snp:
 				snp_writer.write_record(record)
@@ -152,7 +474,7 @@ def splitVcf(filename, output_folder = None):
 	return result
 
 
-def splitCallset(callset, output_folder, **kwargs):
+def splitCallset(callset, output_folder, output_format = 'vcf', **kwargs):
 	split_callset = dict()
 	#pprint(callset)
 	for caller_name, source in callset.items():
@@ -161,10 +483,13 @@ def splitCallset(callset, output_folder, **kwargs):
 		
 		if 'indel' in caller_name or 'snp' in caller_name:
 			destination = os.path.join(output_folder, os.path.basename(source))
-			shutil.copy2(source, destination)
+			if output_format == 'vcf':
+				shutil.copy2(source, destination)
+			else:
+				destination = vcfio.compressVcf(source, vcfio.getOutputFilename(destination, output_format))
 			split_callset[caller_name] = destination
 		else:
-			result = splitVcf(source, output_folder)
+			result = splitVcf(source, output_folder, output_format)
 			split_callset[caller_name + '-indel'] = result['indel']
 			split_callset[caller_name + '-snp']   = result['snp']
 			#print("\t\tDestination: ", result['indel'])
@@ -173,6 +498,131 @@ def splitCallset(callset, output_folder, **kwargs):
 	return split_callset
 
 
+def _routeByType(fields):
+	return scanner.getVariantClass(fields[scanner.REF], fields[scanner.ALT], fields[scanner.INFO])
+
+def _routeByChromosome(fields):
+	chromosome = fields[scanner.CHROM]
+	return chromosome if _CHROMOSOME_REGEX.search(chromosome) else None
+
+def _routeByFilter(fields):
+	return 'PASS' if fields[scanner.FILTER] in ('PASS', '.') else 'filtered'
+
+# The routing keys available to partitionVcf() by name.
+ROUTING_KEYS = {
+	'type': _routeByType,
+	'chromosome': _routeByChromosome,
+	'filter': _routeByFilter
+}
+
+def partitionVcf(source, output_folder = None, keys = ('type',), remove_slash_alleles = True, max_open_files = 32,
+		output_format = 'vcf'):
+	""" Reads a vcf file once and sends each record to an output file chosen by
+		a combination of routing keys. This does the work of copyVcf(), splitVcf()
+		and splitVcfByChromosome() in a single pass. As in copyVcf(), the DP4 header
+		line of VarScan files is fixed.
+		Parameters
+		----------
+			source: string [PATH]
+			output_folder: string [PATH]; default None
+				Defaults to the folder of the source file.
+			keys: list<string, function>; default ('type',)
+				The routing keys. Each key is either the name of a key in ROUTING_KEYS
+				or a function that takes the tab-separated columns of a record (as strings)
+				and returns the name of the partition, or None to drop the record.
+				* 'type': 'snp' or 'indel'. Other records are dropped, as in splitVcf().
+				* 'chromosome': The chromosome. Only the chromosomes saved by
+					splitVcfByChromosome() are kept.
+				* 'filter': 'PASS' or 'filtered'.
+			remove_slash_alleles: bool; default True
+				Drops records with a '/' in the REF or ALT allele, as in copyVcf().
+			max_open_files: int; default 32
+				The maximum number of output files to keep open at once.
+			output_format: {'vcf', 'vcf.gz'}; default 'vcf'
+				'vcf.gz' bgzips each output file and indexes it with tabix.
+		Returns
+		-------
+			output: dict<tuple<string>, string>
+				The file saved for each combination of keys, saved as
+				'{basename}.{key1}.{key2}....vcf'.
+	"""
+	path = os.path.dirname(source)
+	if output_folder is None: output_folder = path
+	filetools.checkDir(output_folder, True)
+	basename = _getSourceBasename(source)
+	routes = [ROUTING_KEYS[key] if isinstance(key, str) else key for key in keys]
+
+	header = scanner.readHeader(source)
+	if 'Varscan' in source:
+		header = [scanner.fixDp4Header(line) for line in header]
+	outputs = _OutputFiles(header, max_open_files)
+	try:
+		for line in scanner.iterRecordLines(source):
+			fields = line.decode().rstrip('\r\n').split('\t', scanner.FORMAT)
+			if remove_slash_alleles and scanner.hasSlashAllele(fields[scanner.REF], fields[scanner.ALT]):
+				continue
+			partition = tuple(route(fields) for route in routes)
+			if None in partition: continue
+			output_file = outputs.get(partition,
+				lambda: os.path.join(output_folder, vcfio.getOutputFilename("{}.{}.vcf".format(basename, '.'.join(partition)), output_format)))
+			if not line.endswith(b'\n'): line += b'\n'
+			output_file.write(line)
+	finally:
+		outputs.close()
+
+	return outputs.filenames
+
+def partitionCallset(callset, output_folder, keys = ('type',), **kwargs):
+	""" Partitions every file in a callset with partitionVcf().
+		Returns
+		-------
+			output: dict<string, dict<tuple<string>, string>>
+				The output of partitionVcf() for each caller.
+	"""
+	return {caller: partitionVcf(source, output_folder, keys, **kwargs) for caller, source in callset.items()}
+
+
+def _getCorrectedFilename(caller, source, **kwargs):
+	if 'output_folder' in kwargs:
+		output_folder = kwargs['output_folder']
+	else:
+		output_folder = os.path.dirname(source)
+
+	if 'patientId' in kwargs:
+		basename = "{}.{}.corrected.vcf".format(kwargs['patientId'], caller)
+	else:
+		basename = os.path.basename(source)
+		basename, ext = os.path.splitext(basename)
+		basename = "{}.corrected.vcf".format(basename)
+
+	return os.path.join(output_folder, basename)
+
+def _getModifyVjsdCommand(caller, source, destination, modify_vjsd_script):
+	""" Returns the modify_VJSD.py command that fixes the output of a caller, or None if
+		the caller's output doesn't need to be fixed.
+	"""
+	if 'varscan' in caller:
+		command = """python3 {program} -method VarScan2 -infile {infile} -outfile {outfile}"""
+	elif 'somaticsniper' in caller:
+		command = """python3 {program} -method SomaticSniper -infile {infile} -outfile {outfile}"""
+	elif 'muse' in caller:
+		command = """python3 {program} -method MuSE -infile {infile} -outfile {outfile}"""
+	else:
+		return None
+
+	command = command.format(
+		program = modify_vjsd_script,
+		infile  = source,
+		outfile = destination)
+	return command
+
+def _copyUncorrectedFile(source, destination, output_format):
+	if output_format == 'vcf.gz':
+		destination = vcfio.compressVcf(source, vcfio.getOutputFilename(destination, output_format))
+	else:
+		shutil.copy2(source, destination)
+	return destination
+
 def fixCallerOutputs(callset, somaticseq_folder, **kwargs):
 	"""
 		Required Parameters
@@ -185,47 +635,102 @@ def fixCallerOutputs(callset, somaticseq_folder, **kwargs):
 		-------------------
 			sample: dict<>
 			patientId: str
+			output_format: {'vcf', 'vcf.gz'}; default 'vcf'
+				'vcf.gz' bgzips the corrected files and indexes them with tabix.
+			native: bool; default False
+				Fixes the files in-process with vcftools.harmonize instead of running
+				modify_VJSD.py. `somaticseq_folder` is not used.
 
 	"""
 
 	modify_vjsd_script   = os.path.join(somaticseq_folder, "modify_VJSD.py")
+	output_format = kwargs.get('output_format', 'vcf')
+	native = kwargs.get('native', False)
 	
 	fixed_callset = dict()
 	for caller, source in callset.items():
-		if 'output_folder' in kwargs:
-			output_folder = kwargs['output_folder']
-		else:
-			output_folder = os.path.dirname(source)
+		destination = _getCorrectedFilename(caller, source, **kwargs)
+		command = _getModifyVjsdCommand(caller, source, destination, modify_vjsd_script)
 
-		if 'patientId' in kwargs:
-			basename = "{}.{}.corrected.vcf".format(kwargs['patientId'], caller)
-		else:
-			basename = os.path.basename(source)
-			basename, ext = os.path.splitext(basename)
-			basename = "{}.corrected.vcf".format(basename)
-
-		destination = os.path.join(output_folder, basename)
-		if 'varscan' in caller:
-			command = """python3 {program} -method VarScan2 -infile {infile} -outfile {outfile}"""
-		elif 'somaticsniper' in caller:
-			command = """python3 {program} -method SomaticSniper -infile {infile} -outfile {outfile}"""
-		elif 'muse' in caller:
-			command = """python3 {program} -method MuSE -infile {infile} -outfile {outfile}"""
-		else:
-			command = None
-
-		if command:
-			command = command.format(
-				program = modify_vjsd_script,
-				infile  = source,
-				outfile = destination)
+		if command and native:
+			destination = vcfio.getOutputFilename(destination, output_format)
+			destination = harmonize.harmonizeVcf(caller, source, destination)
+		elif command:
 			systemtools.Terminal(command, use_system = True)
+			if output_format == 'vcf.gz':
+				destination = vcfio.compressVcf(destination, remove_source = True)
 		else:
-			shutil.copy2(source, destination)
+			destination = _copyUncorrectedFile(source, destination, output_format)
 		fixed_callset[caller] = destination
 
 	return fixed_callset
 
+def fixCallsetOutputs(callsets, somaticseq_folder, runner = None, **kwargs):
+	""" Fixes the callsets of many patients at once. The modify_VJSD.py jobs of every
+		callset are run concurrently by a batchtools.BatchRunner.
+		Parameters
+		----------
+			callsets: dict<str, dict<str, str>>
+				The callset of each patient, keyed by patientId.
+			somaticseq_folder: str [path]
+			runner: batchtools.BatchRunner; default None
+				Defaults to one job per CPU.
+			**kwargs
+				'output_folder', 'output_format' and 'native' are passed to fixCallerOutputs().
+				With 'native', every file is fixed in-process and no jobs are run.
+				'patientId' is not accepted, since each callset is named after its key.
+		Returns
+		-------
+			result: dict<>
+				* 'callsets': dict<str, dict<str, str>>
+					The fixed callset of each patient. Files whose job failed are left out.
+				* 'jobs': list<dict<>>
+					The result of each modify_VJSD.py job. See batchtools.BatchRunner.run().
+		Raises
+		------
+			ValueError: If 'patientId' is passed as a keyword argument.
+	"""
+	if 'patientId' in kwargs:
+		message = "fixCallsetOutputs() takes the patientId of each callset from the keys of `callsets`."
+		raise ValueError(message)
+	modify_vjsd_script   = os.path.join(somaticseq_folder, "modify_VJSD.py")
+	output_format = kwargs.get('output_format', 'vcf')
+
+	fixed_callsets = dict()
+	jobs = list()
+	# The patient and caller of each job.
+	job_callers = list()
+	for patient_id, callset in callsets.items():
+		if kwargs.get('native', False):
+			fixed_callsets[patient_id] = fixCallerOutputs(callset, somaticseq_folder, patientId = patient_id, **kwargs)
+			continue
+		fixed_callsets[patient_id] = dict()
+		for caller, source in callset.items():
+			destination = _getCorrectedFilename(caller, source, patientId = patient_id, **kwargs)
+			command = _getModifyVjsdCommand(caller, source, destination, modify_vjsd_script)
+			if command:
+				name = "{}.{}".format(patient_id, caller)
+				jobs.append(batchtools.Job(name, command, output = destination))
+				job_callers.append((patient_id, caller))
+			else:
+				fixed_callsets[patient_id][caller] = _copyUncorrectedFile(source, destination, output_format)
+
+	if runner is None: runner = batchtools.BatchRunner()
+	results = runner.run(jobs)
+	for (patient_id, caller), result in zip(job_callers, results):
+		if not result['status']:
+			continue
+		destination = result['output']
+		if output_format == 'vcf.gz':
+			destination = vcfio.compressVcf(destination, remove_source = True)
+		fixed_callsets[patient_id][caller] = destination
+
+	result = {
+		'callsets': fixed_callsets,
+		'jobs': results
+	}
+	return result
+
 if __name__ == "__main__":
 	source_folder = "/home/upmc/Documents/Data/raw_snp_output/TCGA-2H-A9GR/"
 	output_folder = "/home/upmc/Documents/Data/raw_snp_output/TCGA-2H-A9GR-CHROMS/"